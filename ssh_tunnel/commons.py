@@ -2,40 +2,806 @@
 Commons function used both by workside and homeside
 """
 
+import asyncio
+import collections
 import hashlib
+import hmac
+import itertools
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 try:
     from Crypto.Cipher import AES
     from Crypto import Random
+    from Crypto.Util.strxor import strxor
 except ImportError:
-    print("Please run ``pip3 install pycrypto``")
+    print("Please run ``pip3 install pycryptodome``")
     import sys
     sys.exit(1)
 
 SALT = b'31415916'
 ITERATIONS = 30
+# Size of the random identifier of the key a process encrypts with, in bytes
+SESSION_SIZE = 8
+# Size of the nonce and of the tag surrounding each message, in bytes
+NONCE_SIZE = 16
+TAG_SIZE = 16
+# Number of peer keys remembered, a new one is used each time the peer
+# restarts. A key is only kept once a frame of its session is authenticated
+PEER_KEYS = 16
+
+# Default time spent waiting for more data before sending a frame, in seconds
+LINGER = 0.01
+# Default maximum size of the records sent in a single frame, in bytes
+MAX_FRAME_SIZE = 65536
+# Default number of concurrent requests in each direction
+WINDOW = 4
+# Default maximum size of the records waiting to be sent, in bytes
+QUEUE_SIZE = 4 * 1024 * 1024
+# Bytes a channel may send when it opens, before the peer grants it more
+CHANNEL_WINDOW = 1024 * 1024
+# Size of the buffers sockets are read into, in bytes
+BUFFER_SIZE = 65536
+# Number of idle buffers a BufferPool keeps
+POOL_BUFFERS = 64
+# A channel which recently put this many bytes in a RecordQueue is bulk, in bytes
+BULK_BYTES = 32768
+# Time after which the bytes put by a channel count half, in seconds
+RATE_HALF_LIFE = 1
+# Bulk data gets at least 1/BULK_SHARE of every batch taken from a RecordQueue
+BULK_SHARE = 4
+# Number of threads of a CryptoPool, if not given
+CRYPTO_WORKERS = os.cpu_count() or 1
+# Default time without any data after which the workside gives up a /stream
+# answer, in seconds. The homeside writes a first frame straight away, then one
+# at least every --hold seconds : nothing coming in time means a proxy holds the answer
+STREAM_TIMEOUT = 30
+# Frames of an epoch not restarted yet a ReorderBuffer keeps at most
+EARLY_FRAMES = 64
+# Default maximum size of the frames kept to be sent again, in bytes
+RETRANSMIT_SIZE = 8 * 1024 * 1024
+
+# Kinds of records exchanged through the tunnel. Each record belongs to a
+# channel, that is to say one ssh client connected to the homeside
+CHANNEL_DATA = 0
+CHANNEL_OPEN = 1
+CHANNEL_CLOSE = 2
+CHANNEL_CREDIT = 3
+# Records of channel 0, about the tunnel itself
+TUNNEL_ACK = 4
+TUNNEL_RESUME = 5
+
+# Version of the frame format, the first byte of every frame
+FRAME_VERSION = 1
+# version, flags, epoch of the sender, sequence number of the frame
+FRAME_HEADER = struct.Struct("!BBIQ")
+# channel id, kind, length of the data following the header
+RECORD_HEADER = struct.Struct("!IBI")
+# bytes granted, the data of a CHANNEL_CREDIT record
+CREDIT = struct.Struct("!I")
+# next seq expected, the data of a TUNNEL_ACK record
+ACK = struct.Struct("!Q")
+# epoch of the peer, next seq expected from it, next seq sent to it, the data of a TUNNEL_RESUME record
+RESUME = struct.Struct("!IQQ")
+# length of the encrypted frame following the header, in the answers of /stream
+STREAM_HEADER = struct.Struct("!I")
+
+# Flags of a frame : its records are compressed, its sender can decompress
+# frames, its records start a new compression stream, its sender traces it
+FLAG_COMPRESSED = 1
+FLAG_ZLIB = 2
+FLAG_RESET = 4
+FLAG_TRACE = 8
+
+
+def pack_frame(epoch, seq, flags, payload):
+    """Serialize the payload sent in one request, that is to say packed
+    records, along with its sequence number
+    """
+    return FRAME_HEADER.pack(FRAME_VERSION, flags, epoch, seq) + payload
+
+
+def unpack_frame(data):
+    """Parse the output of ``pack_frame``. Returns (epoch, seq, flags, payload)"""
+    if len(data) < FRAME_HEADER.size:
+        raise ValueError("Truncated frame header")
+    version, flags, epoch, seq = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported frame version {}".format(version))
+    return epoch, seq, flags, memoryview(data)[FRAME_HEADER.size:]
+
+
+def pack_records(records):
+    """Serialize a list of (channel, kind, data) records. data may be any bytes-like object"""
+    parts = []
+    for channel, kind, data in records:
+        parts.append(RECORD_HEADER.pack(channel, kind, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_records(data):
+    """Parse the output of ``pack_records``. The data of the records are
+    memoryviews of ``data``. Raises ValueError if the data is truncated
+    """
+    data = memoryview(data)
+    records = []
+    offset = 0
+    while offset < len(data):
+        if offset + RECORD_HEADER.size > len(data):
+            raise ValueError("Truncated record header")
+        channel, kind, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            raise ValueError("Truncated record data")
+        records.append((channel, kind, data[offset:offset + length]))
+        offset += length
+    return records
+
+
+class FrameSplitter():
+    """Split the body of a /stream answer into the encrypted frames it
+    carries, whatever pieces the body is read in
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Returns the frames completed by data"""
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= STREAM_HEADER.size:
+            size, = STREAM_HEADER.unpack_from(self.buffer, offset)
+            end = offset + STREAM_HEADER.size + size
+            if end > len(self.buffer):
+                break
+            frames.append(bytes(self.buffer[offset + STREAM_HEADER.size:end]))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+    @property
+    def pending(self):
+        """Bytes of a frame not complete yet"""
+        return len(self.buffer)
+
+
+def _double(block):
+    """Multiplication by x in GF(2^128), as used to derive the OMAC subkeys"""
+    n = int.from_bytes(block, 'big') << 1
+    if n >> 128:
+        n ^= 0x87
+    return (n & ((1 << 128) - 1)).to_bytes(16, 'big')
+
+
+class EAX():
+    """AES in EAX mode, with an empty header, keeping what only depends on
+    the key : creating an AES.MODE_EAX cipher for every message costs more
+    than encrypting a whole frame. Messages are compatible with AES.MODE_EAX
+    """
+    def __init__(self, key):
+        self.key = key
+        self.ecb = AES.new(key, AES.MODE_ECB)
+        self.k1 = _double(self.ecb.encrypt(bytes(16)))
+        self.k2 = _double(self.k1)
+        # OMAC^t of a message starts with the encryption of the block [t]
+        self.starts = [self.ecb.encrypt(bytes(15) + bytes([t])) for t in range(3)]
+        self.header_mac = self.omac(1, b"")
+
+    def omac(self, t, data):
+        """OMAC^t of data, which is any bytes-like object"""
+        if not len(data):
+            return self.ecb.encrypt(strxor(bytes(15) + bytes([t]), self.k1))
+        rest = len(data) % 16 or 16
+        if rest == 16:
+            last = strxor(bytes(data[-16:]), self.k1)
+        else:
+            last = strxor(bytes(data[-rest:]) + b"\x80" + bytes(15 - rest), self.k2)
+        chaining = self.starts[t]
+        if len(data) > rest:
+            chaining = AES.new(self.key, AES.MODE_CBC, iv=chaining).encrypt(data[:-rest])[-16:]
+        return self.ecb.encrypt(strxor(last, chaining))
+
+    def counter(self, nonce):
+        """Returns (omac of the nonce, AES.MODE_CTR cipher) of a message"""
+        nonce_mac = self.omac(0, nonce)
+        return nonce_mac, AES.new(self.key, AES.MODE_CTR, initial_value=nonce_mac, nonce=b"")
+
+    def tag(self, nonce_mac, crypted):
+        return strxor(strxor(nonce_mac, self.omac(2, crypted)), self.header_mac)
+
+    def verify(self, nonce_mac, crypted, tag):
+        """Whether tag authenticates crypted, compared in constant time"""
+        return hmac.compare_digest(self.tag(nonce_mac, crypted), tag)
 
 
 class Cipherer():
-    """Class to abstract symetric encryption between home and work
+    """Class to abstract symetric encryption between home and work.
+
+    Each process encrypts with a key of its own, derived from the
+    passphrase and a random session identifier. Nonces are made of this
+    identifier followed by a counter, so they never repeat without having
+    to draw random bytes for every message.
     """
     def __init__(self, passphrase):
         self.key = hashlib.pbkdf2_hmac('sha256', passphrase.encode(), SALT, ITERATIONS)
+        self.session = Random.new().read(SESSION_SIZE)
+        self.eax = EAX(self.derive_key(self.session))
+        self.counter = itertools.count()
+        # session identifier -> EAX, for the sessions of the peer
+        self.peer_eax = collections.OrderedDict()
+        self.peer_lock = threading.Lock()
+
+    def derive_key(self, session):
+        return hmac.new(self.key, session, hashlib.sha256).digest()
+
+    def peer(self, session):
+        """Returns the EAX of a session of the peer. Only ``trust`` keeps
+        one : anybody may send frames of a made-up session, which must not
+        evict the keys of the real ones
+        """
+        with self.peer_lock:
+            eax = self.peer_eax.get(session)
+        return EAX(self.derive_key(session)) if eax is None else eax
+
+    def trust(self, session, eax):
+        """Keep the EAX of a session, once a frame of it was authenticated"""
+        with self.peer_lock:
+            self.peer_eax[session] = eax
+            self.peer_eax.move_to_end(session)
+            while len(self.peer_eax) > PEER_KEYS:
+                self.peer_eax.popitem(last=False)
+
+    def next_nonce(self):
+        return self.session + struct.pack("!Q", next(self.counter))
 
     def encrypt(self, data):
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(self.key, AES.MODE_EAX, iv)
+        nonce = self.next_nonce()
+        nonce_mac, cipher = self.eax.counter(nonce)
         crypted = cipher.encrypt(data)
-        tag = cipher.digest()
-        msg = iv + crypted + tag
-        return msg
+        return b"".join((nonce, crypted, self.eax.tag(nonce_mac, crypted)))
+
+    def encrypt_into(self, data, buffer, offset=0):
+        """Encrypt data into a writable buffer, which must hold at least
+        ``sealed_size(len(data))`` bytes from offset. data may already be
+        where its ciphertext goes. Returns the number of bytes written
+        """
+        size = self.sealed_size(len(data))
+        view = memoryview(buffer)[offset:offset + size]
+        nonce = self.next_nonce()
+        view[:NONCE_SIZE] = nonce
+        nonce_mac, cipher = self.eax.counter(nonce)
+        crypted = view[NONCE_SIZE:size - TAG_SIZE]
+        cipher.encrypt(data, output=crypted)
+        view[size - TAG_SIZE:] = self.eax.tag(nonce_mac, crypted)
+        return size
+
+    def seal(self, epoch, seq, flags, payload):
+        """Build and encrypt a frame holding a batch of packed records in
+        one pass, the plaintext being encrypted in place
+        """
+        size = FRAME_HEADER.size + len(payload)
+        buffer = bytearray(self.sealed_size(size))
+        FRAME_HEADER.pack_into(buffer, NONCE_SIZE, FRAME_VERSION, flags, epoch, seq)
+        buffer[NONCE_SIZE + FRAME_HEADER.size:NONCE_SIZE + size] = payload
+        self.encrypt_into(memoryview(buffer)[NONCE_SIZE:NONCE_SIZE + size], buffer)
+        return bytes(buffer)
+
+    def open(self, data):
+        """Decrypt a frame sealed by the peer. Returns (epoch, seq, flags, payload),
+        or None if data holds no frame. Raises ValueError if it cannot be decrypted
+        """
+        plaintext = self.decrypt(data)
+        if not plaintext:
+            return None
+        return unpack_frame(plaintext)
+
+    @staticmethod
+    def sealed_size(size):
+        """Size of the encrypted message of ``size`` bytes of data"""
+        return NONCE_SIZE + size + TAG_SIZE
 
     def decrypt(self, data):
+        """Raises ValueError if data was not encrypted by the peer"""
         if not len(data):
             return b''
-        iv = data[:16]
-        msg = data[16:-16]
-        tag = data[-16:]
-        cipher = AES.new(self.key, AES.MODE_EAX, iv)
-        cleartext = cipher.decrypt(msg)
-        cipher.verify(tag)
-        return cleartext
+        if len(data) < NONCE_SIZE + TAG_SIZE:
+            raise ValueError("Truncated message")
+        view = memoryview(data)
+        nonce = bytes(view[:NONCE_SIZE])
+        session = nonce[:SESSION_SIZE]
+        eax = self.peer(session)
+        nonce_mac, cipher = eax.counter(nonce)
+        crypted = view[NONCE_SIZE:-TAG_SIZE]
+        if not eax.verify(nonce_mac, crypted, view[-TAG_SIZE:]):
+            raise ValueError("MAC check failed")
+        self.trust(session, eax)
+        return cipher.decrypt(crypted)
+
+
+class BufferPool():
+    """Reusable bytearrays for the threads reading sockets.
+
+    A thread reads into its buffer with ``recv_into`` then calls ``take``.
+    Reads filling a good part of the buffer hand it over to the RecordQueue
+    as a memoryview, and the queue gives it back once the data is packed
+    into a frame ; smaller reads are copied out, and the buffer is read into
+    again. Queued data thus never pins much more memory than its own size.
+    """
+    def __init__(self, size=BUFFER_SIZE, count=POOL_BUFFERS):
+        self.size = size
+        self.count = count
+        # appending and popping a deque is thread safe
+        self.buffers = collections.deque()
+
+    def get(self):
+        try:
+            return self.buffers.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buffer):
+        if len(self.buffers) < self.count:
+            self.buffers.append(buffer)
+
+    def take(self, buffer, size):
+        """Returns the size bytes read at the start of buffer, and the buffer to read into next"""
+        if size < len(buffer) // 4:
+            return bytes(memoryview(buffer)[:size]), buffer
+        return memoryview(buffer)[:size], self.get()
+
+
+class RecordQueue():
+    """Queue of (channel, kind, data) records, consumed by batches fitting in one frame.
+
+    Putting a record never blocks, but readers of sockets call ``wait_room``
+    first : the queue then holds about ``max_size`` bytes at most, and the
+    data left in the kernel buffers pushes back on the other end. Records
+    may hold memoryviews of the buffers of ``buffers``, a BufferPool : they
+    are given back to it once packed.
+
+    Records keep their order within each channel only. Credit records go
+    first, then the data of interactive channels, then the one of bulk
+    channels, which put ``BULK_BYTES`` or more lately : keystrokes do not
+    wait behind a transfer. Bulk data still gets at least one
+    ``BULK_SHARE``-th of every batch.
+    """
+    def __init__(self, max_size=QUEUE_SIZE, buffers=None):
+        self.buffers = buffers
+        # Credit records, ordered with nothing else
+        self.control = collections.deque()
+        # channel -> records, in the order the channels are served
+        self.queues = collections.OrderedDict()
+        # channel -> (bytes recently put, time they were counted at)
+        self.rates = {}
+        self.count = 0
+        self.size = 0
+        self.max_size = max_size
+        self.seq = 0
+        # Counts the calls to restart
+        self.generation = 0
+        # Batches held back to wait for more data
+        self.lingers = 0
+        # If set, called with the seq of each batch taken and the time the
+        # oldest of its records was put, on the wall clock
+        self.trace = None
+        self.since = None
+        lock = threading.Lock()
+        self.not_empty = threading.Condition(lock)
+        self.not_full = threading.Condition(lock)
+
+    def put(self, record):
+        with self.not_empty:
+            self._append(record)
+            # Consumers waiting for more data to linger on must not hide the
+            # ones waiting for a first record
+            self.not_empty.notify_all()
+
+    def wait_room(self, channel=None):
+        """Block while the queue holds ``max_size`` bytes or more. Interactive
+        channels do not wait, their data is taken first anyway
+        """
+        with self.not_full:
+            self.not_full.wait_for(lambda: self.size < self.max_size or self._interactive(channel))
+
+    def is_bulk(self, channel, now=None):
+        """Whether a channel put ``BULK_BYTES`` or more lately"""
+        recent, last = self.rates.get(channel, (0, 0))
+        now = time.monotonic() if now is None else now
+        return recent * 0.5 ** ((now - last) / RATE_HALF_LIFE) >= BULK_BYTES
+
+    def _interactive(self, channel):
+        return channel is not None and not self.is_bulk(channel)
+
+    def _bulk_pending(self):
+        """Whether a bulk channel has data pending : only those are worth
+        lingering for, interactive data is sent at once
+        """
+        now = time.monotonic()
+        return any(self.is_bulk(channel, now) for channel in self.queues)
+
+    def stats(self):
+        now = time.monotonic()
+        bulk = sum(self.is_bulk(channel, now) for channel in list(self.queues))
+        return {'interactive': len(self.queues) - bulk, 'bulk': bulk, 'lingers': self.lingers}
+
+    def _append(self, record):
+        channel, kind, data = record
+        if kind in (CHANNEL_CREDIT, TUNNEL_ACK):
+            self.control.append(record)
+        else:
+            if kind == CHANNEL_DATA:
+                now = time.monotonic()
+                recent, last = self.rates.get(channel, (0, now))
+                self.rates[channel] = (recent * 0.5 ** ((now - last) / RATE_HALF_LIFE) + len(data), now)
+            self.queues.setdefault(channel, collections.deque()).append(record)
+        self.count += 1
+        self.size += RECORD_HEADER.size + len(data)
+        if self.trace is not None and self.since is None:
+            self.since = time.time()
+
+    def get_batch(self, max_size, timeout=None, linger=0, pack=None):
+        """Wait up to ``timeout`` seconds for a first record, then up to
+        ``linger`` seconds for ``max_size`` bytes to be pending if a bulk
+        channel has data pending, and return them as (seq, records). Batches
+        are numbered from 1 in the order they are taken ; (0, []) is returned
+        if nothing came before the timeout, or if the queue restarted meanwhile.
+
+        If given, ``pack`` is called with the records while the queue is
+        locked, so that batches are packed in the order they are numbered,
+        and its result is returned instead of them.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.not_empty:
+            generation = self.generation
+            while True:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not self.not_empty.wait_for(lambda: self.count or self.generation != generation, remaining):
+                    return 0, []
+                if linger and self._bulk_pending():
+                    self.lingers += 1
+                    self.not_empty.wait_for(lambda: self.size >= max_size or self.generation != generation, linger)
+                if self.generation != generation:
+                    # The consumer may serve a peer which is gone
+                    return 0, []
+                if self.count:
+                    break
+                # Another consumer took everything meanwhile, wait for more
+            self.seq += 1
+            return self.seq, self._take(max_size, pack)
+
+    def restart(self, function):
+        """Call ``function`` with the seq of the next batch while no batch can
+        be taken, and return its result. ``function`` may call ``drop``.
+        The consumers waiting for a batch get none
+        """
+        with self.not_empty:
+            self.generation += 1
+            self._restarted()
+            return function(self.seq + 1)
+
+    def drop(self):
+        """Forget every record waiting. Only call it from a function given
+        to ``restart``, or from the event loop for an AsyncRecordQueue
+        """
+        for records in itertools.chain([self.control], self.queues.values()):
+            for channel, kind, data in records:
+                if self.buffers is not None and isinstance(data, memoryview):
+                    self.buffers.put(data.obj)
+        self.control.clear()
+        self.queues.clear()
+        self.rates.clear()
+        self.count = 0
+        self.size = 0
+        self.since = None
+        self._room_made()
+
+    def _take(self, max_size, pack=None):
+        batch = []
+        # Buffers whose data was all taken
+        done = []
+        room = self._take_from(self.control, max_size, batch, done)
+        now = time.monotonic()
+        interactive, bulk = [], []
+        for channel in self.queues:
+            (bulk if self.is_bulk(channel, now) else interactive).append(channel)
+        # Interactive data goes first, but leaves bulk data its share of the batch
+        share = max_size // BULK_SHARE if bulk else 0
+        for channels, reserved in ((interactive, share), (bulk, 0)):
+            for channel in channels:
+                if batch and room - reserved <= RECORD_HEADER.size:
+                    break
+                records = self.queues[channel]
+                room = self._take_from(records, room - reserved, batch, done) + reserved
+                if records:
+                    # The next batch starts with another channel
+                    self.queues.move_to_end(channel)
+                else:
+                    del self.queues[channel]
+        if self.size < self.max_size:
+            self._room_made()
+        records = [(channel, kind, b"".join(data)) for channel, kind, data in batch]
+        # The data was copied by the join, the buffers may be read into again
+        for buffer in done:
+            self.buffers.put(buffer)
+        if self.trace is not None:
+            self.trace(self.seq, self.since)
+            # The records left waited this long at most
+            self.since = time.time() if self.count else None
+        return pack(records) if pack else records
+
+    def _take_from(self, records, room, batch, done):
+        """Move records to the batch while there is room left for them. Returns the room left"""
+        while records and (not batch or room > RECORD_HEADER.size):
+            channel, kind, data = records[0]
+            room -= RECORD_HEADER.size
+            if len(data) > room and kind == CHANNEL_DATA and room > 0:
+                # Only send what fits, the rest stays first in line
+                records[0] = (channel, kind, data[room:])
+                self.size -= room
+                data = data[:room]
+            else:
+                records.popleft()
+                self.count -= 1
+                self.size -= RECORD_HEADER.size + len(data)
+                if self.buffers is not None and isinstance(data, memoryview):
+                    done.append(data.obj)
+                if kind == CHANNEL_CLOSE:
+                    self.rates.pop(channel, None)
+            room -= len(data)
+            if batch and kind == CHANNEL_DATA and batch[-1][:2] == (channel, CHANNEL_DATA):
+                # Consecutive data of a channel is sent as a single record
+                batch[-1][2].append(data)
+            else:
+                batch.append((channel, kind, [data]))
+        return room
+
+    def _room_made(self):
+        self.not_full.notify_all()
+
+    def _restarted(self):
+        self.not_empty.notify_all()
+
+
+class AsyncRecordQueue(RecordQueue):
+    """RecordQueue for the asyncio engines. It must only be used from the event loop"""
+    def __init__(self, max_size=QUEUE_SIZE):
+        RecordQueue.__init__(self, max_size)
+        self.changed = asyncio.Event()
+
+    def put(self, record):
+        self._append(record)
+        self.changed.set()
+
+    async def wait_room(self, channel=None):
+        """Coroutine version of ``RecordQueue.wait_room``"""
+        await self._wait_for(lambda: self.size < self.max_size or self._interactive(channel), None)
+
+    def _room_made(self):
+        self.changed.set()
+
+    def _restarted(self):
+        self.changed.set()
+
+    async def get_batch(self, max_size, timeout=None, linger=0, pack=None):
+        """Coroutine version of ``RecordQueue.get_batch``"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        generation = self.generation
+        while True:
+            remaining = None if deadline is None else deadline - loop.time()
+            if not await self._wait_for(lambda: self.count or self.generation != generation, remaining):
+                return 0, []
+            if linger and self._bulk_pending():
+                self.lingers += 1
+                await self._wait_for(lambda: self.size >= max_size or self.generation != generation, linger)
+            if self.generation != generation:
+                return 0, []
+            if self.count:
+                break
+            # Another consumer took everything meanwhile, wait for more
+        self.seq += 1
+        return self.seq, self._take(max_size, pack)
+
+    async def _wait_for(self, predicate, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not predicate():
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), None if deadline is None else deadline - loop.time())
+            except asyncio.TimeoutError:
+                return predicate()
+        return True
+
+
+class Credit():
+    """Bytes a channel may still send to the peer, before it grants more"""
+    def __init__(self, size=CHANNEL_WINDOW):
+        self.size = size
+        self.closed = False
+        self.available = threading.Condition()
+
+    def grant(self, size):
+        with self.available:
+            self.size += size
+            self.available.notify()
+
+    def close(self):
+        with self.available:
+            self.closed = True
+            self.available.notify()
+
+    def wait(self):
+        """Block until some bytes may be sent, and return how many. Returns 0 once closed"""
+        with self.available:
+            self.available.wait_for(lambda: self.size > 0 or self.closed)
+            return 0 if self.closed else self.size
+
+    def consume(self, size):
+        with self.available:
+            self.size -= size
+
+
+class AsyncCredit(Credit):
+    """Credit for the asyncio engines. It must only be used from the event loop"""
+    def __init__(self, size=CHANNEL_WINDOW):
+        self.size = size
+        self.closed = False
+        self.changed = asyncio.Event()
+
+    def grant(self, size):
+        self.size += size
+        self.changed.set()
+
+    def close(self):
+        self.closed = True
+        self.changed.set()
+
+    async def wait(self):
+        """Coroutine version of ``Credit.wait``"""
+        while self.size <= 0 and not self.closed:
+            self.changed.clear()
+            await self.changed.wait()
+        return 0 if self.closed else self.size
+
+    def consume(self, size):
+        self.size -= size
+
+
+class CryptoPool():
+    """Seal and open frames in a pool of threads. AES runs without holding
+    the GIL, so frames are encrypted on several cores at once, while the
+    threads or the event loop which handed them over go on with their
+    network I/O. Frames may come out of the pool in any order : the
+    sequence number they got when batched lets the peer put them back in order
+    """
+    def __init__(self, workers=CRYPTO_WORKERS):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crypto")
+
+    def submit(self, function, *args):
+        """Returns a future of ``function(*args)``, called in the pool"""
+        return self.executor.submit(function, *args)
+
+    async def run(self, function, *args):
+        """Coroutine calling ``function(*args)`` in the pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+
+class ReorderBuffer():
+    """Put back in order the frames received by concurrent requests.
+
+    ``deliver`` is called with the content of each frame, following their
+    sequence numbers. The frames of an epoch, that is to say of a process
+    of the peer, are kept aside until ``restart`` tells the seq they start
+    from : up to ``EARLY_FRAMES`` of them, of the last epoch seen only.
+    ``stalled_since`` is the time frames started waiting for the next one.
+    """
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.epoch = None
+        self.next_seq = 1
+        self.pending = {}
+        # Frames received before their epoch restarted, and that epoch
+        self.early = {}
+        self.early_epoch = None
+        self.stalled_since = None
+        self.lock = threading.Lock()
+
+    def restart(self, epoch, next_seq):
+        """Deliver the frames of epoch from next_seq on, dropping the ones before"""
+        with self.lock:
+            if epoch != self.epoch:
+                self.epoch = epoch
+                self.next_seq = next_seq
+                self.pending = self.early if epoch == self.early_epoch else {}
+            else:
+                # The frames of the epoch delivered already are not delivered again
+                self.next_seq = max(self.next_seq, next_seq)
+            self.early = {}
+            self.early_epoch = None
+            self.pending = {seq: content for seq, content in self.pending.items() if seq >= self.next_seq}
+            self._deliver_pending()
+
+    def push(self, epoch, seq, content):
+        with self.lock:
+            if epoch != self.epoch:
+                if epoch != self.early_epoch:
+                    # Only the last process of the peer may be about to restart
+                    self.early = {}
+                    self.early_epoch = epoch
+                if len(self.early) < EARLY_FRAMES:
+                    self.early[seq] = content
+                return
+            if seq < self.next_seq:
+                # Already delivered
+                return
+            self.pending[seq] = content
+            self._deliver_pending()
+
+    def _deliver_pending(self):
+        delivered = False
+        while self.next_seq in self.pending:
+            self.deliver(self.pending.pop(self.next_seq))
+            self.next_seq += 1
+            delivered = True
+        if not self.pending:
+            self.stalled_since = None
+        elif delivered or self.stalled_since is None:
+            self.stalled_since = time.monotonic()
+
+
+class RetransmitBuffer():
+    """Frames sent to the peer, kept by seq until it acknowledges them, so
+    that the ones it missed may be sent again. Past ``max_size`` bytes, the
+    oldest ones are forgotten : frames numbered below ``first`` may be lost
+    """
+    def __init__(self, max_size=RETRANSMIT_SIZE):
+        # seq -> sealed frame, in the order they were put
+        self.frames = collections.OrderedDict()
+        self.size = 0
+        self.max_size = max_size
+        self.first = 1
+        self.lock = threading.Lock()
+
+    def put(self, seq, frame):
+        with self.lock:
+            if seq < self.first:
+                return
+            self.frames[seq] = frame
+            self.size += len(frame)
+            while self.size > self.max_size:
+                forgotten, frame = self.frames.popitem(last=False)
+                self.size -= len(frame)
+                self.first = max(self.first, forgotten + 1)
+
+    def ack(self, seq):
+        """The peer got every frame numbered below seq"""
+        with self.lock:
+            for acked in [s for s in self.frames if s < seq]:
+                self.size -= len(self.frames.pop(acked))
+            self.first = max(self.first, seq)
+
+    def since(self, seq, next_seq):
+        """Returns the frames numbered from seq on, in order, or None if the
+        first one was forgotten. next_seq is the number of the next frame to send
+        """
+        with self.lock:
+            if seq < self.first or (seq < next_seq and seq not in self.frames):
+                return None
+            return [self.frames[s] for s in sorted(self.frames) if s >= seq]
+
+    def restart(self, seq):
+        """Forget every frame, the next one sent being numbered seq"""
+        with self.lock:
+            self.frames.clear()
+            self.size = 0
+            self.first = seq
+
+    def stats(self):
+        with self.lock:
+            return {'frames': len(self.frames), 'bytes': self.size}
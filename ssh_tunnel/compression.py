@@ -0,0 +1,136 @@
+"""Optional compression of the frames, before they are encrypted.
+
+Each direction of the tunnel is a single zlib stream, so that a frame
+benefits from the data sent in the previous ones. Frames are compressed
+in the order of their sequence numbers, and decompressed in the same
+order once the ReorderBuffer has put them back in line. The first frame
+compressed by a new stream says so, for the peer to start a new one too.
+"""
+
+import zlib
+from ssh_tunnel.commons import pack_records, unpack_records, FLAG_COMPRESSED, FLAG_ZLIB, FLAG_RESET
+
+COMPRESSION_LEVEL = 6
+# Frames smaller than this are not worth compressing, in bytes
+MIN_COMPRESS_SIZE = 128
+# A frame is sent compressed if it is shrunk below this ratio
+MAX_RATIO = 0.9
+# Maximum number of frames sent as is after incompressible ones
+MAX_BACKOFF = 64
+
+
+class FrameCompressor():
+    """Compress the payload of the frames sent in one direction, skipping
+    the ones which do not compress. Data such as ssh traffic, which is
+    already encrypted, never compresses : the compressor then backs off,
+    only trying again once in a while
+    """
+    def __init__(self, level=COMPRESSION_LEVEL):
+        self.level = level
+        self.restart()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compressed = 0
+        self.skipped = 0
+
+    def restart(self):
+        """Start a new stream, forgetting the data compressed so far"""
+        self.compressor = zlib.compressobj(self.level)
+        self.backoff = 0
+        self.skip = 0
+        # No frame was compressed by the stream yet
+        self.fresh = True
+
+    def compress(self, data):
+        """Returns the compressed data, or None if it should be sent as is"""
+        if len(data) < MIN_COMPRESS_SIZE:
+            return None
+        if self.skip:
+            self.skip -= 1
+            self.skipped += 1
+            return None
+        # Work on a copy, the stream must not see the frames sent as is
+        attempt = self.compressor.copy()
+        compressed = attempt.compress(data) + attempt.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_in += len(data)
+        if len(compressed) < len(data) * MAX_RATIO:
+            self.compressor = attempt
+            self.backoff = 0
+            self.bytes_out += len(compressed)
+            self.compressed += 1
+            return compressed
+        self.bytes_out += len(data)
+        self.backoff = min(max(1, self.backoff * 2), MAX_BACKOFF)
+        self.skip = self.backoff
+        self.skipped += 1
+        return None
+
+    @property
+    def ratio(self):
+        """Size sent over size given, for the frames compression was tried on"""
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def stats(self):
+        return {'ratio': self.ratio, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'compressed': self.compressed, 'skipped': self.skipped}
+
+
+class FrameDecompressor():
+    """Decompress the frames received in one direction, in the order they were compressed"""
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+
+    def decompress(self, data):
+        try:
+            return self.decompressor.decompress(data)
+        except zlib.error as e:
+            raise ValueError("Cannot decompress frame: {}".format(e))
+
+
+class StreamCompression():
+    """Compression of the frames exchanged by one side of the tunnel.
+
+    Every frame tells whether its sender can decompress frames ; frames are
+    only sent compressed if ``enabled`` and once the peer told so.
+    """
+    def __init__(self, enabled=False, level=COMPRESSION_LEVEL):
+        self.compressor = FrameCompressor(level) if enabled else None
+        self.decompressor = FrameDecompressor()
+        self.peer_epoch = None
+        self.peer_zlib = False
+
+    def restart(self):
+        """Compress the next frames with a new stream. Call it while no frame is packed"""
+        if self.compressor:
+            self.compressor.restart()
+
+    def pack(self, records):
+        """Returns (flags, payload) of a frame. Frames must be packed in the order of their seq"""
+        payload = pack_records(records)
+        if self.compressor and self.peer_zlib:
+            compressed = self.compressor.compress(payload)
+            if compressed is not None:
+                flags = FLAG_ZLIB | FLAG_COMPRESSED
+                if self.compressor.fresh:
+                    self.compressor.fresh = False
+                    flags |= FLAG_RESET
+                return flags, compressed
+        return FLAG_ZLIB, payload
+
+    def received(self, flags):
+        """Take note of the flags of a frame, as soon as it is received"""
+        if flags & FLAG_ZLIB:
+            self.peer_zlib = True
+
+    def unpack(self, epoch, flags, payload):
+        """Returns the records of a frame. Frames must be unpacked in the order of their seq"""
+        if epoch != self.peer_epoch or flags & FLAG_RESET:
+            # The peer restarted, or started a new compression stream
+            self.peer_epoch = epoch
+            self.decompressor = FrameDecompressor()
+        if flags & FLAG_COMPRESSED:
+            payload = self.decompressor.decompress(payload)
+        return unpack_records(payload)
+
+    def stats(self):
+        return self.compressor.stats() if self.compressor else {}
@@ -0,0 +1,288 @@
+"""asyncio engine of the homeside : a single event loop serves the ssh
+clients and the http requests of the workside, instead of a couple of
+threads per client. It speaks the same protocol as the threaded engine.
+"""
+
+import asyncio
+import logging
+import sys
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from threading import Thread
+from ssh_tunnel.commons import AsyncCredit, BUFFER_SIZE, CHANNEL_DATA, STREAM_HEADER
+from ssh_tunnel.homeside.tools import PagePool
+from ssh_tunnel.homeside.tunnel import parse_id, KEEP_ALIVE_TIMEOUT
+from ssh_tunnel.metrics import is_local
+
+SERVER_VERSION = BaseHTTPRequestHandler.server_version + " Python/" + sys.version.split()[0]
+
+logger = logging.getLogger(__name__)
+
+
+class Channel():
+    """An ssh client connected to the listening ssh port"""
+    def __init__(self, identifier, writer):
+        self.identifier = identifier
+        self.writer = writer
+        # Data received on /up for this client, None once the workside closed it
+        self.outgoing_content = asyncio.Queue()
+        # Bytes of the client the workside is ready to take
+        self.credit = AsyncCredit()
+
+    def send(self, data):
+        self.outgoing_content.put_nowait(data)
+
+    def grant(self, size):
+        self.credit.grant(size)
+
+    def close(self):
+        self.outgoing_content.put_nowait(None)
+        self.credit.close()
+
+
+async def read_ssh(tunnel, channel, reader):
+    while True:
+        await tunnel.incoming_content.wait_room(channel.identifier)
+        credit = await channel.credit.wait()
+        if not credit:
+            # Closed by the workside
+            return
+        try:
+            rawdata = await reader.read(min(BUFFER_SIZE, credit))
+        except OSError:
+            rawdata = b""
+        if not rawdata:
+            logger.info("Client of channel %s disconnected", channel.identifier)
+            tunnel.client_gone(channel.identifier)
+            return
+        channel.credit.consume(len(rawdata))
+        tunnel.incoming_content.put((channel.identifier, CHANNEL_DATA, rawdata))
+
+
+async def write_ssh(tunnel, channel):
+    while True:
+        rawdata = await channel.outgoing_content.get()
+        if rawdata is None:
+            break
+        try:
+            channel.writer.write(rawdata)
+            await channel.writer.drain()
+        except OSError:
+            break
+        tunnel.consumed(channel.identifier, len(rawdata))
+    channel.writer.close()
+
+
+def http_response(status, content_type, body, keep_alive):
+    """Build a response looking like the ones of the threaded engine.
+    If body is None, the response is chunked and its body follows
+    """
+    head = ["HTTP/1.1 {} {}".format(status, HTTPStatus(status).phrase),
+            "Server: {}".format(SERVER_VERSION),
+            "Date: {}".format(formatdate(usegmt=True)),
+            "Content-type: {}".format(content_type),
+            "Transfer-Encoding: chunked" if body is None else "Content-Length: {}".format(len(body))]
+    if not keep_alive:
+        head.append("Connection: close")
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+
+class AsyncioEngine():
+    """Listen for ssh clients and http requests on the same event loop"""
+    def __init__(self, tunnel, bind, http_ports, ssh_port, pages=None, crypto=None):
+        self.tunnel = tunnel
+        # Random pages answering the decoy requests
+        self.pages = pages or PagePool()
+        # CryptoPool sealing and opening the frames, or None to do it in the event loop
+        self.crypto = crypto
+        # /stream identifier -> [lock held by the request writing the stream, number of requests]
+        self.streams = {}
+        self.bind = bind
+        self.http_ports = http_ports
+        self.ssh_port = ssh_port
+
+    async def serve(self):
+        ssh_server = await asyncio.start_server(self.handle_ssh, self.bind, self.ssh_port)
+        ssh_server_info = ssh_server.sockets[0].getsockname()
+        logger.info("SSH Socket listening on %s port %s ...", ssh_server_info[0], ssh_server_info[1])
+        http_servers = []
+        for port in self.http_ports:
+            http_servers.append(await asyncio.start_server(self.handle_http, self.bind, port))
+            http_server_info = http_servers[-1].sockets[0].getsockname()
+            logger.info("HTTP Socket listening on %s port %s ...", http_server_info[0], http_server_info[1])
+        await asyncio.gather(ssh_server.serve_forever(), *[server.serve_forever() for server in http_servers])
+
+    async def handle_ssh(self, reader, writer):
+        channel = Channel(self.tunnel.next_channel_id(), writer)
+        logger.info("Got a client on channel %s ! Handle it in new tasks", channel.identifier)
+        self.tunnel.add_channel(channel)
+        await asyncio.gather(read_ssh(self.tunnel, channel, reader), write_ssh(self.tunnel, channel))
+
+    async def handle_http(self, reader, writer):
+        """Serve the requests of an http connection, as long as it is kept alive"""
+        local = is_local(writer.get_extra_info("peername")[0])
+        try:
+            while True:
+                try:
+                    requestline = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                words = requestline.decode("latin-1").split()
+                if len(words) != 3:
+                    break
+                method, path, version = words
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if method == "POST" and path.startswith("/stream"):
+                    self.tunnel.count_request("stream")
+                    await self.handle_stream(parse_id(path), body, version, keep_alive, writer)
+                else:
+                    status, content_type, body = await self.handle_request(method, path, body, local)
+                    writer.write(http_response(status, content_type, body, keep_alive))
+                    await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ValueError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, path, body, local=False):
+        """Returns (status, content type, body) answering a request. ``local``
+        tells whether the client connected from the loopback interface
+        """
+        if method == "POST" and path.startswith("/down"):
+            self.tunnel.count_request("down")
+        elif method == "POST" and path.startswith("/up"):
+            self.tunnel.count_request("up")
+        elif method == "POST" and path.startswith("/exchange"):
+            self.tunnel.count_request("exchange")
+        elif method == "POST" and path.startswith("/resume"):
+            self.tunnel.count_request("resume")
+        else:
+            self.tunnel.count_request("other")
+        if method == "POST" and path == "/":
+            body = b"SSH to HTTP tunnel is up and running"
+            logger.info(body.decode())
+            return 200, "raw", body
+        elif method == "POST" and path.startswith("/down"):
+            return 201, "audio", await self.handle_down(parse_id(path))
+        elif method == "POST" and path.startswith("/up"):
+            try:
+                await self.receive_up(parse_id(path), body)
+                return 201, "audio", b""
+            except ValueError:
+                return 400, "audio", b""
+        elif method == "POST" and path.startswith("/exchange"):
+            # Like an /up request, answered like a /down one
+            try:
+                await self.receive_up(parse_id(path), body)
+            except ValueError:
+                return 400, "audio", b""
+            return 201, "audio", await self.handle_down(parse_id(path))
+        elif method == "POST" and path.startswith("/resume"):
+            try:
+                return 201, "audio", self.tunnel.resume(body)
+            except ValueError:
+                # Answered like any unknown request
+                pass
+        elif method == "GET" and path == "/metrics" and local:
+            return 200, "text/plain; version=0.0.4", self.tunnel.metrics.render()
+        # Fake the ennemy with a normal-looking html page
+        return 200, "raw", self.pages.get()
+
+    async def handle_stream(self, identifier, body, version, keep_alive, writer):
+        """Expose data to the ssh server in a long-lived chunked answer, or
+        in a single frame answered with a Content-Length, like the threaded engine
+        """
+        try:
+            index, framed = self.tunnel.parse_stream(body)
+        except ValueError:
+            writer.write(http_response(200, "raw", self.pages.get(), keep_alive))
+            await writer.drain()
+            return
+        stream = self.streams.setdefault(identifier, [asyncio.Lock(), 0])
+        stream[1] += 1
+        number = stream[1]
+        session = self.tunnel.session
+        try:
+            # A request resuming the stream makes the previous one give up, and waits for it
+            async with stream[0]:
+                if framed or version != "HTTP/1.1":
+                    frame = await self.stream_frame(identifier, index, self.tunnel.hold)
+                    writer.write(http_response(201, "audio", frame, keep_alive))
+                    await writer.drain()
+                    return
+                writer.write(http_response(201, "audio", None, keep_alive))
+                deadline = asyncio.get_running_loop().time() + self.tunnel.stream_time
+                # The first frame is written straight away, telling the workside no proxy holds the answer
+                timeout = 0
+                while stream[1] == number and self.tunnel.session == session:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    if remaining <= 0:
+                        break
+                    frame = await self.stream_frame(identifier, index, min(timeout, remaining))
+                    writer.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                    # A failed write raises here, the frames not written are remembered
+                    await writer.drain()
+                    index += 1
+                    timeout = self.tunnel.hold
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        finally:
+            if stream[1] == number:
+                self.streams.pop(identifier, None)
+
+    async def stream_frame(self, identifier, index, timeout):
+        """Returns the frame number ``index`` of a stream, length-prefixed"""
+        key = self.tunnel.stream_key(identifier, index)
+        body = self.tunnel.replay_down(key)
+        if body is None:
+            seq, packed = await self.tunnel.incoming_content.get_batch(
+                self.tunnel.max_frame_size, timeout=timeout, linger=self.tunnel.linger,
+                pack=self.tunnel.compression.pack)
+            body = await self.answer_down(key, seq, packed)
+        return STREAM_HEADER.pack(len(body)) + body
+
+    async def handle_down(self, identifier):
+        """Expose data to the ssh server, as soon as some is available"""
+        body = self.tunnel.replay_down(identifier)
+        if body is None:
+            seq, packed = await self.tunnel.incoming_content.get_batch(
+                self.tunnel.max_frame_size, timeout=self.tunnel.hold, linger=self.tunnel.linger,
+                pack=self.tunnel.compression.pack)
+            body = await self.answer_down(identifier, seq, packed)
+        return body
+
+    async def receive_up(self, identifier, body):
+        """Hand the body of an /up request to the tunnel, opened in the crypto pool if any"""
+        if self.crypto is None:
+            self.tunnel.receive_up(identifier, body)
+        elif not self.tunnel.duplicate_up(identifier):
+            frame = await self.crypto.run(self.tunnel.open_up, body)
+            self.tunnel.accept_up(identifier, body, frame)
+
+    async def answer_down(self, identifier, seq, packed):
+        """Build the answer of an /down request, sealed in the crypto pool if any"""
+        if self.crypto is None:
+            return self.tunnel.answer_down(identifier, seq, packed)
+        return await self.crypto.run(self.tunnel.answer_down, identifier, seq, packed)
+
+
+class AsyncioThread(Thread):
+    """Run the asyncio engine in its own thread, the main thread runs the ssh client"""
+    def __init__(self, tunnel, bind, http_ports, ssh_port, pages=None, crypto=None, *args, **kwargs):
+        self.engine = AsyncioEngine(tunnel, bind, http_ports, ssh_port, pages, crypto)
+        super(*args, **kwargs)
+        Thread.__init__(self)
+
+    def run(self):
+        asyncio.run(self.engine.serve())
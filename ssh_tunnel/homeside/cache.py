@@ -0,0 +1,73 @@
+"""Bounded cache of the requests already answered, so that retried or
+replayed requests are answered the same way"""
+
+import collections
+import threading
+import time
+
+# Default time a request is remembered after its last use, in seconds
+CACHE_TTL = 300
+# Default maximum size of the remembered content, in bytes
+CACHE_SIZE = 16 * 1024 * 1024
+# Approximate memory used by an entry besides its content, in bytes
+ENTRY_OVERHEAD = 200
+
+
+class RequestCache():
+    """Least recently used request identifiers and their content.
+
+    Entries expire ``ttl`` seconds after their last use, and the least
+    recently used ones are evicted once the cache holds more than
+    ``max_size`` bytes.
+    """
+    def __init__(self, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # identifier -> (expiry, content), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, identifier):
+        """Returns the content remembered for identifier, or None"""
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(identifier)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[identifier] = (time.monotonic() + self.ttl, entry[1])
+            self.entries.move_to_end(identifier)
+            return entry[1]
+
+    def put(self, identifier, content):
+        with self.lock:
+            if identifier in self.entries:
+                self._remove(identifier)
+            self.entries[identifier] = (time.monotonic() + self.ttl, content)
+            self.size += ENTRY_OVERHEAD + len(content)
+            self._expire()
+            while self.size > self.max_size and self.entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.entries:
+            identifier, (expiry, _) = next(iter(self.entries.items()))
+            if expiry > now:
+                break
+            self._remove(identifier)
+
+    def _remove(self, identifier):
+        _, content = self.entries.pop(identifier)
+        self.size -= ENTRY_OVERHEAD + len(content)
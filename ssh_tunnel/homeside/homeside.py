@@ -1,152 +1,322 @@
 #!/usr/bin/env python3
 import argparse
-import io
+import logging
 import queue
-import shutil
 import socket
 import sys
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from threading import Thread
-from ssh_tunnel.commons import Cipherer
-from ssh_tunnel.homeside.tools import read_random_line
+from threading import Lock, Thread
+from ssh_tunnel.commons import AsyncRecordQueue, BufferPool, Cipherer, Credit, CryptoPool, RecordQueue
+from ssh_tunnel.commons import LINGER, MAX_FRAME_SIZE, CHANNEL_DATA, CRYPTO_WORKERS, STREAM_HEADER, RETRANSMIT_SIZE
+from ssh_tunnel.commons import STREAM_TIMEOUT
+from ssh_tunnel.homeside.aio import AsyncioThread
+from ssh_tunnel.homeside.cache import CACHE_TTL, CACHE_SIZE
+from ssh_tunnel.metrics import is_local, log_sampled
+from ssh_tunnel.homeside.tools import PagePool
+from ssh_tunnel.profiling import SamplingProfiler, PROFILE_SIGNAL
+from ssh_tunnel.tracing import Tracer, TRACE_SAMPLE
+from ssh_tunnel.homeside.tunnel import Tunnel, parse_id, HOLD, KEEP_ALIVE_TIMEOUT, STREAM_TIME
 
 
+# Default number of threads serving http requests
+WORKERS = 32
+
 _ssh_server = None
-incoming_content = queue.Queue()
-incoming_done = {}
-outgoing_content = queue.Queue()
-outgoing_done = {}
 ssh_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-cipherer = None
+tunnel = None
+# Random pages answering the decoy requests
+pages = None
+# /stream identifier -> [lock held by the request writing the stream, number of requests]
+streams = {}
+streams_lock = Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class Channel():
+    """An ssh client connected to the listening ssh port"""
+    def __init__(self, identifier, socket):
+        self.identifier = identifier
+        self.socket = socket
+        # Data received on /up for this client, None once the workside closed it
+        self.outgoing_content = queue.Queue()
+        # Bytes of the client the workside is ready to take
+        self.credit = Credit()
+
+    def send(self, data):
+        self.outgoing_content.put(data)
 
+    def grant(self, size):
+        self.credit.grant(size)
 
-def parse_id(path):
-    return path.split("/")[2]
+    def close(self):
+        self.outgoing_content.put(None)
+        self.credit.close()
 
 
 class SSHTunnelHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body are written separately, do not let them wait for an ack
+    disable_nagle_algorithm = True
+
     def do_GET(self):
-        self.send_random_text()
+        tunnel.count_request("other")
+        if self.path == "/metrics" and is_local(self.client_address[0]):
+            self.send_metrics()
+        else:
+            self.send_random_text()
 
     def do_POST(self):
+        content_len = int(self.headers.get('Content-Length', 0))
+        # Always consume the body, the connection is kept alive for the next request
+        self.body = self.rfile.read(content_len)
         if self.path == "/":
+            tunnel.count_request("other")
             self.handle_root()
         elif self.path.startswith("/down"):
+            tunnel.count_request("down")
             self.handle_down()
         elif self.path.startswith("/up"):
+            tunnel.count_request("up")
             self.handle_up()
+        elif self.path.startswith("/exchange"):
+            tunnel.count_request("exchange")
+            self.handle_exchange()
+        elif self.path.startswith("/stream"):
+            tunnel.count_request("stream")
+            self.handle_stream()
+        elif self.path.startswith("/resume"):
+            tunnel.count_request("resume")
+            self.handle_resume()
         else:
+            tunnel.count_request("other")
             self.send_random_text()
 
     def handle_root(self):
         body = b"SSH to HTTP tunnel is up and running"
-        print(body)
-        f = io.BytesIO()
-        f.write(body)
-        f.seek(0)
+        logger.info(body.decode())
         self.send_response(200)
         self.send_header("Content-type", "raw")
         self.send_header("Content-Length", len(body))
         self.end_headers()
         # This needs to be done after sending the headers
-        shutil.copyfileobj(f, self.wfile)
-        f.close()
+        self.wfile.write(body)
 
     def handle_down(self):
         """
-        Expose data to the ssh server
+        Expose data to the ssh server. The request is held until some data
+        is available, then everything pending is sent at once, up to
+        ``max_frame_size`` bytes
         """
         identifier = parse_id(self.path)
-        if identifier in incoming_done:
-            body = incoming_done[identifier]
-        else:
-            try:
-                body = incoming_content.get(timeout=1)
-            except queue.Empty:
-                body = b""
-            incoming_done[identifier] = body
-        body = cipherer.encrypt(body)
-
-        f = io.BytesIO()
-        f.write(body)
-        f.seek(0)
+        body = tunnel.replay_down(identifier)
+        if body is None:
+            seq, packed = tunnel.incoming_content.get_batch(tunnel.max_frame_size, timeout=tunnel.hold,
+                                                            linger=tunnel.linger, pack=tunnel.compression.pack)
+            body = tunnel.answer_down(identifier, seq, packed)
+
         self.send_response(201)
         self.send_header("Content-type", "audio")
         self.send_header("Content-Length", len(body))
         self.end_headers()
         # This needs to be done after sending the headers
-        shutil.copyfileobj(f, self.wfile)
-        f.close()
+        self.wfile.write(body)
+
+    def handle_exchange(self):
+        """
+        Inject the content of the request to the ssh clients, like /up, then
+        answer with the data of the ssh clients, like /down
+        """
+        try:
+            tunnel.receive_up(parse_id(self.path), self.body)
+        except ValueError:
+            self.send_response(400)
+            self.send_header("Content-type", "audio")
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+        self.handle_down()
+
+    def handle_resume(self):
+        """
+        Agree on a session with the workside, and send again the frames it
+        missed in the answer
+        """
+        try:
+            body = tunnel.resume(self.body)
+        except ValueError:
+            self.send_random_text()
+            return
+        self.send_response(201)
+        self.send_header("Content-type", "audio")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_stream(self):
+        """
+        Expose data to the ssh server in a long-lived chunked answer, each
+        frame being written as soon as it is sealed, for ``stream_time``
+        seconds. The body of the request tells how many frames of the stream
+        the workside already got, if it resumes a stream cut short, and may
+        ask for a single frame answered with a Content-Length instead
+        """
+        identifier = parse_id(self.path)
+        try:
+            index, framed = tunnel.parse_stream(self.body)
+        except ValueError:
+            self.send_random_text()
+            return
+        with streams_lock:
+            stream = streams.setdefault(identifier, [Lock(), 0])
+            stream[1] += 1
+            number = stream[1]
+        session = tunnel.session
+        try:
+            # A request resuming the stream makes the previous one give up, and waits for it
+            with stream[0]:
+                if framed or self.request_version != "HTTP/1.1":
+                    body = self.stream_frame(identifier, index, tunnel.hold)
+                    self.send_response(201)
+                    self.send_header("Content-type", "audio")
+                    self.send_header("Content-Length", len(body))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                self.send_response(201)
+                self.send_header("Content-type", "audio")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                deadline = time.monotonic() + tunnel.stream_time
+                # The first frame is written straight away, telling the workside no proxy holds the answer
+                timeout = 0
+                try:
+                    while stream[1] == number and tunnel.session == session:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        frame = self.stream_frame(identifier, index, min(timeout, remaining))
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                        index += 1
+                        timeout = tunnel.hold
+                    self.wfile.write(b"0\r\n\r\n")
+                except OSError:
+                    # The frames not written are remembered, for the workside to resume the stream
+                    self.close_connection = True
+                    return
+        finally:
+            with streams_lock:
+                if stream[1] == number:
+                    streams.pop(identifier, None)
+
+    def stream_frame(self, identifier, index, timeout):
+        """Returns the frame number ``index`` of a stream, length-prefixed,
+        waiting up to timeout seconds for data if it is a new one
+        """
+        key = tunnel.stream_key(identifier, index)
+        body = tunnel.replay_down(key)
+        if body is None:
+            seq, packed = tunnel.incoming_content.get_batch(tunnel.max_frame_size, timeout=timeout,
+                                                            linger=tunnel.linger, pack=tunnel.compression.pack)
+            body = tunnel.answer_down(key, seq, packed)
+        return STREAM_HEADER.pack(len(body)) + body
 
     def handle_up(self):
         """
-        Read the content of the request, and inject it to the ssh client
+        Read the content of the request, and inject it to the ssh clients
         """
         identifier = parse_id(self.path)
-        content_len = int(self.headers.get('Content-Length', 0))
         try:
-            if identifier not in outgoing_done and content_len > 0:
-                body = self.rfile.read(content_len)
-                body = cipherer.decrypt(body)
-                outgoing_content.put(body)
-                outgoing_done[identifier] = body
-                print("Mac verification failed, passing")
-            else:
-                body = outgoing_done[identifier]
+            tunnel.receive_up(identifier, self.body)
             self.send_response(201)
             self.send_header("Content-type", "audio")
+            self.send_header("Content-Length", 0)
             self.end_headers()
         except ValueError:
             self.send_response(400)
             self.send_header("Content-type", "audio")
+            self.send_header("Content-Length", 0)
             self.end_headers()
 
     def log_message(self, format, *args):
         # Mute the default message logger
         return
 
+    def send_metrics(self):
+        """Expose the metrics of the tunnel, to local clients only"""
+        body = tunnel.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
     def send_random_text(self):
         """Fake the ennemy with a normal-looking html page"""
-        body = b'<html><body>'
-        for i in range(0, 200):
-            body += read_random_line("./lib/wordlist.txt")
-            body += b' '
-        body += b'</body></html>'
-        f = io.BytesIO()
-        f.write(body)
-        f.seek(0)
+        body = pages.get()
         self.send_response(200)
         self.send_header("Content-type", "raw")
         self.send_header("Content-Length", len(body))
         self.end_headers()
         # This needs to be done after sending the headers
-        shutil.copyfileobj(f, self.wfile)
-        f.close()
+        self.wfile.write(body)
 
 
 class SSHReadThread(Thread):
-    def __init__(self, socket, *args, **kwargs):
-        self.socket = socket
+    def __init__(self, channel, *args, **kwargs):
+        self.channel = channel
+        self.socket = channel.socket
         super(*args, **kwargs)
         Thread.__init__(self)
 
     def run(self):
+        buffers = tunnel.incoming_content.buffers
+        buffer = buffers.get()
         while True:
-            rawdata = self.socket.recv(2048)
-            incoming_content.put(rawdata)
+            tunnel.incoming_content.wait_room(self.channel.identifier)
+            credit = self.channel.credit.wait()
+            if not credit:
+                # Closed by the workside
+                return
+            try:
+                size = self.socket.recv_into(buffer, min(len(buffer), credit))
+            except OSError:
+                size = 0
+            if not size:
+                logger.info("Client of channel %s disconnected", self.channel.identifier)
+                tunnel.client_gone(self.channel.identifier)
+                return
+            rawdata, buffer = buffers.take(buffer, size)
+            self.channel.credit.consume(size)
+            tunnel.incoming_content.put((self.channel.identifier, CHANNEL_DATA, rawdata))
 
 
 class SSHWriteThread(Thread):
-    def __init__(self, socket, *args, **kwargs):
-        self.socket = socket
+    def __init__(self, channel, *args, **kwargs):
+        self.channel = channel
+        self.socket = channel.socket
         super(*args, **kwargs)
         Thread.__init__(self)
 
     def run(self):
         while True:
-            rawdata = outgoing_content.get()
-            self.socket.send(rawdata)
+            rawdata = self.channel.outgoing_content.get()
+            if rawdata is None:
+                break
+            try:
+                self.socket.sendall(rawdata)
+            except OSError:
+                break
+            tunnel.consumed(self.channel.identifier, len(rawdata))
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
 
 
 class SSHThread(Thread):
@@ -158,58 +328,121 @@ class SSHThread(Thread):
         Thread.__init__(self)
 
     def run(self):
+        # A restarted homeside listens again while the connections of the previous one linger
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.bind, self.port))
         self.socket.listen(0)
         ssh_server_info = self.socket.getsockname()
-        print("SSH Socket listening on", ssh_server_info[0], "port", ssh_server_info[1], "...")
-        print("Now serving ssh")
+        logger.info("SSH Socket listening on %s port %s ...", ssh_server_info[0], ssh_server_info[1])
         while True:
             incomming, _ = self.socket.accept()
-            print("Got a client ! Handle it in a new thread")
-            client_reading_thread = SSHReadThread(incomming)
-            client_writing_thread = SSHWriteThread(incomming)
-            client_reading_thread.start()
-            client_writing_thread.start()
-            client_reading_thread.run()
-            client_writing_thread.run()
+            channel = Channel(tunnel.next_channel_id(), incomming)
+            logger.info("Got a client on channel %s ! Handle it in new threads", channel.identifier)
+            tunnel.add_channel(channel)
+            SSHReadThread(channel).start()
+            SSHWriteThread(channel).start()
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """Handle each connection in a bounded pool of threads, as the workside
+    keeps several connections open at once
+    """
+    def __init__(self, server_address, RequestHandlerClass, workers=WORKERS):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        """Log the error of a connection without its traceback, at most once
+        in a while : a workside gone while its request was held is common
+        """
+        log_sampled(logger, logging.WARNING, "http error", "Error serving %s: %r", client_address[0],
+                    sys.exc_info()[1])
 
 
 class HTTPThread(Thread):
-    def __init__(self, bind, port, cipherer, *args, **kwargs):
+    def __init__(self, bind, port, cipherer, workers=WORKERS, *args, **kwargs):
         self.bind = bind
         self.port = port
         self.cipherer = cipherer
+        self.workers = workers
         super(*args, **kwargs)
         Thread.__init__(self)
 
     def run(self):
-        self.server = HTTPServer((self.bind, self.port), SSHTunnelHTTPRequestHandler)
+        self.server = ThreadPoolHTTPServer((self.bind, self.port), SSHTunnelHTTPRequestHandler, self.workers)
         ssh_server_info = self.server.socket.getsockname()
-        print("HTTP Socket listening on", ssh_server_info[0], "port", ssh_server_info[1], "...")
-        print("Now serving http")
+        logger.info("HTTP Socket listening on %s port %s ...", ssh_server_info[0], ssh_server_info[1])
         self.server.serve_forever()
 
 
-def run(passphrase, protocol="HTTP/1.0", http_port=8000, ssh_port=2222, bind=""):
-    """This run a listening ssh thread, a listening http thread, then
-    starts an external ssh client connecting to the listining ssh port
+def start(passphrase, protocol="HTTP/1.1", http_port=8000, ssh_port=2222, bind="",
+          frame_linger=LINGER, frame_size=MAX_FRAME_SIZE, down_hold=HOLD, workers=WORKERS,
+          engine="threads", cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, compress=False,
+          stream_time=STREAM_TIME, crypto_workers=0, retransmit_size=RETRANSMIT_SIZE, extra_http_ports=(),
+          trace=None, trace_sample=TRACE_SAMPLE):
+    """Start a listening ssh thread and a listening http thread, and return them.
+    The http interface is also served on ``extra_http_ports``, for a workside
+    spreading its requests over several urls. If ``trace`` is given, a share
+    ``trace_sample`` of the frames are traced to this file. With the asyncio
+    engine, a single thread runs an event loop serving both, frames being
+    sealed and opened by ``crypto_workers`` threads if not 0
     """
+    if down_hold >= STREAM_TIMEOUT:
+        logger.warning("Streaming worksides give up /stream answers without data for %s s by default : "
+                       "give them a --stream-timeout longer than the hold of %s s", STREAM_TIMEOUT, down_hold)
     # Instanciate the needed threads
-    global cipherer
+    global tunnel, pages
     cipherer = Cipherer(passphrase)
-    ssh_thread = SSHThread(bind, ssh_port, ssh_socket)
-    http_thread = HTTPThread(bind, http_port, cipherer)
+    settings = dict(linger=frame_linger, max_frame_size=frame_size, hold=down_hold,
+                    cache_ttl=cache_ttl, cache_size=cache_size, compress=compress, stream_time=stream_time,
+                    retransmit_size=retransmit_size, tracer=Tracer(trace, trace_sample) if trace else None)
+    pages = PagePool()
+    if engine == "asyncio":
+        tunnel = Tunnel(cipherer, AsyncRecordQueue(), **settings)
+        crypto = CryptoPool(crypto_workers) if crypto_workers else None
+        threads = [AsyncioThread(tunnel, bind, [http_port, *extra_http_ports], ssh_port, pages, crypto)]
+    else:
+        tunnel = Tunnel(cipherer, RecordQueue(buffers=BufferPool()), **settings)
+        SSHTunnelHTTPRequestHandler.protocol_version = protocol
+        threads = [SSHThread(bind, ssh_port, ssh_socket)] + [HTTPThread(bind, port, cipherer, workers)
+                                                             for port in [http_port, *extra_http_ports]]
+    threads.append(pages)
+    for thread in threads:
+        thread.start()
+    return threads
 
+
+def run(passphrase, ssh_port=2222, profile=None, **settings):
+    """This run a listening ssh thread, a listening http thread, then
+    starts an external ssh client connecting to the listining ssh port.
+    With ``profile``, a SamplingProfiler writes to files starting with it.
+    ``settings`` are the ones of ``start``
+    """
+    if profile:
+        SamplingProfiler(profile).start()
+    threads = []
     try:
-        ssh_thread.start()
-        http_thread.start()
-        print("Starting external ssh client")
+        threads = start(passphrase, ssh_port=ssh_port, **settings)
+        logger.info("Starting external ssh client")
         os.system('ssh -v localhost -p {}'.format(ssh_port))
 
     except Exception as e:
-        print(e)
-        ssh_thread.socket.close()
-        http_thread.server.server_close()
+        logger.error(e)
+        ssh_socket.close()
+        for thread in threads:
+            if hasattr(thread, "server"):
+                thread.server.server_close()
         sys.exit(0)
 
 
@@ -226,7 +459,77 @@ if __name__ == '__main__':
                         default=2222, type=int,
                         nargs='?',
                         help='Specify alternate port for ssh interface [default: 2222]')
+    parser.add_argument('--extra-port', action='append',
+                        default=[], type=int, dest='extra_ports',
+                        help='Also serve the http interface on this port, for a workside spreading its '
+                             'requests over several urls. May be given several times [default: none]')
+    parser.add_argument('--linger', action='store',
+                        default=LINGER, type=float,
+                        help='Specify how long to wait for more ssh data before answering /down '
+                             '[default: {} s]'.format(LINGER))
+    parser.add_argument('--max-frame', action='store',
+                        default=MAX_FRAME_SIZE, type=int,
+                        help='Specify the maximum size of the data sent in a single /down answer '
+                             '[default: {} bytes]'.format(MAX_FRAME_SIZE))
+    parser.add_argument('--hold', action='store',
+                        default=HOLD, type=float,
+                        help='Specify how long a /down request waits for ssh data before '
+                             'being answered empty, and the time between two frames of a /stream answer. It must '
+                             'be shorter than the --stream-timeout of the workside [default: {} s]'.format(HOLD))
+    parser.add_argument('--workers', action='store',
+                        default=WORKERS, type=int,
+                        help='Specify how many http connections are served at once [default: {}]'.format(WORKERS))
+    parser.add_argument('--engine', action='store',
+                        default="threads", choices=["threads", "asyncio"],
+                        help='Serve ssh clients and http requests with threads, '
+                             'or with a single asyncio event loop [default: threads]')
+    parser.add_argument('--cache-ttl', action='store',
+                        default=CACHE_TTL, type=float,
+                        help='Specify how long answered requests are remembered, to answer '
+                             'their retries the same way [default: {} s]'.format(CACHE_TTL))
+    parser.add_argument('--cache-size', action='store',
+                        default=CACHE_SIZE, type=int,
+                        help='Specify how much memory remembered requests may use '
+                             '[default: {} bytes]'.format(CACHE_SIZE))
+    parser.add_argument('--retransmit-size', action='store',
+                        default=RETRANSMIT_SIZE, type=int,
+                        help='Specify how much memory the /down frames kept until the workside '
+                             'acknowledges them may use [default: {} bytes]'.format(RETRANSMIT_SIZE))
+    parser.add_argument('--compress', action='store_true',
+                        help='Compress the /down answers when they shrink, if the workside '
+                             'can decompress them [default: off]')
+    parser.add_argument('--stream-time', action='store',
+                        default=STREAM_TIME, type=float,
+                        help='Specify how long a /stream answer lasts, if the workside streams '
+                             '[default: {} s]'.format(STREAM_TIME))
+    parser.add_argument('--crypto-workers', action='store',
+                        default=0, type=int,
+                        help='Specify how many threads seal and open the frames of the asyncio engine, {} '
+                             'using every core. The threaded engine already does it in the thread of each '
+                             'request [default: 0, in the event loop]'.format(CRYPTO_WORKERS))
+    parser.add_argument('--trace', action='store',
+                        default=None, metavar='FILE',
+                        help='Specify a file to append the time each traced frame reaches each stage to, '
+                             'read with python3 -m ssh_tunnel.tracing [default: not traced]')
+    parser.add_argument('--trace-sample', action='store',
+                        default=TRACE_SAMPLE, type=float,
+                        help='Specify the share of the frames sent which are traced, the workside tracing '
+                             'the same ones [default: {}]'.format(TRACE_SAMPLE))
+    parser.add_argument('--profile', action='store',
+                        default=None, metavar='PREFIX',
+                        help='Sample the stacks of every thread between two {} signals, and write them to '
+                             'PREFIX.<time>.folded [default: off]'.format(PROFILE_SIGNAL.name))
+    parser.add_argument('--log-level', action='store',
+                        default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help='Specify the level of the messages logged [default: INFO]')
     parser.add_argument('passphrase', action='store',
                         help='Specify the passphrase to use. Must be the same that the one specified on workside')
     args = parser.parse_args()
-    run(args.passphrase, ssh_port=args.ssh_port, http_port=args.http_port, bind=args.bind)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M')
+    run(args.passphrase, ssh_port=args.ssh_port, http_port=args.http_port, bind=args.bind,
+        frame_linger=args.linger, frame_size=args.max_frame, down_hold=args.hold, workers=args.workers,
+        engine=args.engine, cache_ttl=args.cache_ttl, cache_size=args.cache_size, compress=args.compress,
+        stream_time=args.stream_time, crypto_workers=args.crypto_workers, retransmit_size=args.retransmit_size,
+        extra_http_ports=args.extra_ports, trace=args.trace, trace_sample=args.trace_sample,
+        profile=args.profile)
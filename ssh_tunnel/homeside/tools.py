@@ -1,25 +1,67 @@
+import array
+import itertools
 import os
+import queue
 import random
+import threading
+from threading import Thread
 
+WORDLIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "lib", "wordlist.txt")
+# Number of words of a random page
+PAGE_WORDS = 200
+# Number of pages kept ready by a PagePool
+POOL_SIZE = 64
 
-def read_random_line(f, chunk_size=16):
-    """Returns a random line from a file"""
-    with open(f, 'rb') as f_handle:
-        f_handle.seek(0, os.SEEK_END)
-        size = f_handle.tell()
-        i = random.randint(0, size)
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class WordIndex():
+    """The lines of a file, loaded once, with the offset of each of them"""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        lines = self.data.splitlines(keepends=True)
+        self.offsets = array.array('L', itertools.accumulate(itertools.chain([0], map(len, lines))))
+        self.count = len(lines)
+
+    def random_lines(self, k):
+        """Returns k lines picked at random"""
+        data, offsets = self.data, self.offsets
+        return [data[offsets[i]:offsets[i + 1]] for i in random.choices(range(self.count), k=k)]
+
+
+def word_index(path):
+    """Returns the WordIndex of a file, loading it the first time"""
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = WordIndex(path)
+        return _indexes[path]
+
+
+def random_page(wordlist=WORDLIST):
+    """Returns a normal-looking html page made of random words"""
+    words = word_index(wordlist).random_lines(PAGE_WORDS)
+    return b''.join([b'<html><body>', b' '.join(words), b' </body></html>'])
+
+
+class PagePool(Thread):
+    """Keep random pages ready, built in the background, so that answering
+    a decoy request only takes a page off the pool
+    """
+    def __init__(self, size=POOL_SIZE, wordlist=WORDLIST, *args, **kwargs):
+        self.pages = queue.Queue(size)
+        self.wordlist = wordlist
+        super(*args, **kwargs)
+        Thread.__init__(self, daemon=True)
+
+    def run(self):
         while True:
-            i -= chunk_size
-            if i < 0:
-                chunk_size += i
-                i = 0
-            f_handle.seek(i, os.SEEK_SET)
-            chunk = f_handle.read(chunk_size)
-            i_newline = chunk.rfind(b'\n')
-            if i_newline != -1:
-                i += i_newline + 1
-                break
-            if i == 0:
-                break
-        f_handle.seek(i, os.SEEK_SET)
-        return f_handle.readline()
+            self.pages.put(random_page(self.wordlist))
+
+    def get(self):
+        """Returns a random page, built on the spot if the pool ran dry"""
+        try:
+            return self.pages.get_nowait()
+        except queue.Empty:
+            return random_page(self.wordlist)
@@ -0,0 +1,302 @@
+"""State of the homeside end of the tunnel, shared by the threaded and
+the asyncio engines
+"""
+
+import itertools
+import logging
+import random
+import time
+from ssh_tunnel.commons import ReorderBuffer, RetransmitBuffer, pack_records, unpack_records
+from ssh_tunnel.compression import StreamCompression
+from ssh_tunnel.metrics import Metrics, log_sampled
+from ssh_tunnel.commons import LINGER, MAX_FRAME_SIZE
+from ssh_tunnel.commons import CHANNEL_DATA, CHANNEL_OPEN, CHANNEL_CLOSE, CHANNEL_CREDIT, TUNNEL_ACK, TUNNEL_RESUME
+from ssh_tunnel.commons import CHANNEL_WINDOW, CREDIT, ACK, RESUME, STREAM_HEADER, RETRANSMIT_SIZE
+from ssh_tunnel.commons import FLAG_RESET, FLAG_TRACE
+from ssh_tunnel.homeside.cache import RequestCache, CACHE_TTL, CACHE_SIZE
+from ssh_tunnel.tracing import UP, DOWN
+
+# Default time a /down request waits for ssh data before being answered empty, in seconds
+HOLD = 10
+# Default time a /stream answer lasts, before the workside sends a new request, in seconds
+STREAM_TIME = 60
+# Time after which an idle keep-alive connection is closed, in seconds
+KEEP_ALIVE_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def parse_id(path):
+    return path.split("/")[2]
+
+
+class Tunnel():
+    """Channels of the connected ssh clients, and frames exchanged with the workside.
+
+    ``incoming_content`` holds the (channel, kind, data) records waiting
+    to be exposed on /down. Engines read it by themselves, as they do not
+    wait the same way, but they pack batches with ``compression.pack``.
+    Channels are engine objects with a ``send(data)``, a ``grant(size)``
+    and a ``close()`` method. They read their ssh client as long as the
+    workside granted them credit, and report the data written to it with
+    ``consumed``, so that the workside is granted credit in turn.
+
+    Frames written in the answer of a /stream request are remembered like
+    /down answers, under ``stream_key``, so that a stream cut short can be
+    resumed from the first frame the workside did not get.
+
+    The workside agrees on a session with ``resume`` when it starts, when
+    the homeside restarted, and when frames went missing. The frames sent
+    on /down are kept in ``sent_frames`` until the workside acknowledges
+    them, to be sent again then.
+    """
+    def __init__(self, cipherer, incoming_content, linger=LINGER, max_frame_size=MAX_FRAME_SIZE, hold=HOLD,
+                 cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, compress=False, stream_time=STREAM_TIME,
+                 retransmit_size=RETRANSMIT_SIZE, tracer=None):
+        self.cipherer = cipherer
+        self.incoming_content = incoming_content
+        self.linger = linger
+        self.max_frame_size = max_frame_size
+        self.hold = hold
+        self.stream_time = stream_time
+        # Answers of the /down requests, and identifiers of the /up requests already handled
+        self.incoming_done = RequestCache(cache_ttl, cache_size)
+        self.outgoing_done = RequestCache(cache_ttl, cache_size)
+        # channel id -> channel, one for each connected ssh client
+        self.channels = {}
+        # channel id -> bytes written to the ssh client, and not granted back to the workside yet
+        self.unacked = {}
+        self.channel_ids = itertools.count(1)
+        # Identify the frames sent by this process on /down
+        self.epoch = random.getrandbits(32)
+        # /up requests may arrive out of order, dispatch their records following their sequence number
+        self.outgoing_frames = ReorderBuffer(self.deliver_frame)
+        self.compression = StreamCompression(compress)
+        # Epoch of the workside of the session, None until one resumed
+        self.peer_epoch = None
+        self.sent_frames = RetransmitBuffer(retransmit_size)
+        # seq of the first frame of the current compression stream
+        self.stream_start = 1
+        # Counts the calls to resume, a /stream answer ends with its session
+        self.session = 0
+        # Tracer stamping the frames at each stage, or None
+        self.tracer = tracer
+        if tracer is not None:
+            incoming_content.trace = lambda seq, since: tracer.taken(DOWN, self.epoch, seq, since)
+        self.metrics = Metrics()
+        self.metrics.gauge("queue_bytes", lambda: self.incoming_content.size)
+        self.metrics.gauge("queue_records", lambda: self.incoming_content.count)
+        self.metrics.gauge("queue_channels", self.incoming_content.stats)
+        self.metrics.gauge("channels", lambda: len(self.channels))
+        self.metrics.gauge("down_cache", self.incoming_done.stats)
+        self.metrics.gauge("up_cache", self.outgoing_done.stats)
+        self.metrics.gauge("compression", self.compression.stats)
+        self.metrics.gauge("retransmit", self.sent_frames.stats)
+
+    def count_request(self, kind):
+        """Count an http request served, by kind : up, down, exchange, stream, resume or other"""
+        self.metrics.count("requests_" + kind)
+
+    def next_channel_id(self):
+        return next(self.channel_ids)
+
+    def add_channel(self, channel):
+        """Register the channel of a new ssh client"""
+        self.channels[channel.identifier] = channel
+        # Let the workside open its connection to sshd before any data comes
+        self.incoming_content.put((channel.identifier, CHANNEL_OPEN, b""))
+
+    def close_channel(self, identifier):
+        """Forget about a channel and tell it to stop"""
+        channel = self.channels.pop(identifier, None)
+        self.unacked.pop(identifier, None)
+        if self.tracer is not None:
+            self.tracer.forget(identifier)
+        if channel:
+            channel.close()
+
+    def client_gone(self, identifier):
+        """The ssh client of a channel disconnected"""
+        self.close_channel(identifier)
+        self.incoming_content.put((identifier, CHANNEL_CLOSE, b""))
+
+    def deliver_frame(self, frame):
+        """Called with the frames received on /up, following their sequence number"""
+        frame_epoch, seq, flags, payload = frame
+        try:
+            records = self.compression.unpack(frame_epoch, flags, payload)
+        except ValueError as e:
+            self.metrics.count("invalid_frames")
+            log_sampled(logger, logging.WARNING, "invalid frame", "Invalid frame received on /up, dropping it: %s", e)
+            return
+        self.dispatch_records(records, (UP, frame_epoch, seq) if flags & FLAG_TRACE else None)
+
+    def dispatch_records(self, records, traced=None):
+        """Hand the records received on /up to the matching ssh clients. The
+        data of a ``traced`` frame is stamped once written to its client
+        """
+        for identifier, kind, data in records:
+            if kind == CHANNEL_CLOSE:
+                self.close_channel(identifier)
+            elif kind == TUNNEL_ACK:
+                self.sent_frames.ack(ACK.unpack(data)[0])
+            else:
+                # The channel may be closed meanwhile by its own thread
+                channel = self.channels.get(identifier)
+                if channel is None:
+                    continue
+                if kind == CHANNEL_DATA:
+                    if self.tracer is not None:
+                        self.tracer.dispatched(identifier, len(data), traced)
+                    channel.send(data)
+                elif kind == CHANNEL_CREDIT:
+                    channel.grant(CREDIT.unpack(data)[0])
+
+    def consumed(self, identifier, size):
+        """A channel wrote size bytes to its ssh client : grant them back to
+        the workside, once enough of them piled up
+        """
+        if identifier not in self.channels:
+            return
+        if self.tracer is not None:
+            self.tracer.written(identifier, size)
+        unacked = self.unacked.get(identifier, 0) + size
+        if unacked >= CHANNEL_WINDOW // 4:
+            self.incoming_content.put((identifier, CHANNEL_CREDIT, CREDIT.pack(unacked)))
+            unacked = 0
+        self.unacked[identifier] = unacked
+
+    def receive_up(self, identifier, body):
+        """Handle the body of an /up request. Raises ValueError if it cannot be decrypted"""
+        if self.duplicate_up(identifier):
+            return
+        self.accept_up(identifier, body, self.open_up(body))
+
+    def duplicate_up(self, identifier):
+        """Whether an /up request was already handled"""
+        if self.outgoing_done.get(identifier) is not None:
+            self.metrics.count("up_duplicates")
+            return True
+        return False
+
+    def open_up(self, body):
+        """Decrypt the body of an /up request, from any thread. Returns its
+        frame, raises ValueError if it cannot be decrypted
+        """
+        received = time.time()
+        start = time.perf_counter()
+        try:
+            frame = self.cipherer.open(body)
+        except ValueError as e:
+            self.metrics.count("invalid_frames")
+            log_sampled(logger, logging.WARNING, "invalid request", "Invalid /up request: %s", e)
+            raise
+        self.metrics.observe("decrypt_seconds", time.perf_counter() - start)
+        if frame is None:
+            raise ValueError("No frame in /up request")
+        if self.tracer is not None:
+            self.tracer.opened(UP, frame, received)
+        return frame
+
+    def accept_up(self, identifier, body, frame):
+        """Handle the frame of an /up request, as returned by ``open_up``"""
+        frame_epoch, seq, flags, payload = frame
+        self.metrics.count("up_frames")
+        self.metrics.count("up_bytes", len(body))
+        self.compression.received(flags)
+        self.outgoing_frames.push(frame_epoch, seq, frame)
+        self.outgoing_done.put(identifier, b"")
+
+    @staticmethod
+    def stream_key(identifier, index):
+        """Identify the frame number ``index`` of a /stream answer"""
+        return "{}/{}".format(identifier, index)
+
+    @staticmethod
+    def parse_stream(body):
+        """Returns (index, framed) out of the body of a /stream request : the
+        number of frames of the stream the workside already got, and whether
+        it asks for a single frame answered with a Content-Length. Raises ValueError
+        """
+        index, _, mode = body.partition(b" ")
+        if not index.isdigit() or mode not in (b"", b"framed"):
+            raise ValueError("Invalid /stream request")
+        return int(index), mode == b"framed"
+
+    def replay_down(self, identifier):
+        """Return the answer already given to an /down request, or None if it is a new one"""
+        body = self.incoming_done.get(identifier)
+        if body is not None:
+            self.metrics.count("down_replayed")
+        return body
+
+    def answer_down(self, identifier, seq, packed):
+        """Build the answer of an /down request from a batch of ``incoming_content``,
+        as packed by ``compression.pack``. It may be called from any thread
+        """
+        if seq:
+            flags, payload = packed
+            if self.tracer is not None:
+                flags |= self.tracer.flag(seq)
+        start = time.perf_counter()
+        body = self.cipherer.seal(self.epoch, seq, flags, payload) if seq else self.cipherer.encrypt(b"")
+        self.metrics.observe("encrypt_seconds", time.perf_counter() - start)
+        if seq and self.tracer is not None:
+            self.tracer.sealed(DOWN, self.epoch, seq)
+        self.metrics.count("down_frames" if seq else "down_empty")
+        self.metrics.count("down_bytes", len(body))
+        self.incoming_done.put(identifier, body)
+        if seq:
+            self.sent_frames.put(seq, body)
+        return body
+
+    def resume(self, body):
+        """Handle the body of a /resume request : a frame numbered 0 telling
+        the session the workside knows. Returns the answer, length-prefixed
+        frames like the ones of /stream : a frame numbered 0 telling the
+        session agreed on, then the frames the workside missed. Raises ValueError
+        """
+        peer_epoch, seq, flags, payload = self.open_up(body)
+        records = [data for channel, kind, data in unpack_records(payload) if kind == TUNNEL_RESUME]
+        if seq or not records:
+            raise ValueError("No session in /resume request")
+        known_epoch, down_next, up_next = RESUME.unpack(records[0])
+        gone = []
+
+        def restart(next_seq):
+            self.session += 1
+            if peer_epoch == self.peer_epoch and known_epoch == self.epoch:
+                frames = self.sent_frames.since(down_next, next_seq)
+                if frames is not None:
+                    # Same session, send the frames the workside missed again
+                    return down_next, frames, 0
+            elif self.peer_epoch is None:
+                # First workside since this process started, it gets all the frames sent so far
+                frames = self.sent_frames.since(self.stream_start, next_seq)
+                if frames is not None:
+                    self.peer_epoch = peer_epoch
+                    self.outgoing_frames.restart(peer_epoch, up_next)
+                    return self.stream_start, frames, FLAG_RESET
+            # The workside restarted, or frames it did not get were forgotten :
+            # the data of the channels is lost, and their ssh clients must know
+            gone.extend(self.channels)
+            self.incoming_content.drop()
+            self.compression.restart()
+            self.sent_frames.restart(next_seq)
+            self.stream_start = next_seq
+            self.peer_epoch = peer_epoch
+            self.outgoing_frames.restart(peer_epoch, up_next)
+            return next_seq, [], FLAG_RESET
+
+        start, frames, flags = self.incoming_content.restart(restart)
+        for identifier in gone:
+            self.close_channel(identifier)
+        self.metrics.count("resumes")
+        self.metrics.count("resent_frames", len(frames))
+        if gone:
+            self.metrics.count("lost_channels", len(gone))
+            logger.warning("Workside session lost, %s channels closed", len(gone))
+        # FLAG_RESET tells a new session, whose frames start a new compression stream
+        session = RESUME.pack(peer_epoch, self.outgoing_frames.next_seq, start)
+        control = self.cipherer.seal(self.epoch, 0, flags, pack_records([(0, TUNNEL_RESUME, session)]))
+        return b"".join(STREAM_HEADER.pack(len(frame)) + frame for frame in [control] + frames)
@@ -0,0 +1,149 @@
+"""Counters, gauges and histograms describing one side of the tunnel, and
+sampled logging for the messages of the hot path
+"""
+
+import bisect
+import collections
+import logging
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+# Upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Prefix of the names of the metrics, as exposed
+PREFIX = "ssh_tunnel_"
+# Shortest time between two messages logged with the same key, in seconds
+LOG_PERIOD = 10
+
+logger = logging.getLogger(__name__)
+
+_last_logged = {}
+_suppressed = collections.Counter()
+_log_lock = threading.Lock()
+
+
+def log_sampled(logger, level, key, message, *args):
+    """Log a message of the hot path at most once every LOG_PERIOD seconds
+    for each key, telling how many similar ones were left out meanwhile
+    """
+    if not logger.isEnabledFor(level):
+        return
+    now = time.monotonic()
+    with _log_lock:
+        if key in _last_logged and now - _last_logged[key] < LOG_PERIOD:
+            _suppressed[key] += 1
+            return
+        _last_logged[key] = now
+        suppressed = _suppressed.pop(key, 0)
+    if suppressed:
+        message += " ({} similar messages not logged)".format(suppressed)
+    logger.log(level, message, *args)
+
+
+def is_local(address):
+    """Whether an http client connected from the loopback interface"""
+    return address in ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics():
+    """Metrics of one side of the tunnel. Counters and histograms are fed
+    as events happen, gauges are functions called when the metrics are read.
+    A gauge may return a dict, each item being exposed as a metric
+    """
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def read_gauges(self):
+        values = {}
+        for name, function in list(self.gauges.items()):
+            value = function()
+            items = value.items() if isinstance(value, dict) else [(None, value)]
+            for key, item in items:
+                if isinstance(item, (int, float)):
+                    values[name if key is None else "{}_{}".format(name, key)] = float(item)
+        return values
+
+    def snapshot(self):
+        """Returns the metrics as a dict"""
+        with self.lock:
+            histograms = {name: {'count': h.count, 'sum': h.sum,
+                                 'buckets': dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts))}
+                          for name, h in self.histograms.items()}
+            counters = dict(self.counters)
+        return {'counters': counters, 'gauges': self.read_gauges(), 'histograms': histograms}
+
+    def render(self):
+        """Returns the metrics in the text format of Prometheus"""
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append("# TYPE {0}{1} counter\n{0}{1} {2}".format(PREFIX, name, value))
+            for name, h in sorted(self.histograms.items()):
+                lines.append("# TYPE {}{} histogram".format(PREFIX, name))
+                cumulated = 0
+                for bound, count in zip([str(b) for b in h.buckets] + ["+Inf"], h.counts):
+                    cumulated += count
+                    lines.append('{}{}_bucket{{le="{}"}} {}'.format(PREFIX, name, bound, cumulated))
+                lines.append("{0}{1}_sum {2}\n{0}{1}_count {3}".format(PREFIX, name, h.sum, h.count))
+        for name, value in sorted(self.read_gauges().items()):
+            lines.append("# TYPE {0}{1} gauge\n{0}{1} {2}".format(PREFIX, name, value))
+        return ("\n".join(lines) + "\n").encode()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Mute the default message logger
+        return
+
+
+class MetricsThread(Thread):
+    """Serve the metrics on a local port"""
+    def __init__(self, metrics, port, bind="127.0.0.1", *args, **kwargs):
+        self.metrics = metrics
+        self.port = port
+        self.bind = bind
+        super(*args, **kwargs)
+        Thread.__init__(self, daemon=True)
+
+    def run(self):
+        server = HTTPServer((self.bind, self.port), MetricsHandler)
+        server.metrics = self.metrics
+        logger.info("Metrics served on http://%s:%s/metrics", self.bind, self.port)
+        server.serve_forever()
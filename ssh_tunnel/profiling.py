@@ -0,0 +1,95 @@
+"""Sampling profiler switched on and off at runtime, for the long-running
+processes of the tunnel.
+
+Once a ``SamplingProfiler`` is started, sending ``PROFILE_SIGNAL`` to the
+process starts sampling the stacks of every thread, and sending it again
+writes them to a file, in the collapsed format of flamegraph.pl and
+speedscope : one line per distinct stack, its frames separated by
+semicolons from the thread down to the function running, then the number
+of samples. While it is off, the profiler only waits for the signal.
+"""
+
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from threading import Thread
+
+# Default time between two samples of the stacks, in seconds
+PROFILE_INTERVAL = 0.005
+# Signal switching the profiler on and off
+PROFILE_SIGNAL = signal.SIGUSR2
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler(Thread):
+    """Wait for ``signum``, then sample the stacks of every thread every
+    ``interval`` seconds until it comes again, and write them to
+    ``<prefix>.<time>.folded``.
+
+    It must be started from the main thread, before any other thread : the
+    signal is blocked in every thread but this one, so that it is handled
+    whatever the main thread is busy with.
+    """
+    def __init__(self, prefix, interval=PROFILE_INTERVAL, signum=PROFILE_SIGNAL, *args, **kwargs):
+        self.prefix = prefix
+        self.interval = interval
+        self.signum = signum
+        self.active = threading.Event()
+        # Thread sampling the stacks while active, None while off
+        self.sampler = None
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signum])
+        super(*args, **kwargs)
+        Thread.__init__(self, daemon=True)
+
+    def run(self):
+        logger.info("Send %s to process %s to start or stop profiling", signal.Signals(self.signum).name, os.getpid())
+        while True:
+            signal.sigwait([self.signum])
+            self.toggle()
+
+    def toggle(self):
+        """Start sampling, or stop it and write the stacks sampled"""
+        if self.active.is_set():
+            self.active.clear()
+            self.sampler.join()
+            self.sampler = None
+        else:
+            self.active.set()
+            self.sampler = Thread(target=self.sample, name="SamplingProfiler", daemon=True)
+            self.sampler.start()
+
+    def sample(self):
+        logger.info("Profiling every thread")
+        stacks = collections.Counter()
+        samples = 0
+        start = time.time()
+        own = {self.ident, threading.get_ident()}
+        while self.active.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident not in own:
+                    stacks[collapse(names.get(ident, str(ident)), frame)] += 1
+            samples += 1
+            time.sleep(self.interval)
+        path = "{}.{}.folded".format(self.prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(start)))
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        logger.info("Profile of %s samples over %.1f s written to %s", samples, time.time() - start, path)
+
+
+def collapse(thread_name, frame):
+    """Returns the stack of a frame as the line of a collapsed stack file"""
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+        frame = frame.f_back
+    functions.append(thread_name.replace(";", ","))
+    return ";".join(reversed(functions))
@@ -4,7 +4,7 @@ import shutil
 import io
 import logging
 import socket
-from time import clock
+from time import perf_counter
 import pkg_resources
 import sys
 
@@ -19,6 +19,7 @@ from ssh_tunnel.proxy.filters.UserAgentFilter import UserAgentFilter  # nopep8
 from ssh_tunnel.proxy.filters.EntropyFilter import EntropyFilter  # nopep8
 from ssh_tunnel.proxy.filters.CheckRecurenceRequestFilter import CheckRecurenceRequestFilter  # nopep8
 from ssh_tunnel.proxy.ssl_thread import SSLThread
+from ssh_tunnel.profiling import SamplingProfiler, PROFILE_SIGNAL
 
 
 class ProxyHandler(BaseHTTPRequestHandler):
@@ -26,7 +27,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
     filters = []
 
     def __init__(self, *args, **kwargs):
-        self.start = clock()
+        self.start = perf_counter()
         BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
 
     @property
@@ -191,7 +192,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
         """
 
         logging.info('"%s" %s %s %s',
-                         self.requestline, str(code), str(size), str(clock()-self.start))
+                         self.requestline, str(code), str(size), str(perf_counter()-self.start))
 
 
 class ThreadedProxyServer(ThreadingMixIn, HTTPServer):
@@ -201,7 +202,7 @@ class ThreadedProxyServer(ThreadingMixIn, HTTPServer):
 def checkModuleVersion(name):
     version = pkg_resources.get_distribution(name).version
     logging.debug("Requests version = {}".format(version))
-    if version < "2.6.2":
+    if pkg_resources.parse_version(version) < pkg_resources.parse_version("2.6.2"):
         logging.info(
             "Your version of requests is out of date (< 2.6.2).\n" +
             "You need to update requests (sudo pip3 install --upgrade " +
@@ -217,6 +218,10 @@ if __name__ == '__main__':
                         help='Specify alternate port [default: 8008]')
     parser.add_argument('--verbose', '-v', action="store_true",
                         help='Toogle verbose mode')
+    parser.add_argument('--profile', action='store',
+                        default=None, metavar='PREFIX',
+                        help='Sample the stacks of every thread between two {} signals, and write them to '
+                             'PREFIX.<time>.folded [default: off]'.format(PROFILE_SIGNAL.name))
     parser.add_argument('filters', nargs="*", default="all", type=str,
                         help='A list of filters. Available are {}. [default: all]'.format(list_filters() +
                                                                                           ['all',
@@ -247,6 +252,8 @@ if __name__ == '__main__':
         # add the handler to the root logger
         logging.getLogger('').addHandler(console)
     checkModuleVersion("requests")
+    if args.profile:
+        SamplingProfiler(args.profile).start()
     logging.info("Server starting")
     logging.debug("Verbose on")
     filters = load_filters_from_list(args.filters)
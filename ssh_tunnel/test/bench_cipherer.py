@@ -0,0 +1,73 @@
+"""Microbenchmark of the Cipherer : frames encrypted then decrypted per second,
+compared to the previous scheme drawing a random iv for every frame
+"""
+
+import argparse
+import hashlib
+import os
+import time
+from Crypto.Cipher import AES
+from Crypto import Random
+from ssh_tunnel.commons import Cipherer, SALT, ITERATIONS
+
+SIZES = [64, 1024, 16384, 65536]
+
+
+class RandomIVCipherer():
+    """The Cipherer as it was, one random iv per frame"""
+    def __init__(self, passphrase):
+        self.key = hashlib.pbkdf2_hmac('sha256', passphrase.encode(), SALT, ITERATIONS)
+
+    def encrypt(self, data):
+        iv = Random.new().read(AES.block_size)
+        cipher = AES.new(self.key, AES.MODE_EAX, iv)
+        crypted = cipher.encrypt(data)
+        tag = cipher.digest()
+        return iv + crypted + tag
+
+    def decrypt(self, data):
+        iv = data[:16]
+        msg = data[16:-16]
+        tag = data[-16:]
+        cipher = AES.new(self.key, AES.MODE_EAX, iv)
+        cleartext = cipher.decrypt(msg)
+        cipher.verify(tag)
+        return cleartext
+
+
+def frames_per_second(sender, receiver, data, duration):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for _ in range(100):
+            receiver.decrypt(sender.encrypt(data))
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+def frames_per_second_into(sender, receiver, data, duration):
+    buffer = bytearray(sender.sealed_size(len(data)))
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for _ in range(100):
+            size = sender.encrypt_into(data, buffer)
+            receiver.decrypt(memoryview(buffer)[:size])
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', action='store',
+                        default=1, type=float,
+                        help='Specify how long each measure lasts [default: 1 s]')
+    args = parser.parse_args()
+    print("{:>8} {:>14} {:>14} {:>14} {:>8}".format("size", "random iv", "counter", "counter into", "speedup"))
+    for size in SIZES:
+        data = os.urandom(size)
+        before = frames_per_second(RandomIVCipherer("plop"), RandomIVCipherer("plop"), data, args.duration)
+        after = frames_per_second(Cipherer("plop"), Cipherer("plop"), data, args.duration)
+        into = frames_per_second_into(Cipherer("plop"), Cipherer("plop"), data, args.duration)
+        speedup = max(after, into) / before
+        print("{:>8} {:>14.0f} {:>14.0f} {:>14.0f} {:>7.2f}x".format(size, before, after, into, speedup))
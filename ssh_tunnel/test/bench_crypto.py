@@ -0,0 +1,67 @@
+"""Microbenchmark of the CryptoPool : MB of frames sealed then opened per
+second, inline and with pools of more and more threads, checking that the
+frames come out of the ReorderBuffer in order
+"""
+
+import argparse
+import os
+import time
+from ssh_tunnel.commons import Cipherer, CryptoPool, ReorderBuffer, CRYPTO_WORKERS
+
+SIZES = [1024, 16384, 65536, 262144, 1048576]
+
+
+def roundtrip(sender, receiver, seq, payload):
+    """Seal a frame and open it, as the two sides of the tunnel do"""
+    epoch, seq, flags, payload = receiver.open(sender.seal(1, seq, 0, payload))
+    return epoch, seq, (flags, payload)
+
+
+def mb_per_second(sender, receiver, payload, duration, pool=None):
+    delivered = []
+    reorder = ReorderBuffer(lambda content: delivered.append(content))
+    reorder.restart(1, 1)
+    seq = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        batch = range(seq + 1, seq + 65)
+        if pool is None:
+            frames = [roundtrip(sender, receiver, s, payload) for s in batch]
+        else:
+            futures = [pool.submit(roundtrip, sender, receiver, s, payload) for s in batch]
+            # Take them in the order they complete, as concurrent requests would
+            frames = [future.result() for future in reversed(futures)]
+        for epoch, s, content in frames:
+            reorder.push(epoch, s, content)
+        seq += len(batch)
+    elapsed = time.perf_counter() - start
+    assert len(delivered) == seq and reorder.next_seq == seq + 1, "frames lost or out of order"
+    return seq * len(payload) / elapsed / 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', action='store',
+                        default=1, type=float,
+                        help='Specify how long each measure lasts [default: 1 s]')
+    parser.add_argument('--max-workers', action='store',
+                        default=CRYPTO_WORKERS, type=int,
+                        help='Specify the largest pool measured [default: {}, the number of cores]'.format(
+                            CRYPTO_WORKERS))
+    args = parser.parse_args()
+    workers = [1]
+    while workers[-1] * 2 <= args.max_workers:
+        workers.append(workers[-1] * 2)
+    if workers[-1] != args.max_workers:
+        workers.append(args.max_workers)
+    pools = [CryptoPool(n) for n in workers]
+    print("{:>8} {:>10}".format("size", "inline") + "".join(" {:>10}".format("{} thr".format(n)) for n in workers)
+          + " {:>8}".format("speedup"))
+    for size in SIZES:
+        payload = os.urandom(size)
+        sender, receiver = Cipherer("plop"), Cipherer("plop")
+        inline = mb_per_second(sender, receiver, payload, args.duration)
+        pooled = [mb_per_second(sender, receiver, payload, args.duration, pool) for pool in pools]
+        print("{:>8} {:>10.1f}".format(size, inline) + "".join(" {:>10.1f}".format(mb) for mb in pooled)
+              + " {:>7.2f}x".format(max(pooled) / inline))
+    print("MB of frames sealed then opened per second, {} cores".format(CRYPTO_WORKERS))
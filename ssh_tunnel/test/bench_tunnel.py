@@ -0,0 +1,298 @@
+"""Loopback benchmark of the tunnel : the homeside, the workside and
+optionally the proxy run on localhost, a local server standing in for sshd.
+Measures bulk throughput both ways, the round trip time of small messages,
+alone and during a download, the http requests and the cpu time spent per
+MB, and writes them as json. It fails if small messages alone made a
+queue linger, which only bulk data should wait for
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+from ssh_tunnel.commons import LINGER
+from ssh_tunnel.homeside import homeside
+from ssh_tunnel.workside import workside
+from ssh_tunnel.tracing import TRACE_SAMPLE
+
+PASSPHRASE = "benchmark"
+# Size of the chunks written by the server and the clients, in bytes
+CHUNK_SIZE = 65536
+
+
+class BenchServer(Thread):
+    """Stand in for sshd. Each connection starts with a command line :
+    ``echo`` sends back everything, ``sink <n>`` reads n bytes then answers
+    ``done``, ``source <n>`` sends n bytes
+    """
+    def __init__(self, bind="127.0.0.1", *args, **kwargs):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((bind, 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        super(*args, **kwargs)
+        Thread.__init__(self, daemon=True)
+
+    def run(self):
+        while True:
+            connection, _ = self.socket.accept()
+            Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        with connection, connection.makefile("rb") as reader:
+            command = reader.readline().split()
+            if command == [b"echo"]:
+                while True:
+                    data = reader.read1(CHUNK_SIZE)
+                    if not data:
+                        return
+                    connection.sendall(data)
+            elif command[0] == b"sink":
+                left = int(command[1])
+                while left > 0:
+                    data = reader.read1(min(left, CHUNK_SIZE))
+                    if not data:
+                        return
+                    left -= len(data)
+                connection.sendall(b"done\n")
+            elif command[0] == b"source":
+                send_bytes(connection, int(command[1]))
+
+
+def send_bytes(connection, size):
+    chunk = os.urandom(CHUNK_SIZE)
+    while size > 0:
+        connection.sendall(chunk[:size])
+        size -= CHUNK_SIZE
+
+
+def recv_bytes(connection, size):
+    while size > 0:
+        data = connection.recv(min(size, CHUNK_SIZE))
+        if not data:
+            raise ConnectionError("Connection closed with {} bytes left".format(size))
+        size -= len(data)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def open_channel(ssh_port, command):
+    """Connect to the homeside as an ssh client would, and send a command to the server"""
+    connection = socket.create_connection(("127.0.0.1", ssh_port))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connection.settimeout(60)
+    connection.sendall(command.encode() + b"\n")
+    return connection
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Meter():
+    """Wall time, cpu time and http requests spent between start and stop"""
+    def __enter__(self):
+        self.requests = requests_served()
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.cpu = time.process_time() - self.cpu
+        self.requests = requests_served() - self.requests
+
+    def report(self, size):
+        mb = size / 1e6
+        return {'mb': mb, 'seconds': self.seconds, 'mb_per_s': mb / self.seconds,
+                'requests_per_mb': self.requests / mb, 'cpu_s_per_mb': self.cpu / mb}
+
+
+def requests_served():
+    counters = homeside.tunnel.metrics.counters
+    return sum(counters["requests_" + kind] for kind in ("up", "down", "exchange", "stream"))
+
+
+def lingers():
+    """Batches held back by the queues of both sides to wait for more data"""
+    return homeside.tunnel.incoming_content.lingers + workside.tunnel.outgoing_content.lingers
+
+
+def measure_upload(ssh_port, size):
+    connection = open_channel(ssh_port, "sink {}".format(size))
+    with connection, Meter() as meter:
+        send_bytes(connection, size)
+        connection.recv(16)
+    return meter.report(size)
+
+
+def measure_download(ssh_port, size):
+    connection = open_channel(ssh_port, "source {}".format(size))
+    with connection, Meter() as meter:
+        recv_bytes(connection, size)
+    return meter.report(size)
+
+
+def measure_latency(ssh_port, messages, size):
+    connection = open_channel(ssh_port, "echo")
+    message = os.urandom(size)
+    rtts = []
+    with connection:
+        # The first message also waits for sshd to be connected
+        connection.sendall(message)
+        recv_bytes(connection, size)
+        requests = requests_served()
+        held = lingers()
+        for _ in range(messages):
+            start = time.perf_counter()
+            connection.sendall(message)
+            recv_bytes(connection, size)
+            rtts.append((time.perf_counter() - start) * 1000)
+        requests = requests_served() - requests
+        held = lingers() - held
+    return {'messages': messages, 'size': size, 'p50_ms': percentile(rtts, 50),
+            'p90_ms': percentile(rtts, 90), 'p99_ms': percentile(rtts, 99), 'max_ms': max(rtts),
+            'requests_per_message': requests / messages, 'lingers': held}
+
+
+def measure_loaded_latency(ssh_port, messages, size, bulk):
+    """Round trip time of small messages while a download of bulk bytes runs"""
+    transfer = Thread(target=measure_download, args=(ssh_port, bulk), daemon=True)
+    transfer.start()
+    # Let the transfer fill the queues first
+    time.sleep(0.5)
+    latency = measure_latency(ssh_port, messages, size)
+    latency['transfer_running'] = transfer.is_alive()
+    transfer.join()
+    return latency
+
+
+def start_proxy():
+    """Run proxy.py without filters, and make the workside go through it"""
+    port = free_port()
+    proxy = subprocess.Popen([sys.executable, "-m", "ssh_tunnel.proxy.proxy", "--port", str(port), "none"],
+                             cwd=tempfile.mkdtemp(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    wait_port(port)
+    os.environ["http_proxy"] = "http://127.0.0.1:{}".format(port)
+    os.environ.pop("no_proxy", None)
+    return proxy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--home-engine', action='store',
+                        default="threads", choices=["threads", "asyncio"],
+                        help='Specify the engine of the homeside [default: threads]')
+    parser.add_argument('--work-engine', action='store',
+                        default="threads", choices=["threads", "asyncio"],
+                        help='Specify the engine of the workside [default: threads]')
+    parser.add_argument('--compress', action='store_true',
+                        help='Compress the frames on both sides [default: off]')
+    parser.add_argument('--stream', action='store_true',
+                        help='Make the workside read long-lived /stream answers instead of polling /down '
+                             '[default: off]')
+    parser.add_argument('--linger', action='store',
+                        default=LINGER, type=float,
+                        help='Specify how long both sides wait for bulk data to fill a frame '
+                             '[default: {} s]'.format(LINGER))
+    parser.add_argument('--crypto-workers', action='store',
+                        default=0, type=int,
+                        help='Specify how many threads seal and open frames on both sides [default: 0, no pool]')
+    parser.add_argument('--trace', action='store',
+                        default=None, metavar='PREFIX',
+                        help='Trace the frames of both sides to PREFIX.home and PREFIX.work [default: off]')
+    parser.add_argument('--trace-sample', action='store',
+                        default=TRACE_SAMPLE, type=float,
+                        help='Specify the share of the frames traced [default: {}]'.format(TRACE_SAMPLE))
+    parser.add_argument('--proxy', action='store_true',
+                        help='Send the requests of the workside through proxy.py [default: off]')
+    parser.add_argument('--bulk', action='store',
+                        default=16, type=float,
+                        help='Specify how much data each bulk transfer carries [default: 16 MB]')
+    parser.add_argument('--messages', action='store',
+                        default=200, type=int,
+                        help='Specify how many small messages are echoed [default: 200]')
+    parser.add_argument('--message-size', action='store',
+                        default=64, type=int,
+                        help='Specify the size of the small messages [default: 64 bytes]')
+    parser.add_argument('--output', '-o', action='store',
+                        default="bench_tunnel.json",
+                        help='Specify the file the results are written to [default: bench_tunnel.json]')
+    args = parser.parse_args()
+
+    server = BenchServer()
+    server.start()
+    proxy = start_proxy() if args.proxy else None
+    http_port, ssh_port = free_port(), free_port()
+    traces = {side: args.trace and "{}.{}".format(args.trace, side) for side in ("home", "work")}
+    homeside.start(PASSPHRASE, http_port=http_port, ssh_port=ssh_port, bind="127.0.0.1",
+                   engine=args.home_engine, compress=args.compress, crypto_workers=args.crypto_workers,
+                   frame_linger=args.linger,
+                   trace=traces["home"], trace_sample=args.trace_sample)
+    wait_port(http_port)
+    workside.start(PASSPHRASE, baseurl="http://127.0.0.1:{}".format(http_port), ssh_port=server.port,
+                   bind="127.0.0.1", engine=args.work_engine, compress=args.compress, stream=args.stream,
+                   linger=args.linger,
+                   crypto_workers=args.crypto_workers, trace=traces["work"], trace_sample=args.trace_sample)
+
+    bulk = int(args.bulk * 1e6)
+    results = {
+        'config': {'home_engine': args.home_engine, 'work_engine': args.work_engine,
+                   'compress': args.compress, 'stream': args.stream,
+                   'crypto_workers': args.crypto_workers, 'proxy': args.proxy, 'bulk_bytes': bulk,
+                   'linger': args.linger},
+        'python': platform.python_version(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'latency': measure_latency(ssh_port, args.messages, args.message_size),
+        'upload': measure_upload(ssh_port, bulk),
+        'download': measure_download(ssh_port, bulk),
+        'loaded_latency': measure_loaded_latency(ssh_port, args.messages, args.message_size, 4 * bulk),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print("latency   p50 {p50_ms:.1f} ms  p90 {p90_ms:.1f} ms  p99 {p99_ms:.1f} ms  "
+          "{requests_per_message:.1f} requests/message".format(**results['latency']))
+    print("loaded    p50 {p50_ms:.1f} ms  p90 {p90_ms:.1f} ms  p99 {p99_ms:.1f} ms  "
+          "during a download{}".format("" if results['loaded_latency']['transfer_running'] else " (ended first)",
+                                       **results['loaded_latency']))
+    for direction in ("upload", "download"):
+        print("{:<9} {mb_per_s:.2f} MB/s  {requests_per_mb:.1f} requests/MB  {cpu_s_per_mb:.3f} cpu s/MB".format(
+            direction, **results[direction]))
+    print("Results written to {}".format(args.output))
+    if args.trace:
+        print("Traces written to {0}.home and {0}.work, read them with "
+              "python3 -m ssh_tunnel.tracing {0}.home {0}.work".format(args.trace))
+    if proxy:
+        proxy.terminate()
+    # Only small messages are sent before the transfers : no queue may linger
+    # for them, whatever their round trip time
+    lingered = results['latency']['lingers']
+    if lingered:
+        print("Small messages made the queues linger {} times".format(lingered))
+    # The tunnel threads never stop by themselves
+    os._exit(1 if lingered else 0)
@@ -0,0 +1,35 @@
+"""Shared fixtures of the unit tests. Run them with python3 -m pytest ssh_tunnel/test"""
+
+import pytest
+from ssh_tunnel import commons, tracing
+from ssh_tunnel.homeside import cache
+from ssh_tunnel.workside import controller, paths
+
+# test_global runs both sides until interrupted, it is not a unit test
+collect_ignore = ["test_global.py"]
+
+# Modules whose time is given by the clock fixture
+CLOCKED = (commons, tracing, cache, controller, paths)
+
+
+class FakeClock():
+    """Stands in for the time module, only moving when told to"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    for module in CLOCKED:
+        monkeypatch.setattr(module, "time", clock)
+    return clock
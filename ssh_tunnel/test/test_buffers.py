@@ -0,0 +1,352 @@
+"""Deterministic tests of the queues and buffers of commons, on a fake
+clock. Run with python3 -m pytest
+"""
+
+import asyncio
+import threading
+from ssh_tunnel.commons import AsyncCredit, AsyncRecordQueue, Credit
+from ssh_tunnel.commons import RecordQueue, ReorderBuffer, CHANNEL_DATA, CHANNEL_CLOSE, CHANNEL_CREDIT
+from ssh_tunnel.commons import RECORD_HEADER, BULK_BYTES, BULK_SHARE, CREDIT, RATE_HALF_LIFE, EARLY_FRAMES
+from ssh_tunnel.commons import FrameSplitter, RetransmitBuffer, STREAM_HEADER, RETRANSMIT_SIZE
+
+
+def drain(queue, max_size):
+    """Take every batch of the queue, returns them as lists of records"""
+    batches = []
+    while queue.count:
+        seq, records = queue.get_batch(max_size, timeout=0)
+        assert seq == len(batches) + 1
+        batches.append([(channel, kind, bytes(data)) for channel, kind, data in records])
+    return batches
+
+
+def test_record_queue_empty(clock):
+    assert RecordQueue().get_batch(1024, timeout=0) == (0, [])
+
+
+def test_record_queue_merges_data_of_a_channel(clock):
+    queue = RecordQueue()
+    for data in (b"a" * 100, b"b" * 100, b"c" * 100):
+        queue.put((1, CHANNEL_DATA, data))
+    queue.put((1, CHANNEL_CLOSE, b""))
+    assert drain(queue, 1024) == [[(1, CHANNEL_DATA, b"a" * 100 + b"b" * 100 + b"c" * 100),
+                                   (1, CHANNEL_CLOSE, b"")]]
+    assert queue.size == 0
+
+
+def test_record_queue_batches_fit_max_size(clock):
+    queue = RecordQueue()
+    data = bytes(range(256)) * 40
+    queue.put((1, CHANNEL_DATA, data))
+    max_size = 1000
+    batches = drain(queue, max_size)
+    assert len(batches) == -(-len(data) // (max_size - RECORD_HEADER.size))
+    for batch in batches:
+        assert sum(RECORD_HEADER.size + len(data) for _, _, data in batch) <= max_size
+    assert b"".join(data for batch in batches for _, _, data in batch) == data
+
+
+def test_record_queue_keeps_channel_order_when_splitting(clock):
+    queue = RecordQueue()
+    sent = {1: b"", 2: b"", 3: b""}
+    for index in range(20):
+        for channel in sent:
+            data = bytes([channel, index]) * (50 + 37 * index)
+            sent[channel] += data
+            queue.put((channel, CHANNEL_DATA, data))
+    received = {channel: b"" for channel in sent}
+    for batch in drain(queue, 700):
+        for channel, kind, data in batch:
+            received[channel] += data
+    assert received == sent
+
+
+def test_record_queue_credit_first(clock):
+    queue = RecordQueue()
+    queue.put((1, CHANNEL_DATA, b"data"))
+    queue.put((2, CHANNEL_CREDIT, CREDIT.pack(4096)))
+    assert [record[:2] for record in drain(queue, 1024)[0]] == [(2, CHANNEL_CREDIT), (1, CHANNEL_DATA)]
+
+
+def test_record_queue_interactive_first(clock):
+    queue = RecordQueue()
+    queue.put((1, CHANNEL_DATA, b"x" * BULK_BYTES))
+    queue.put((2, CHANNEL_DATA, b"keystroke"))
+    assert queue.is_bulk(1) and not queue.is_bulk(2)
+    batch = drain(queue, 1024)[0]
+    assert batch[0] == (2, CHANNEL_DATA, b"keystroke")
+
+
+def test_record_queue_bulk_share(clock):
+    queue = RecordQueue()
+    queue.put((1, CHANNEL_DATA, b"x" * BULK_BYTES))
+    queue.put((2, CHANNEL_DATA, b"y" * (BULK_BYTES // 2)))
+    max_size = 8192
+    seq, batch = queue.get_batch(max_size, timeout=0)
+    taken = {channel: len(data) for channel, _, data in batch}
+    # The interactive channel fills the batch, but for the share of the bulk one
+    assert taken[1] == max_size // BULK_SHARE - RECORD_HEADER.size
+    assert taken[2] == max_size - max_size // BULK_SHARE - RECORD_HEADER.size
+
+
+def test_record_queue_bulk_decays(clock):
+    queue = RecordQueue()
+    queue.put((1, CHANNEL_DATA, b"x" * BULK_BYTES))
+    assert queue.is_bulk(1)
+    clock.now += RATE_HALF_LIFE
+    assert not queue.is_bulk(1)
+
+
+def test_record_queue_no_linger_for_interactive(clock):
+    queue = RecordQueue()
+    queue.put((1, CHANNEL_DATA, b"keystroke"))
+    # Lingering would wait for 10 seconds on the real clock
+    assert queue.get_batch(65536, timeout=0, linger=10) == (1, [(1, CHANNEL_DATA, b"keystroke")])
+
+
+def test_reorder_buffer_out_of_order(clock):
+    delivered = []
+    buffer = ReorderBuffer(delivered.append)
+    buffer.restart(7, 1)
+    buffer.push(7, 3, "c")
+    buffer.push(7, 2, "b")
+    assert delivered == []
+    assert buffer.stalled_since == clock.now
+    clock.now += 1
+    buffer.push(7, 1, "a")
+    assert delivered == ["a", "b", "c"]
+    assert buffer.stalled_since is None
+
+
+def test_reorder_buffer_stalled_since(clock):
+    buffer = ReorderBuffer(lambda content: None)
+    buffer.restart(7, 1)
+    start = clock.now
+    buffer.push(7, 3, "c")
+    clock.now += 1
+    buffer.push(7, 4, "d")
+    # Still waiting for the same frame
+    assert buffer.stalled_since == start
+    buffer.push(7, 1, "a")
+    # Waiting for another frame now
+    assert buffer.stalled_since == clock.now
+
+
+def test_reorder_buffer_duplicates(clock):
+    delivered = []
+    buffer = ReorderBuffer(delivered.append)
+    buffer.restart(7, 1)
+    buffer.push(7, 2, "b")
+    buffer.push(7, 2, "b")
+    buffer.push(7, 1, "a")
+    buffer.push(7, 1, "a")
+    buffer.push(7, 2, "b")
+    assert delivered == ["a", "b"]
+
+
+def test_record_queue_restart(clock):
+    queue = RecordQueue()
+    queue.put((1, CHANNEL_DATA, b"data"))
+    assert queue.get_batch(1024, timeout=0)[0] == 1
+    queue.put((1, CHANNEL_DATA, b"lost"))
+
+    def restart(next_seq):
+        queue.drop()
+        return next_seq
+    assert queue.restart(restart) == 2
+    assert queue.count == queue.size == 0
+    assert queue.get_batch(1024, timeout=0) == (0, [])
+
+
+def waiting(target, *args):
+    """Returns a thread running target, once it has had time to block"""
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    thread.join(0.05)
+    return thread
+
+
+def test_credit_waits_for_grant():
+    credit = Credit(100)
+    assert credit.wait() == 100
+    credit.consume(100)
+    got = []
+    thread = waiting(lambda: got.append(credit.wait()))
+    assert thread.is_alive() and got == []
+    credit.grant(30)
+    thread.join(1)
+    assert got == [30]
+
+
+def test_credit_close_wakes_up():
+    credit = Credit(0)
+    got = []
+    thread = waiting(lambda: got.append(credit.wait()))
+    credit.close()
+    thread.join(1)
+    assert got == [0]
+
+
+def test_async_credit_waits_for_grant():
+    async def run():
+        credit = AsyncCredit(0)
+        waiter = asyncio.ensure_future(credit.wait())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        credit.grant(30)
+        assert await asyncio.wait_for(waiter, 1) == 30
+        credit.consume(30)
+        waiter = asyncio.ensure_future(credit.wait())
+        await asyncio.sleep(0.01)
+        credit.close()
+        assert await asyncio.wait_for(waiter, 1) == 0
+    asyncio.run(run())
+
+
+def test_record_queue_wait_room(clock):
+    queue = RecordQueue(max_size=BULK_BYTES)
+    queue.put((1, CHANNEL_DATA, bytes(BULK_BYTES)))
+    # A full queue blocks the bulk channel, not an interactive one
+    thread = waiting(queue.wait_room, 1)
+    assert thread.is_alive()
+    queue.wait_room(2)
+    queue.put((2, CHANNEL_DATA, b"ls\n"))
+    assert queue.get_batch(RECORD_HEADER.size + 3, timeout=0)[1] == [(2, CHANNEL_DATA, b"ls\n")]
+    assert thread.is_alive()
+    queue.get_batch(BULK_BYTES * 2, timeout=0)
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_async_record_queue_wait_room(clock):
+    async def run():
+        queue = AsyncRecordQueue(max_size=BULK_BYTES)
+        queue.put((1, CHANNEL_DATA, bytes(BULK_BYTES)))
+        waiter = asyncio.ensure_future(queue.wait_room(1))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        await asyncio.wait_for(queue.wait_room(2), 1)
+        await queue.get_batch(BULK_BYTES * 2, timeout=0)
+        await asyncio.wait_for(waiter, 1)
+    asyncio.run(run())
+
+
+def test_reorder_buffer_early_frames(clock):
+    delivered = []
+    buffer = ReorderBuffer(delivered.append)
+    # Frames of an epoch are kept aside until it restarts
+    buffer.push(7, 4, "d")
+    buffer.push(7, 2, "b")
+    buffer.push(7, 3, "c")
+    assert delivered == []
+    # Frames before the seq it restarts from are dropped
+    buffer.restart(7, 3)
+    assert delivered == ["c", "d"]
+
+
+def test_reorder_buffer_early_frames_bounded(clock):
+    delivered = []
+    buffer = ReorderBuffer(delivered.append)
+    for seq in range(1, 2 * EARLY_FRAMES):
+        buffer.push(7, seq, seq)
+    assert len(buffer.early) == EARLY_FRAMES
+    # Only the frames of the last epoch seen are kept
+    buffer.push(8, 1, "a")
+    assert buffer.early == {1: "a"}
+    buffer.restart(7, 1)
+    assert delivered == []
+    assert buffer.early == {}
+
+
+def test_reorder_buffer_restart(clock):
+    delivered = []
+    buffer = ReorderBuffer(delivered.append)
+    buffer.restart(7, 1)
+    buffer.push(7, 1, "a")
+    buffer.push(7, 3, "c")
+    # The same epoch again does not deliver its frames twice
+    buffer.restart(7, 1)
+    buffer.push(7, 1, "a")
+    assert delivered == ["a"]
+    # A new epoch drops the frames pending from the previous one
+    buffer.push(8, 5, "e")
+    buffer.restart(8, 5)
+    buffer.push(7, 2, "b")
+    assert delivered == ["a", "e"]
+    assert buffer.pending == {}
+    assert buffer.stalled_since is None
+
+
+def test_retransmit_ack():
+    sent = RetransmitBuffer()
+    for seq in range(1, 6):
+        sent.put(seq, bytes(10))
+    sent.ack(3)
+    assert sent.stats() == {'frames': 3, 'bytes': 30}
+    assert sent.since(3, 6) == [bytes(10)] * 3
+    # Acknowledged frames are gone, and late ones are not kept again
+    assert sent.since(2, 6) is None
+    sent.put(2, bytes(10))
+    assert sent.stats()['frames'] == 3
+    sent.ack(6)
+    assert sent.stats() == {'frames': 0, 'bytes': 0}
+    # Nothing was missed
+    assert sent.since(6, 6) == []
+
+
+def test_retransmit_forgets_past_max_size():
+    sent = RetransmitBuffer()
+    frame = bytes(1024 * 1024)
+    for seq in range(1, RETRANSMIT_SIZE // len(frame) + 1):
+        sent.put(seq, frame)
+    assert len(sent.since(1, 9)) == 8
+    sent.put(9, frame)
+    assert sent.stats() == {'frames': 8, 'bytes': RETRANSMIT_SIZE}
+    assert sent.since(1, 10) is None
+    assert len(sent.since(2, 10)) == 8
+
+
+def test_retransmit_restart():
+    sent = RetransmitBuffer()
+    sent.put(1, b"a")
+    sent.restart(10)
+    assert sent.stats() == {'frames': 0, 'bytes': 0}
+    assert sent.since(1, 10) is None
+    sent.put(10, b"b")
+    assert sent.since(10, 11) == [b"b"]
+
+
+def stream_body(frames):
+    return b"".join(STREAM_HEADER.pack(len(frame)) + frame for frame in frames)
+
+
+def test_frame_splitter_any_cut():
+    frames = [b"first", b"", bytes(range(256)) * 3, b"last"]
+    body = stream_body(frames)
+    for cut in range(len(body) + 1):
+        splitter = FrameSplitter()
+        assert splitter.feed(body[:cut]) + splitter.feed(body[cut:]) == frames
+        assert splitter.pending == 0
+
+
+def test_frame_splitter_byte_by_byte():
+    frames = [b"a" * 300, b"b", b"c" * 70000]
+    body = stream_body(frames)
+    splitter = FrameSplitter()
+    received = []
+    for offset in range(len(body)):
+        received += splitter.feed(body[offset:offset + 1])
+        # Cut inside the length prefix or the frame, nothing more comes out
+        assert len(received) == sum(offset + 1 >= len(stream_body(frames[:n + 1])) for n in range(len(frames)))
+    assert received == frames
+
+
+def test_frame_splitter_truncated_tail():
+    body = stream_body([b"complete", b"truncated frame"])
+    splitter = FrameSplitter()
+    assert splitter.feed(body[:-3]) == [b"complete"]
+    assert splitter.pending == STREAM_HEADER.size + len(b"truncated frame") - 3
+    splitter = FrameSplitter()
+    # Only part of the length prefix
+    assert splitter.feed(body[:len(b"complete") + STREAM_HEADER.size + 2]) == [b"complete"]
+    assert splitter.pending == 2
@@ -0,0 +1,66 @@
+"""Deterministic tests of the RequestCache of the homeside, on a fake
+clock. Run with python3 -m pytest
+"""
+
+from ssh_tunnel.homeside.cache import RequestCache, ENTRY_OVERHEAD
+
+
+def test_hits_and_misses(clock):
+    requests = RequestCache()
+    assert requests.get("a") is None
+    requests.put("a", b"content")
+    assert requests.get("a") == b"content"
+    assert requests.get("a") == b"content"
+    assert requests.get("b") is None
+    assert requests.stats() == {'entries': 1, 'size': ENTRY_OVERHEAD + 7, 'hits': 2, 'misses': 2,
+                                'evictions': 0}
+
+
+def test_ttl(clock):
+    requests = RequestCache(ttl=10)
+    requests.put("a", b"a")
+    requests.put("b", b"b")
+    clock.now += 6
+    # Using an entry makes it live ttl seconds more
+    assert requests.get("a") == b"a"
+    clock.now += 6
+    assert requests.get("b") is None
+    assert requests.get("a") == b"a"
+    clock.now += 10
+    assert requests.get("a") is None
+    assert requests.stats()['entries'] == 0
+    assert requests.stats()['size'] == 0
+    # Expiry is not eviction
+    assert requests.stats()['evictions'] == 0
+
+
+def test_size_eviction(clock):
+    entry = ENTRY_OVERHEAD + 100
+    requests = RequestCache(max_size=3 * entry)
+    for identifier in "abc":
+        requests.put(identifier, bytes(100))
+    # "a" becomes the most recently used
+    assert requests.get("a") is not None
+    requests.put("d", bytes(100))
+    assert requests.get("b") is None
+    assert all(requests.get(identifier) is not None for identifier in "acd")
+    assert requests.stats()['size'] == 3 * entry
+    assert requests.stats()['evictions'] == 1
+
+
+def test_put_again_replaces(clock):
+    requests = RequestCache()
+    requests.put("a", bytes(100))
+    requests.put("a", bytes(10))
+    assert requests.get("a") == bytes(10)
+    assert requests.stats()['size'] == ENTRY_OVERHEAD + 10
+
+
+def test_larger_than_max_size(clock):
+    requests = RequestCache(max_size=ENTRY_OVERHEAD + 10)
+    requests.put("a", bytes(5))
+    requests.put("b", bytes(100))
+    assert requests.get("a") is None
+    assert requests.get("b") is None
+    assert requests.stats()['entries'] == 0
+    assert requests.stats()['evictions'] == 2
@@ -0,0 +1,86 @@
+"""Check the EAX implementation of commons against AES.MODE_EAX, and that
+Cipherer rejects tampered frames. Run with python3 -m pytest
+"""
+
+import os
+import pytest
+from Crypto.Cipher import AES
+from ssh_tunnel.commons import EAX, Cipherer, NONCE_SIZE, TAG_SIZE, SESSION_SIZE, PEER_KEYS
+
+# Around the block boundaries, up to a frame and a bit more
+SIZES = [0, 1, 15, 16, 17, 31, 32, 33, 100, 4096, 65541]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_eax_matches_mode_eax(size):
+    key = os.urandom(32)
+    nonce = os.urandom(NONCE_SIZE)
+    data = os.urandom(size)
+    eax = EAX(key)
+    nonce_mac, cipher = eax.counter(nonce)
+    crypted = cipher.encrypt(data)
+    expected, expected_tag = AES.new(key, AES.MODE_EAX, nonce=nonce).encrypt_and_digest(data)
+    assert crypted == expected
+    assert eax.tag(nonce_mac, crypted) == expected_tag
+    assert eax.verify(nonce_mac, crypted, expected_tag)
+    assert not eax.verify(nonce_mac, crypted, bytes(TAG_SIZE))
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_cipherer_round_trip(size):
+    home, work = Cipherer("plop"), Cipherer("plop")
+    data = os.urandom(size)
+    assert work.decrypt(home.encrypt(data)) == data
+    epoch, seq, flags, payload = work.open(home.seal(3, 7, 1, data))
+    assert (epoch, seq, flags, bytes(payload)) == (3, 7, 1, data)
+
+
+def test_cipherer_empty_message():
+    home, work = Cipherer("plop"), Cipherer("plop")
+    sealed = home.encrypt(b"")
+    assert len(sealed) == NONCE_SIZE + TAG_SIZE
+    assert work.decrypt(sealed) == b""
+    epoch, seq, flags, payload = work.open(home.seal(0, 1, 0, b""))
+    assert (epoch, seq, flags, bytes(payload)) == (0, 1, 0, b"")
+    # An empty body holds no frame
+    assert work.open(b"") is None
+
+
+@pytest.mark.parametrize("position", [0, NONCE_SIZE - 1, NONCE_SIZE, NONCE_SIZE + 20, -TAG_SIZE, -1])
+def test_cipherer_rejects_flipped_byte(position):
+    home, work = Cipherer("plop"), Cipherer("plop")
+    sealed = bytearray(home.seal(0, 1, 0, os.urandom(100)))
+    sealed[position] ^= 0x01
+    with pytest.raises(ValueError):
+        work.open(bytes(sealed))
+
+
+def test_cipherer_rejects_other_passphrase():
+    with pytest.raises(ValueError):
+        Cipherer("other").open(Cipherer("plop").seal(0, 1, 0, b"data"))
+
+
+def test_cipherer_keeps_authenticated_sessions():
+    work = Cipherer("plop")
+    homes = [Cipherer("plop") for _ in range(PEER_KEYS)]
+    for home in homes:
+        work.open(home.seal(0, 1, 0, b"data"))
+    assert list(work.peer_eax) == [home.session for home in homes]
+    # Frames of made-up sessions are rejected, and do not evict the keys of the real ones
+    for _ in range(PEER_KEYS * 2):
+        sealed = bytearray(homes[0].seal(0, 1, 0, b"data"))
+        sealed[:SESSION_SIZE] = os.urandom(SESSION_SIZE)
+        with pytest.raises(ValueError):
+            work.open(bytes(sealed))
+    assert list(work.peer_eax) == [home.session for home in homes]
+    # A tampered frame of a known session does not make it more recently used
+    sealed = bytearray(homes[0].seal(0, 2, 0, b"data"))
+    sealed[-1] ^= 0x01
+    with pytest.raises(ValueError):
+        work.open(bytes(sealed))
+    assert next(iter(work.peer_eax)) == homes[0].session
+    # An authenticated one does, the least recently used session being evicted by a new one
+    work.open(homes[0].seal(0, 3, 0, b"data"))
+    newcomer = Cipherer("plop")
+    assert work.open(newcomer.seal(0, 1, 0, b"data"))[3] == b"data"
+    assert list(work.peer_eax) == [home.session for home in homes[2:]] + [homes[0].session, newcomer.session]
@@ -0,0 +1,120 @@
+"""Tests of the compression of the frames. Run with python3 -m pytest"""
+
+import os
+import pytest
+from ssh_tunnel.commons import CHANNEL_DATA, FLAG_COMPRESSED, FLAG_ZLIB, FLAG_RESET
+from ssh_tunnel.compression import FrameCompressor, StreamCompression, MAX_BACKOFF, MIN_COMPRESS_SIZE
+
+EPOCH = 7
+
+
+def pair():
+    """Returns the compression of a sender, which knows its peer decompresses, and of the receiver"""
+    sender, receiver = StreamCompression(True), StreamCompression()
+    sender.received(FLAG_ZLIB)
+    return sender, receiver
+
+
+def records(index):
+    return [(1, CHANNEL_DATA, "frame {} ".format(index).encode() * 50), (2, CHANNEL_DATA, b"x" * index)]
+
+
+def unpacked(receiver, flags, payload):
+    return [(channel, kind, bytes(data)) for channel, kind, data in receiver.unpack(EPOCH, flags, payload)]
+
+
+def test_round_trip():
+    sender, receiver = pair()
+    for index in range(10):
+        flags, payload = sender.pack(records(index))
+        assert flags & FLAG_COMPRESSED
+        # Only the first frame starts a new stream
+        assert bool(flags & FLAG_RESET) == (index == 0)
+        assert unpacked(receiver, flags, payload) == records(index)
+    assert sender.stats()['compressed'] == 10
+    assert sender.stats()['ratio'] < 0.5
+
+
+def test_not_compressed_unless_peer_decompresses():
+    sender, receiver = StreamCompression(True), StreamCompression()
+    flags, payload = sender.pack(records(1))
+    assert flags == FLAG_ZLIB
+    assert unpacked(receiver, flags, payload) == records(1)
+
+
+def test_small_frames_sent_as_is():
+    sender, _ = pair()
+    assert sender.pack([(1, CHANNEL_DATA, b"a" * (MIN_COMPRESS_SIZE // 2))])[0] == FLAG_ZLIB
+
+
+def test_backoff_on_random_data():
+    compressor = FrameCompressor()
+    attempts = []
+    for _ in range(300):
+        before = compressor.bytes_in
+        assert compressor.compress(os.urandom(1024)) is None
+        attempts.append(compressor.bytes_in != before)
+    # Tried again after 1, 2, 4... frames skipped, then every MAX_BACKOFF frames
+    tried = [index for index, attempt in enumerate(attempts) if attempt]
+    gaps = [b - a - 1 for a, b in zip(tried, tried[1:])]
+    assert gaps[:7] == [1, 2, 4, 8, 16, 32, MAX_BACKOFF]
+    assert set(gaps[6:]) == {MAX_BACKOFF}
+    assert compressor.skipped == 300
+
+
+def test_backoff_reset_by_compressible_data():
+    compressor = FrameCompressor()
+    compressor.compress(os.urandom(1024))
+    compressor.compress(os.urandom(1024))
+    assert compressor.compress(os.urandom(1024)) is None
+    assert compressor.backoff == 2
+    # Skipped, however compressible
+    assert compressor.compress(b"a" * 1024) is None
+    assert compressor.compress(b"a" * 1024) is None
+    assert compressor.compress(b"a" * 1024) is not None
+    assert compressor.backoff == 0
+
+
+def test_random_frames_do_not_break_the_stream():
+    sender, receiver = pair()
+    for index in range(5):
+        frame = [(1, CHANNEL_DATA, os.urandom(1024))] if index % 2 else records(index)
+        flags, payload = sender.pack(frame)
+        assert unpacked(receiver, flags, payload) == frame
+
+
+def test_restart_flags_reset():
+    sender, receiver = pair()
+    for index in range(3):
+        flags, payload = sender.pack(records(index))
+        unpacked(receiver, flags, payload)
+    sender.restart()
+    flags, payload = sender.pack(records(3))
+    assert flags & FLAG_RESET
+    # A new receiver, as after a restart of the peer, gets it too
+    assert unpacked(StreamCompression(), flags, payload) == records(3)
+    assert unpacked(receiver, flags, payload) == records(3)
+    flags, payload = sender.pack(records(4))
+    assert not flags & FLAG_RESET
+    assert unpacked(receiver, flags, payload) == records(4)
+
+
+def test_corrupted_payload():
+    sender, receiver = pair()
+    flags, payload = sender.pack(records(1))
+    corrupted = bytearray(payload)
+    corrupted[len(corrupted) // 2] ^= 0xff
+    corrupted[2] ^= 0xff
+    with pytest.raises(ValueError):
+        receiver.unpack(EPOCH, flags, bytes(corrupted))
+
+
+def test_missing_frame_in_stream():
+    sender, receiver = pair()
+    flags, payload = sender.pack(records(1))
+    unpacked(receiver, flags, payload)
+    # The second frame never comes, the third one refers to it
+    sender.pack([(1, CHANNEL_DATA, bytes(range(256)) * 4)])
+    flags, payload = sender.pack([(1, CHANNEL_DATA, bytes(range(256)) * 4)])
+    with pytest.raises(ValueError):
+        receiver.unpack(EPOCH, flags, payload)
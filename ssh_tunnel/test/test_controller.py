@@ -0,0 +1,107 @@
+"""Deterministic tests of the adaptive control of the workside requests,
+on a fake clock. Run with python3 -m pytest
+"""
+
+import threading
+from ssh_tunnel.commons import NONCE_SIZE, TAG_SIZE
+from ssh_tunnel.workside.controller import Controller, BULK_SIZE, IDLE_POLLS, MIN_FRAME_SIZE, MIN_READ_SIZE
+from ssh_tunnel.workside.controller import MAX_READ_SIZE, MAX_RETRY_DELAY, GOODPUT_PERIOD
+
+EMPTY = NONCE_SIZE + TAG_SIZE
+
+
+def test_frame_size_grows_while_data_piles_up(clock):
+    controller = Controller(max_frame_size=MIN_FRAME_SIZE * 8)
+    sizes = []
+    for _ in range(5):
+        controller.batch_taken(controller.frame_size, controller.frame_size)
+        sizes.append(controller.frame_size)
+    assert sizes == [MIN_FRAME_SIZE * 2, MIN_FRAME_SIZE * 4, MIN_FRAME_SIZE * 8, MIN_FRAME_SIZE * 8,
+                     MIN_FRAME_SIZE * 8]
+    # A frame filling a quarter of it or more keeps the size
+    controller.batch_taken(controller.frame_size // 4, 0)
+    assert controller.frame_size == MIN_FRAME_SIZE * 8
+    sizes = []
+    for _ in range(4):
+        controller.batch_taken(100, 0)
+        sizes.append(controller.frame_size)
+    assert sizes == [MIN_FRAME_SIZE * 4, MIN_FRAME_SIZE * 2, MIN_FRAME_SIZE, MIN_FRAME_SIZE]
+
+
+def test_frame_size_below_min(clock):
+    controller = Controller(max_frame_size=MIN_FRAME_SIZE // 2)
+    assert controller.frame_size == MIN_FRAME_SIZE // 2
+    controller.batch_taken(MIN_FRAME_SIZE, MIN_FRAME_SIZE)
+    controller.batch_taken(1, 0)
+    assert controller.frame_size == MIN_FRAME_SIZE // 2
+
+
+def test_pollers_ramp_up_and_back_off(clock):
+    controller = Controller(window=8)
+    assert controller.pollers == 8
+    for _ in range(IDLE_POLLS - 1):
+        controller.down_answered(EMPTY)
+    assert controller.pollers == 8
+    controller.down_answered(EMPTY)
+    assert controller.idle and controller.pollers == 1
+    # Interactive data wakes a second poller, bulk data doubles them
+    controller.down_answered(100)
+    assert not controller.idle and controller.pollers == 2
+    pollers = []
+    for _ in range(3):
+        controller.down_answered(BULK_SIZE)
+        pollers.append(controller.pollers)
+    assert pollers == [4, 8, 8]
+    controller.down_answered(100)
+    assert controller.pollers == 8
+
+
+def test_wait_turn(clock):
+    controller = Controller(window=4)
+    for _ in range(IDLE_POLLS):
+        controller.down_answered(EMPTY)
+    controller.wait_turn(0)
+    thread = threading.Thread(target=controller.wait_turn, args=(3,), daemon=True)
+    thread.start()
+    thread.join(0.05)
+    assert thread.is_alive()
+    controller.down_answered(BULK_SIZE)
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_read_size(clock):
+    controller = Controller()
+    sizes = []
+    while controller.read_size < MAX_READ_SIZE:
+        controller.read_done(controller.read_size, controller.read_size)
+        sizes.append(controller.read_size)
+    assert sizes[0] == MIN_READ_SIZE * 2 and len(sizes) == 5
+    controller.read_done(MAX_READ_SIZE, MAX_READ_SIZE)
+    assert controller.read_size == MAX_READ_SIZE
+    controller.read_done(MAX_READ_SIZE // 4, MAX_READ_SIZE)
+    assert controller.read_size == MAX_READ_SIZE
+    for _ in range(10):
+        controller.read_done(10, controller.read_size)
+    assert controller.read_size == MIN_READ_SIZE
+
+
+def test_retry_delay(clock):
+    controller = Controller(interval=0.1)
+    delays = [controller.failed() for _ in range(8)]
+    assert delays[:4] == [0.1, 0.2, 0.4, 0.8]
+    assert delays[-1] == MAX_RETRY_DELAY
+    # An answer resets the backoff
+    controller.up_answered(0.05, 100)
+    assert controller.failed() == 0.1
+
+
+def test_goodput_and_srtt(clock):
+    controller = Controller()
+    controller.up_answered(0.1, 1000)
+    controller.up_answered(0.2, 1000)
+    assert controller.stats()['srtt'] == 0.1 + 0.125 * 0.1
+    assert controller.stats()['goodput'] == 0
+    clock.now += GOODPUT_PERIOD
+    controller.down_answered(2000)
+    assert controller.stats()['goodput'] == 0.125 * 4000 / GOODPUT_PERIOD
@@ -0,0 +1,66 @@
+"""Deterministic tests of the spreading of the workside requests over
+several paths, on a fake clock. Run with python3 -m pytest
+"""
+
+import collections
+import pytest
+from ssh_tunnel.workside.controller import MAX_RETRY_DELAY
+from ssh_tunnel.workside.paths import Paths
+
+URLS = ["http://home:8080/", "http://home:8081", "http://other:8080"]
+
+
+def test_urls():
+    assert Paths(URLS).urls == ["http://home:8080", "http://home:8081", "http://other:8080"]
+
+
+def test_spread_over_healthy_paths(clock):
+    paths = Paths(URLS)
+    # Requests in flight, as many as the pollers of the workside
+    picked = [paths.pick() for _ in range(6)]
+    assert collections.Counter(path.url for path in picked) == {url: 2 for url in paths.urls}
+    for path in picked:
+        paths.answered(path, 0.1)
+    # A path twice slower gets half the requests
+    paths.paths[0].srtt = 0.2
+    picked = [paths.pick() for _ in range(10)]
+    counts = collections.Counter(path.url for path in picked)
+    assert counts == {URLS[0].rstrip("/"): 2, URLS[1]: 4, URLS[2]: 4}
+
+
+def test_failing_path_left_aside(clock):
+    paths = Paths(URLS[:2], interval=0.1)
+    failing, healthy = paths.paths
+    paths.failed(paths.pick())
+    assert failing.failures == 1
+    assert paths.stats()["0_up"] == 0
+    # Only the healthy path is used until the backoff expires
+    for _ in range(3):
+        assert paths.pick() is healthy
+    clock.now += 0.1
+    assert failing in [paths.pick() for _ in range(5)]
+    # The delay doubles at each failure in a row
+    for delay in (0.2, 0.4, 0.8):
+        failing.in_flight += 1
+        paths.failed(failing)
+        assert failing.down_until == pytest.approx(clock.now + delay)
+    for _ in range(10):
+        failing.in_flight += 1
+        paths.failed(failing)
+    assert failing.down_until == clock.now + MAX_RETRY_DELAY
+    failing.in_flight += 1
+    paths.answered(failing)
+    assert failing.failures == 0 and paths.stats()["0_up"] == 1
+
+
+def test_every_path_failing(clock):
+    paths = Paths(URLS[:2], interval=0.1)
+    first, second = paths.paths
+    paths.failed(paths.pick())
+    clock.now += 0.05
+    paths.failed(paths.pick())
+    assert paths.wait() == pytest.approx(0.05)
+    # The path back first is still used, the request waiting for it
+    assert paths.pick() is first
+    clock.now += 0.1
+    assert paths.wait() == 0
@@ -0,0 +1,67 @@
+"""Tests of the random pages of the homeside. Run with python3 -m pytest"""
+
+import time
+from ssh_tunnel.homeside.tools import WordIndex, PagePool, random_page, word_index, PAGE_WORDS, WORDLIST
+
+WORDS = [b"alpha", b"beta", b"gamma", b"delta"]
+
+
+def page_words(page):
+    assert page.startswith(b"<html><body>") and page.endswith(b" </body></html>")
+    return page[len(b"<html><body>"):-len(b" </body></html>")].split()
+
+
+def test_word_index(tmp_path):
+    path = tmp_path / "words.txt"
+    # The last line has no line feed
+    path.write_bytes(b"\n".join(WORDS))
+    index = WordIndex(str(path))
+    assert index.count == len(WORDS)
+    lines = index.random_lines(1000)
+    assert len(lines) == 1000
+    assert {line.strip() for line in lines} == set(WORDS)
+
+
+def test_word_index_loaded_once():
+    assert word_index(WORDLIST) is word_index(WORDLIST)
+
+
+def test_random_page(tmp_path):
+    path = tmp_path / "words.txt"
+    path.write_bytes(b"\n".join(WORDS) + b"\n")
+    words = page_words(random_page(str(path)))
+    assert len(words) == PAGE_WORDS
+    assert set(words) <= set(WORDS)
+
+
+def test_random_page_of_the_wordlist():
+    with open(WORDLIST, "rb") as f:
+        dictionary = set(f.read().split())
+    words = page_words(random_page())
+    assert len(words) == PAGE_WORDS
+    assert set(words) <= dictionary
+    # Pages differ
+    assert page_words(random_page()) != words
+
+
+def wait_full(pool):
+    deadline = time.monotonic() + 5
+    while not pool.pages.full():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_page_pool_refills(tmp_path):
+    path = tmp_path / "words.txt"
+    path.write_bytes(b"\n".join(WORDS) + b"\n")
+    pool = PagePool(size=4, wordlist=str(path))
+    # Pages are built on the spot until the pool runs
+    assert len(page_words(pool.get())) == PAGE_WORDS
+    pool.start()
+    wait_full(pool)
+    for _ in range(4):
+        page = pool.get()
+        assert len(page_words(page)) == PAGE_WORDS
+        assert set(page_words(page)) <= set(WORDS)
+    wait_full(pool)
+    assert pool.pages.qsize() == 4
@@ -0,0 +1,99 @@
+"""Tests of the tracing of the frames, on a fake clock. Run with python3 -m pytest"""
+
+import os
+import subprocess
+import sys
+import pytest
+from ssh_tunnel.commons import FLAG_TRACE
+from ssh_tunnel.tracing import Tracer, read_traces, breakdown, percentile, UP, DOWN, READ, WRITTEN
+
+EPOCH = 3
+
+
+def test_flag():
+    assert [Tracer(os.devnull, sample=0.5).flag(seq) for seq in range(4)] == [FLAG_TRACE, 0, FLAG_TRACE, 0]
+    assert not any(Tracer(os.devnull, sample=0).flag(seq) for seq in range(100))
+
+
+def send(clock, workside, homeside, seq, size):
+    """Trace frame seq going up through every stage, 1 ms each, from the
+    reading of its data until it was written to two channels
+    """
+    since = clock.now
+    clock.now += 0.001
+    workside.taken(UP, EPOCH, seq, since)
+    clock.now += 0.001
+    workside.sealed(UP, EPOCH, seq)
+    clock.now += 0.001
+    received = clock.now
+    clock.now += 0.001
+    flags = workside.flag(seq)
+    homeside.opened(UP, (EPOCH, seq, flags, b""), received)
+    for channel in (1, 2):
+        homeside.dispatched(channel, size, (UP, EPOCH, seq) if flags & FLAG_TRACE else None)
+    clock.now += 0.001
+    homeside.written(1, size)
+    clock.now += 0.001
+    # The other channel wrote the data in two goes
+    homeside.written(2, size - 1)
+    homeside.written(2, 1)
+
+
+def test_breakdown(clock, tmp_path):
+    files = [str(tmp_path / "workside.trace"), str(tmp_path / "homeside.trace")]
+    workside, homeside = Tracer(files[0], sample=0.5), Tracer(files[1], sample=0)
+    for seq in range(10):
+        send(clock, workside, homeside, seq, 100)
+    # Data handed to a channel in frames not traced, the channel going on with the traced ones
+    homeside.dispatched(1, 50)
+    homeside.written(1, 50)
+    send(clock, workside, homeside, 10, 100)
+    homeside.forget(1)
+    homeside.written(1, 100)
+    workside.flush()
+    homeside.flush()
+    frames = read_traces(files)
+    # Odd frames are not traced, and the homeside follows the flag whatever its own sample
+    assert sorted(frames) == [(UP, EPOCH, seq) for seq in range(0, 11, 2)]
+    assert all(len(stamps) == WRITTEN - READ + 1 for stamps in frames.values())
+    steps = dict(breakdown(frames, UP))
+    assert list(steps) == ["queue", "seal", "http", "open", "write", "total"]
+    for step in ("queue", "seal", "http", "open"):
+        assert steps[step] == pytest.approx([0.001] * 6)
+    # The last channel to write the data of a frame counts
+    assert steps["write"] == pytest.approx([0.002] * 6)
+    assert steps["total"] == pytest.approx([0.006] * 6)
+    assert breakdown(frames, DOWN) == []
+
+
+def test_truncated_trace_file(clock, tmp_path):
+    path = str(tmp_path / "trace")
+    tracer = Tracer(path, sample=1)
+    tracer.sealed(DOWN, EPOCH, 1)
+    tracer.sealed(DOWN, EPOCH, 2)
+    tracer.flush()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 1)
+    assert list(read_traces([path])) == [(DOWN, EPOCH, 1)]
+
+
+def test_percentile():
+    values = list(range(100))
+    assert [percentile(values, p) for p in (0, 50, 90, 99, 100)] == [0, 50, 90, 99, 99]
+
+
+def test_command(clock, tmp_path):
+    files = [str(tmp_path / "workside.trace"), str(tmp_path / "homeside.trace")]
+    workside, homeside = Tracer(files[0], sample=1), Tracer(files[1])
+    send(clock, workside, homeside, 1, 100)
+    workside.flush()
+    homeside.flush()
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.run([sys.executable, "-m", "ssh_tunnel.tracing"] + files, cwd=root, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+    assert output[0] == "up, workside -> homeside : 1 frames traced"
+    assert [line.split()[:3] for line in output[2:8]] == [
+        [step, "1", "{:.2f}".format(ms)] for step, ms in
+        (("queue", 1), ("seal", 1), ("http", 1), ("open", 1), ("write", 2), ("total", 6))]
+    assert output[8] == "down, homeside -> workside : 0 frames traced"
+    assert len(output) == 10
@@ -0,0 +1,171 @@
+"""Both ends of the tunnel exchanging frames through function calls, with
+no http in between. Run with python3 -m pytest
+"""
+
+import itertools
+import pytest
+from ssh_tunnel.commons import Cipherer, FrameSplitter, RecordQueue, CHANNEL_DATA, STREAM_HEADER, FLAG_RESET
+from ssh_tunnel.homeside.tunnel import Tunnel as HomeTunnel
+from ssh_tunnel.workside.controller import Controller
+from ssh_tunnel.workside.tunnel import Tunnel as WorkTunnel
+
+MAX_SIZE = 65536
+requests = itertools.count()
+
+
+class FakeChannel():
+    """Stands in for the channels of both engines"""
+    def __init__(self, identifier):
+        self.identifier = identifier
+        self.received = b""
+        self.closed = False
+
+    def send(self, data):
+        self.received += bytes(data)
+
+    def grant(self, size):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def workside(compress=False):
+    return WorkTunnel(Cipherer("plop"), RecordQueue(), FakeChannel, Controller(), compress=compress)
+
+
+def tunnels(compress=False, retransmit_size=MAX_SIZE * 16):
+    """Returns the homeside and the workside of a tunnel, once they agreed on a session"""
+    home = HomeTunnel(Cipherer("plop"), RecordQueue(), compress=compress, retransmit_size=retransmit_size)
+    work = workside(compress)
+    resume(home, work)
+    return home, work
+
+
+def resume(home, work):
+    """Returns the flags of the /resume answer"""
+    answer = home.resume(work.resume_request())
+    work.resumed(answer)
+    return home.cipherer.open(FrameSplitter().feed(answer)[0])[2]
+
+
+def seal_up(work):
+    """Returns the body of the next /up request"""
+    seq, packed = work.outgoing_content.get_batch(MAX_SIZE, timeout=0, pack=work.compression.pack)
+    return work.seal_up(seq, packed)
+
+
+def post_up(home, body):
+    home.receive_up(str(next(requests)), body)
+
+
+def seal_down(home):
+    """Returns the body of the next /down answer"""
+    seq, packed = home.incoming_content.get_batch(MAX_SIZE, timeout=0, pack=home.compression.pack)
+    return home.answer_down(str(next(requests)), seq, packed)
+
+
+def open_channel(home, work):
+    """Returns the homeside and workside channels of a new ssh client"""
+    channel = FakeChannel(home.next_channel_id())
+    home.add_channel(channel)
+    work.receive_down(seal_down(home))
+    return channel, work.channels[channel.identifier]
+
+
+def test_data_both_ways(clock):
+    home, work = tunnels(compress=True)
+    home_channel, work_channel = open_channel(home, work)
+    data = b"hello tunnel " * 100
+    work.outgoing_content.put((home_channel.identifier, CHANNEL_DATA, data))
+    post_up(home, seal_up(work))
+    home.incoming_content.put((home_channel.identifier, CHANNEL_DATA, data))
+    work.receive_down(seal_down(home))
+    assert home_channel.received == data
+    assert work_channel.received == data
+
+
+def test_parse_stream():
+    assert HomeTunnel.parse_stream(b"0") == (0, False)
+    assert HomeTunnel.parse_stream(b"12") == (12, False)
+    # The fallback of a workside whose stream answers are held by a proxy
+    assert HomeTunnel.parse_stream(b"3 framed") == (3, True)
+    for body in (b"", b"-1", b"x", b"3 chunked", b"3framed", b"3 framed extra"):
+        with pytest.raises(ValueError):
+            HomeTunnel.parse_stream(body)
+
+
+def test_stream_frames(clock):
+    home, work = tunnels()
+    home_channel, work_channel = open_channel(home, work)
+    frames = []
+    for index in range(3):
+        home.incoming_content.put((home_channel.identifier, CHANNEL_DATA, b"frame %d " % index))
+        frames.append(seal_down(home))
+    # Frames of a chunked answer, or a single one answered with a Content-Length
+    body = b"".join(STREAM_HEADER.pack(len(frame)) + frame for frame in frames)
+    splitter = FrameSplitter()
+    for offset in range(len(body)):
+        for frame in splitter.feed(body[offset:offset + 1]):
+            work.receive_down(frame)
+    assert work_channel.received == b"frame 0 frame 1 frame 2 "
+
+
+def test_resume_same_session(clock):
+    home, work = tunnels(compress=True)
+    home_channel, work_channel = open_channel(home, work)
+    for index in range(3):
+        home.incoming_content.put((home_channel.identifier, CHANNEL_DATA, b"missed %d " % index))
+        # The answers of these /down requests never reach the workside
+        seal_down(home)
+    assert resume(home, work) == 0
+    assert work_channel.received == b"missed 0 missed 1 missed 2 "
+    assert not home_channel.closed and not work_channel.closed
+    assert home.metrics.counters["resent_frames"] == 3
+    # Frames sent again are not delivered twice
+    assert resume(home, work) == 0
+    assert work_channel.received == b"missed 0 missed 1 missed 2 "
+    home.incoming_content.put((home_channel.identifier, CHANNEL_DATA, b"next"))
+    work.receive_down(seal_down(home))
+    assert work_channel.received.endswith(b"next")
+
+
+def test_resume_restarted_workside(clock):
+    home, work = tunnels(compress=True)
+    home_channel, work_channel = open_channel(home, work)
+    home.incoming_content.put((home_channel.identifier, CHANNEL_DATA, b"lost"))
+    seal_down(home)
+    # A new workside process, which knows nothing of the channels
+    work = workside(compress=True)
+    assert resume(home, work) & FLAG_RESET
+    assert home_channel.closed
+    assert work.channels == {}
+    assert home.metrics.counters["lost_channels"] == 1
+    home_channel, work_channel = open_channel(home, work)
+    home.incoming_content.put((home_channel.identifier, CHANNEL_DATA, b"new session"))
+    work.receive_down(seal_down(home))
+    assert work_channel.received == b"new session"
+
+
+def test_reset_restarts_up_compression(clock):
+    home, work = tunnels(compress=True, retransmit_size=1)
+    home_channel, work_channel = open_channel(home, work)
+    work.outgoing_content.put((home_channel.identifier, CHANNEL_DATA, b"first frame " * 100))
+    post_up(home, seal_up(work))
+    assert work.compression.compressor.compressed == 1
+    # A frame in flight while the homeside forgets the /down frames the workside missed
+    data = b"other data " * 100
+    work.outgoing_content.put((home_channel.identifier, CHANNEL_DATA, data))
+    in_flight = seal_up(work)
+    home.incoming_content.put((home_channel.identifier, CHANNEL_DATA, b"missed"))
+    seal_down(home)
+    assert work_channel.closed is False
+    assert resume(home, work) & FLAG_RESET
+    assert home_channel.closed and work_channel.closed
+    # The homeside drops the frame in flight, the workside starts a new compression stream
+    post_up(home, in_flight)
+    home_channel, work_channel = open_channel(home, work)
+    work.outgoing_content.put((home_channel.identifier, CHANNEL_DATA, data))
+    post_up(home, seal_up(work))
+    assert home_channel.received == data
+    assert home.metrics.counters["invalid_frames"] == 0
@@ -0,0 +1,165 @@
+"""Optional tracing of the frames through the tunnel, and the tool reading
+the traces.
+
+A traced frame is stamped at every stage it goes through : when the oldest
+of its data was read from a socket and queued, when it was taken from the
+queue, sealed, received by the other side, opened, and when its data was
+written to the socket of each of its channels. The sender traces one frame
+out of ``1 / sample`` and flags them, so that the other side traces the
+same ones whatever its own sample. Each side appends its stamps to a trace
+file, a few bytes each ; ``python3 -m ssh_tunnel.tracing <files>`` prints
+the time spent in each stage out of the files of both sides.
+
+Stamps are taken from the wall clock, so that the ones of both sides can
+be compared : the time between sealed and received also holds the offset
+between the clocks of the two hosts.
+"""
+
+import argparse
+import atexit
+import collections
+import struct
+import threading
+import time
+from ssh_tunnel.commons import FLAG_TRACE
+
+# Default share of the frames traced
+TRACE_SAMPLE = 0.01
+# Longest time stamps are kept in memory before being written, in seconds
+FLUSH_PERIOD = 1
+
+# Directions of the frames
+UP = 0
+DOWN = 1
+# Stages of a frame, in the order it goes through them
+READ, TAKEN, SEALED, RECEIVED, OPENED, WRITTEN = range(6)
+# Name of the time spent before reaching each stage
+STEPS = {TAKEN: "queue", SEALED: "seal", RECEIVED: "http", OPENED: "open", WRITTEN: "write"}
+# direction, stage, epoch of the sender, seq of the frame, time
+TRACE_RECORD = struct.Struct("!BBIQd")
+
+
+class Tracer():
+    """Append the stamps of the traced frames of one side to a trace file.
+    It may be used from any thread
+    """
+    def __init__(self, path, sample=TRACE_SAMPLE):
+        # One frame sent out of period is traced, none if 0
+        self.period = max(1, round(1 / sample)) if sample > 0 else 0
+        self.file = open(path, "ab")
+        self.last_flush = time.monotonic()
+        # channel id -> [bytes handed to it, bytes it wrote, deque of (bytes it
+        # must have written for the data of a traced frame to be out, frame)]
+        self.channels = {}
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def flag(self, seq):
+        """Flags of the frame numbered seq, FLAG_TRACE if it is traced"""
+        return FLAG_TRACE if self.period and seq % self.period == 0 else 0
+
+    def stamp(self, direction, epoch, seq, stage, when=None):
+        record = TRACE_RECORD.pack(direction, stage, epoch, seq, time.time() if when is None else when)
+        with self.lock:
+            self.file.write(record)
+            now = time.monotonic()
+            if now - self.last_flush >= FLUSH_PERIOD:
+                self.file.flush()
+                self.last_flush = now
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def taken(self, direction, epoch, seq, since):
+        """A batch was taken from a queue, its oldest data waiting there since ``since``"""
+        if self.flag(seq):
+            self.stamp(direction, epoch, seq, READ, since)
+            self.stamp(direction, epoch, seq, TAKEN)
+
+    def sealed(self, direction, epoch, seq):
+        if self.flag(seq):
+            self.stamp(direction, epoch, seq, SEALED)
+
+    def opened(self, direction, frame, received):
+        """A frame received at ``received`` was opened"""
+        epoch, seq, flags, _ = frame
+        if flags & FLAG_TRACE:
+            self.stamp(direction, epoch, seq, RECEIVED, received)
+            self.stamp(direction, epoch, seq, OPENED)
+
+    def dispatched(self, channel, size, frame=None):
+        """size bytes of a frame were handed to a channel. If given as
+        (direction, epoch, seq), the frame is stamped once the channel wrote them
+        """
+        with self.lock:
+            state = self.channels.setdefault(channel, [0, 0, collections.deque()])
+            state[0] += size
+            if frame is not None:
+                state[2].append((state[0], frame))
+
+    def written(self, channel, size):
+        """A channel wrote size bytes to its socket"""
+        done = []
+        with self.lock:
+            state = self.channels.get(channel)
+            if state is None:
+                return
+            state[1] += size
+            while state[2] and state[2][0][0] <= state[1]:
+                done.append(state[2].popleft()[1])
+        for direction, epoch, seq in done:
+            self.stamp(direction, epoch, seq, WRITTEN)
+
+    def forget(self, channel):
+        with self.lock:
+            self.channels.pop(channel, None)
+
+
+def read_traces(paths):
+    """Returns {(direction, epoch, seq): {stage: time}} out of trace files.
+    A frame written to several channels keeps the time of the last one
+    """
+    frames = collections.defaultdict(dict)
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        usable = len(data) - len(data) % TRACE_RECORD.size
+        for direction, stage, epoch, seq, when in TRACE_RECORD.iter_unpack(data[:usable]):
+            stamps = frames[direction, epoch, seq]
+            stamps[stage] = max(when, stamps.get(stage, when))
+    return frames
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def breakdown(frames, direction):
+    """Returns [(step, sorted durations in seconds)] of the frames going
+    one way : the time spent before each stage, then in total
+    """
+    steps = collections.defaultdict(list)
+    for (frame_direction, _, _), stamps in frames.items():
+        if frame_direction != direction:
+            continue
+        for stage, step in STEPS.items():
+            if stage in stamps and stage - 1 in stamps:
+                steps[step].append(stamps[stage] - stamps[stage - 1])
+        if READ in stamps and WRITTEN in stamps:
+            steps["total"].append(stamps[WRITTEN] - stamps[READ])
+    return [(step, sorted(steps[step])) for step in list(STEPS.values()) + ["total"] if steps[step]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('traces', nargs='+',
+                        help='Specify the trace files to read, those of both sides for the whole breakdown')
+    args = parser.parse_args()
+    frames = read_traces(args.traces)
+    for direction, name in ((UP, "up, workside -> homeside"), (DOWN, "down, homeside -> workside")):
+        print("{} : {} frames traced".format(name, sum(1 for key in frames if key[0] == direction)))
+        print("  {:<6} {:>7} {:>9} {:>9} {:>9} {:>9}".format("step", "frames", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for step, durations in breakdown(frames, direction):
+            print("  {:<6} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                step, len(durations), *[percentile(durations, p) * 1000 for p in (50, 90, 99)], durations[-1] * 1000))
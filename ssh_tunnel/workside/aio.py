@@ -0,0 +1,444 @@
+"""asyncio engine of the workside : a single event loop drives the
+connections to sshd and the http requests to the homeside, instead of a
+thread per socket and per request in flight. It speaks the same protocol
+as the threaded engine.
+"""
+
+import asyncio
+import logging
+import random
+import ssl
+import time
+import urllib.request
+from threading import Thread
+from urllib.parse import urlsplit
+from ssh_tunnel.commons import AsyncCredit, FrameSplitter, CHANNEL_DATA, NONCE_SIZE, TAG_SIZE
+from ssh_tunnel.workside import USER_AGENT
+from ssh_tunnel.metrics import log_sampled
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPConnectionPool():
+    """Minimal HTTP/1.1 client keeping its connections to the homeside
+    alive. Like requests, it goes through the proxy found in the environment
+    """
+    def __init__(self, baseurl):
+        url = urlsplit(baseurl)
+        self.baseurl = baseurl.rstrip("/")
+        self.netloc = url.netloc
+        self.path = url.path.rstrip("/")
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.address = (url.hostname, url.port or (443 if self.ssl else 80))
+        self.through_proxy = False
+        proxy = urllib.request.getproxies().get(url.scheme)
+        if proxy and not self.ssl and not urllib.request.proxy_bypass(url.hostname):
+            proxy = urlsplit(proxy)
+            self.address = (proxy.hostname, proxy.port or 80)
+            self.through_proxy = True
+        self.idle = []
+
+    def request_head(self, method, path, body):
+        target = self.baseurl + path if self.through_proxy else self.path + path
+        head = ("{} {} HTTP/1.1\r\n"
+                "Host: {}\r\n"
+                "User-Agent: {}\r\n"
+                "Accept: */*\r\n"
+                "Content-Length: {}\r\n\r\n").format(method, target, self.netloc, USER_AGENT, len(body))
+        return head.encode("latin-1")
+
+    async def request(self, method, path, body=b""):
+        """Returns (status, content) of the response"""
+        if self.idle:
+            reader, writer = self.idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(*self.address, ssl=self.ssl)
+        try:
+            writer.write(self.request_head(method, path, body) + body)
+            status, keep_alive, content = await self.read_response(reader)
+        except (asyncio.IncompleteReadError, ValueError, OSError) as e:
+            writer.close()
+            raise ConnectionError(e)
+        if keep_alive:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, content
+
+    async def stream(self, method, path, body=b""):
+        """Send a request on a connection of its own, and return (status,
+        chunked, pieces) of the response, pieces being an async iterator over
+        its body as it comes. Iterating over it raises ConnectionError if the
+        connection fails. Only 201 answers are streamed, pieces is None otherwise
+        """
+        reader, writer = await asyncio.open_connection(*self.address, ssl=self.ssl)
+        try:
+            writer.write(self.request_head(method, path, body) + body)
+            status, version, headers = await self.read_head(reader)
+        except (asyncio.IncompleteReadError, ValueError, OSError) as e:
+            writer.close()
+            raise ConnectionError(e)
+        except asyncio.CancelledError:
+            writer.close()
+            raise
+        chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+        if status != 201:
+            writer.close()
+            return status, chunked, None
+        return status, chunked, self.read_pieces(reader, writer, headers, chunked)
+
+    async def read_pieces(self, reader, writer, headers, chunked):
+        try:
+            if chunked:
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    if not size:
+                        break
+                    yield await reader.readexactly(size)
+                    await reader.readexactly(2)
+            elif "content-length" in headers:
+                yield await reader.readexactly(int(headers["content-length"]))
+            else:
+                yield await reader.read()
+        except (asyncio.IncompleteReadError, ValueError, OSError) as e:
+            raise ConnectionError(e)
+        finally:
+            writer.close()
+
+    async def read_head(self, reader):
+        """Returns (status, version, headers) of a response"""
+        statusline = await reader.readline()
+        if not statusline:
+            raise ConnectionError("Connection closed by the server")
+        version, status = statusline.decode("latin-1").split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return int(status), version, headers
+
+    async def read_response(self, reader):
+        status, version, headers = await self.read_head(reader)
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return status, keep_alive, content
+
+
+class Channel():
+    """A connection to sshd, on behalf of an ssh client connected to the homeside"""
+    def __init__(self, identifier):
+        self.identifier = identifier
+        # Data received on /down for sshd, None once the homeside closed it
+        self.incoming_content = asyncio.Queue()
+        # Bytes of sshd the homeside is ready to take
+        self.credit = AsyncCredit()
+
+    def send(self, data):
+        self.incoming_content.put_nowait(data)
+
+    def grant(self, size):
+        self.credit.grant(size)
+
+    def close(self):
+        self.incoming_content.put_nowait(None)
+        self.credit.close()
+
+
+class AsyncioEngine():
+    """Poll /down, send /up and serve the channels from the same event loop"""
+    def __init__(self, tunnel, stream=False, crypto=None):
+        self.tunnel = tunnel
+        self.stream = stream
+        # CryptoPool sealing and opening the frames, or None to do it in the event loop
+        self.crypto = crypto
+        tunnel.new_channel = self.new_channel
+        # Path -> HTTPConnectionPool to its url
+        self.pools = {path: HTTPConnectionPool(path.url) for path in tunnel.paths.paths}
+        # Held by the task agreeing on a session with the homeside
+        self.resume_lock = asyncio.Lock()
+        # Keep a reference on running tasks, the event loop only has weak ones
+        self.tasks = set()
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def serve(self):
+        readers = [self.stream_down(index) for index in range(len(self.pools))] if self.stream else [
+            self.poll_down(index) for index in range(self.tunnel.window)]
+        await asyncio.gather(self.uplink(), self.humanize(), *readers)
+
+    async def resume(self):
+        """Agree on a session with the homeside if needed, before polling it"""
+        if not self.tunnel.needs_resume():
+            return
+        async with self.resume_lock:
+            while self.tunnel.needs_resume():
+                content = await self.post_until_created("/resume/{}".format(random.getrandbits(128)),
+                                                        self.tunnel.resume_request())
+                try:
+                    self.tunnel.resumed(content)
+                except ValueError:
+                    log_sampled(logger, logging.WARNING, "invalid resume", "Invalid answer received on /resume")
+                    await asyncio.sleep(self.tunnel.controller.failed())
+
+    async def deliver_down(self, content):
+        """Hand a frame received from the homeside to the tunnel, opened in the crypto pool if any"""
+        self.tunnel.controller.down_answered(len(content))
+        try:
+            if self.crypto is None:
+                self.tunnel.receive_down(content)
+            else:
+                frame = await self.crypto.run(self.tunnel.open_down, content)
+                self.tunnel.accept_down(content, frame)
+        except ValueError:
+            log_sampled(logger, logging.WARNING, "invalid down", "Invalid content received on /down, dropping it")
+
+    async def post_until_created(self, path, data, timed=False):
+        """Send data to the homeside until it answers with a 201, and return the content.
+        Each try goes through the path picked by ``tunnel.paths``, reporting its round
+        trip time if ``timed``. The path of the url is kept between retries, so the
+        homeside can spot duplicates whatever base url they went to
+        """
+        paths = self.tunnel.paths
+        while True:
+            route = paths.pick()
+            start = time.monotonic()
+            try:
+                status, content = await self.pools[route].request("POST", path, data)
+            except ConnectionError:
+                self.tunnel.controller.failed()
+                paths.failed(route)
+                self.tunnel.metrics.count("http_retries")
+                delay = paths.wait()
+                log_sampled(logger, logging.WARNING, "retry", "Connection to %s failed, retry in %.1f sec",
+                            route.url + path, delay)
+                await asyncio.sleep(delay)
+                continue
+            if status == 201:
+                paths.answered(route, time.monotonic() - start if timed else None)
+                return content
+            self.tunnel.metrics.count("http_retries")
+            self.tunnel.controller.failed()
+            paths.failed(route)
+            await asyncio.sleep(paths.wait())
+
+    async def seal_up(self, seq, packed):
+        """Build the body of an /up request, sealed in the crypto pool if any"""
+        if self.crypto is None:
+            return self.tunnel.seal_up(seq, packed)
+        return await self.crypto.run(self.tunnel.seal_up, seq, packed)
+
+    async def post_up(self, path, seq, packed):
+        """Seal a batch and send it in an /up request, reporting its round trip time to the controller"""
+        data = await self.seal_up(seq, packed)
+        start = time.monotonic()
+        await self.post_until_created(path, data, timed=True)
+        rtt = time.monotonic() - start
+        self.tunnel.metrics.observe("up_rtt_seconds", rtt)
+        self.tunnel.controller.up_answered(rtt, len(data))
+
+    async def poll_down(self, index):
+        """Poll /down as long as the controller lets the poller number ``index``
+        have a request in flight, sending the pending sshd data along if any
+        """
+        delay = 0
+        while True:
+            await self.tunnel.controller.wait_turn(index)
+            await self.resume()
+            seq, packed = await self.tunnel.outgoing_content.get_batch(self.tunnel.controller.frame_size,
+                                                                       timeout=delay,
+                                                                       pack=self.tunnel.compression.pack)
+            request_id = random.getrandbits(128)
+            start = time.monotonic()
+            if seq:
+                self.tunnel.controller.batch_taken(self.tunnel.sealed_size(packed), self.tunnel.outgoing_content.size)
+                encrypted_rawdata = await self.seal_up(seq, packed)
+                self.tunnel.metrics.count("exchanges")
+                content = await self.post_until_created("/exchange/{}".format(request_id), encrypted_rawdata)
+            else:
+                content = await self.post_until_created("/down/{}".format(request_id),
+                                                        str(random.getrandbits(128)).encode())
+            self.tunnel.metrics.observe("down_rtt_seconds", time.monotonic() - start)
+            await self.deliver_down(content)
+            delay = self.tunnel.controller.exchange_delay(len(content))
+
+    async def stream_down(self, index):
+        """Read the frames the homeside writes in long-lived /stream answers,
+        like the StreamThread number ``index``
+        """
+        while True:
+            await self.resume()
+            path = "/stream/{}".format(random.getrandbits(128))
+            received = await self.read_stream(path)
+            if received is not None:
+                break
+        logger.warning("Answers of /stream are held by a proxy : polling /down instead")
+        await self.read_framed(path, received)
+        if index == 0:
+            await asyncio.gather(*[self.poll_down(poller) for poller in range(self.tunnel.window)])
+
+    async def read_stream(self, path):
+        """Read a stream until its end, or until the session must be resumed.
+        Returns None, or the number of frames received if they do not come as
+        they are written
+        """
+        paths = self.tunnel.paths
+        received = 0
+        while True:
+            route = paths.pick()
+            try:
+                status, chunked, pieces = await asyncio.wait_for(
+                    self.pools[route].stream("POST", path, str(received).encode()), self.tunnel.stream_timeout)
+            except asyncio.TimeoutError:
+                # The homeside writes a first frame straight away
+                paths.answered(route)
+                return received
+            except (ConnectionError, OSError):
+                status = None
+            if status == 201 and not chunked:
+                await pieces.aclose()
+                paths.answered(route)
+                return received
+            if status == 201:
+                self.tunnel.metrics.count("streams")
+                splitter = FrameSplitter()
+                try:
+                    while True:
+                        piece = await asyncio.wait_for(pieces.__anext__(), self.tunnel.stream_timeout)
+                        for frame in splitter.feed(piece):
+                            await self.deliver_down(frame)
+                            received += 1
+                        if self.tunnel.needs_resume():
+                            # Go on in a new stream once resumed
+                            await pieces.aclose()
+                            paths.answered(route)
+                            return None
+                except StopAsyncIteration:
+                    if not splitter.pending:
+                        paths.answered(route)
+                        return None
+                except (ConnectionError, asyncio.TimeoutError):
+                    pass
+                await pieces.aclose()
+                log_sampled(logger, logging.WARNING, "stream", "Stream %s cut short, resuming it",
+                            route.url + path)
+            self.tunnel.metrics.count("http_retries")
+            self.tunnel.controller.failed()
+            paths.failed(route)
+            await asyncio.sleep(paths.wait())
+
+    async def read_framed(self, path, received):
+        """Get the frames of a stream one per request, answered with a
+        Content-Length, until the homeside has nothing more to send
+        """
+        while True:
+            content = await self.post_until_created(path, "{} framed".format(received).encode())
+            frames = FrameSplitter().feed(content)
+            for frame in frames:
+                await self.deliver_down(frame)
+            received += len(frames)
+            if not frames or len(frames[-1]) <= NONCE_SIZE + TAG_SIZE:
+                return
+
+    async def uplink(self):
+        """Coalesce the pending records of every channel into /up requests,
+        with up to ``window`` requests in flight
+        """
+        window = asyncio.Semaphore(self.tunnel.window)
+        while True:
+            await window.acquire()
+            seq, packed = await self.tunnel.outgoing_content.get_batch(self.tunnel.controller.frame_size,
+                                                                       linger=self.tunnel.linger,
+                                                                       pack=self.tunnel.compression.pack)
+            if not seq:
+                # The queue restarted with a new session
+                window.release()
+                continue
+            self.tunnel.controller.batch_taken(self.tunnel.sealed_size(packed), self.tunnel.outgoing_content.size)
+            request_id = random.getrandbits(128)
+            # Sealed by the task sending it, while the next batch is taken
+            task = self.spawn(self.post_up("/up/{}".format(request_id), seq, packed))
+            task.add_done_callback(lambda _: window.release())
+
+    async def humanize(self):
+        """Flood the proxy with legitimate traffic, like the HumanizerThread"""
+        while True:
+            method = random.choice(['GET', 'POST'])
+            path = "/{}".format(random.getrandbits(128))
+            pool = random.choice(list(self.pools.values()))
+            try:
+                await pool.request(method, path)
+            except ConnectionError as e:
+                log_sampled(logger, logging.WARNING, "humanize", "requests failed to %s %s: %s",
+                            method, pool.baseurl + path, e)
+            await asyncio.sleep(random.randint(800, 1200)/1000)
+
+    def new_channel(self, identifier):
+        channel = Channel(identifier)
+        self.spawn(self.serve_channel(channel))
+        return channel
+
+    async def serve_channel(self, channel):
+        """Connect a channel to sshd, then copy data both ways"""
+        try:
+            reader, writer = await asyncio.open_connection(*self.tunnel.ssh_address)
+        except OSError:
+            logger.error("Cannot connect to local sshd on port %s", self.tunnel.ssh_address[1])
+            self.tunnel.sshd_gone(channel)
+            return
+        read_task = self.spawn(self.read_sshd(channel, reader))
+        while True:
+            rawdata = await channel.incoming_content.get()
+            if rawdata is None:
+                break
+            try:
+                writer.write(rawdata)
+                await writer.drain()
+            except OSError:
+                logger.info("Broken pipe trying to send data to ssh_server on channel %s", channel.identifier)
+                break
+            self.tunnel.consumed(channel, len(rawdata))
+        writer.close()
+        read_task.cancel()
+
+    async def read_sshd(self, channel, reader):
+        while True:
+            await self.tunnel.outgoing_content.wait_room(channel.identifier)
+            credit = await channel.credit.wait()
+            if not credit:
+                # Closed by the homeside
+                return
+            asked = min(self.tunnel.controller.read_size, credit)
+            try:
+                rawdata = await reader.read(asked)
+            except OSError:
+                rawdata = b""
+            if not rawdata:
+                self.tunnel.sshd_gone(channel)
+                return
+            self.tunnel.controller.read_done(len(rawdata), asked)
+            channel.credit.consume(len(rawdata))
+            self.tunnel.outgoing_content.put((channel.identifier, CHANNEL_DATA, rawdata))
+
+
+class AsyncioThread(Thread):
+    """Run the asyncio engine of the workside"""
+    def __init__(self, tunnel, stream=False, crypto=None, *args, **kwargs):
+        self.tunnel = tunnel
+        self.stream = stream
+        self.crypto = crypto
+        super(*args, **kwargs)
+        Thread.__init__(self)
+
+    def run(self):
+        asyncio.run(AsyncioEngine(self.tunnel, self.stream, self.crypto).serve())
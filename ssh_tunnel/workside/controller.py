@@ -0,0 +1,176 @@
+"""Adaptive control of the requests sent by the workside.
+
+The controller measures the round trip time of the /up requests, the
+goodput of the tunnel and how much data waits to be sent, then picks how
+many /down requests are in flight, how big /up frames and sshd reads are,
+and how long to wait before retrying a failed request. It is shared by
+the threaded and the asyncio engines.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from ssh_tunnel.commons import MAX_FRAME_SIZE, WINDOW, NONCE_SIZE, TAG_SIZE
+
+# Smallest frame size the controller goes down to, in bytes
+MIN_FRAME_SIZE = 8192
+# Range of the size of the reads from sshd, in bytes
+MIN_READ_SIZE = 2048
+MAX_READ_SIZE = 65536
+# /down answers at least this big mean a bulk transfer, in bytes
+BULK_SIZE = 16384
+# Number of empty /down answers in a row after which the tunnel is idle
+IDLE_POLLS = 8
+# Longest time waited before retrying a failed request, in seconds
+MAX_RETRY_DELAY = 5
+# Default time a poller waits for sshd to answer the data it just received,
+# to send the answer along with its next /down request, in seconds
+EXCHANGE_WAIT = 0.01
+# Weight of a new sample in the moving averages
+SMOOTHING = 0.125
+# Period over which goodput is measured, in seconds
+GOODPUT_PERIOD = 1
+
+logger = logging.getLogger(__name__)
+
+
+class Controller():
+    """Pick the poll rate, the in-flight /down requests and the frame size.
+
+    At most ``window`` /down requests are in flight : the controller drops
+    to a single one, held by the homeside, once the tunnel is idle, and
+    ramps up as soon as bulk data comes. /up frames start small and grow
+    while data keeps piling up, up to ``max_frame_size``. After a small
+    /down answer, the kind interactive sessions get, pollers wait up to
+    ``exchange_wait`` for the reply of sshd to carry it in their next request.
+    """
+    def __init__(self, window=WINDOW, max_frame_size=MAX_FRAME_SIZE, interval=0.1, exchange_wait=EXCHANGE_WAIT):
+        self.window = window
+        self.max_frame_size = max_frame_size
+        self.interval = interval
+        self.exchange_wait = exchange_wait
+        self.pollers = window
+        self.frame_size = min(MIN_FRAME_SIZE, max_frame_size)
+        self.read_size = MIN_READ_SIZE
+        self.empty_polls = 0
+        self.failures = 0
+        # Smoothed round trip time of the /up requests, in seconds
+        self.srtt = None
+        # Smoothed bytes carried per second, both ways
+        self.goodput = 0.0
+        self.period_start = time.monotonic()
+        self.period_bytes = 0
+        self.lock = threading.Lock()
+        self.turn = threading.Condition(self.lock)
+
+    @property
+    def idle(self):
+        return self.empty_polls >= IDLE_POLLS
+
+    def wait_turn(self, index):
+        """Block the /down poller number ``index`` until it may send a request"""
+        with self.turn:
+            self.turn.wait_for(lambda: index < self.pollers)
+
+    def _pollers_added(self):
+        self.turn.notify_all()
+
+    def _set_pollers(self, pollers):
+        if pollers == self.pollers:
+            return
+        was_idle = self.pollers == 1
+        added = pollers > self.pollers
+        self.pollers = pollers
+        if added:
+            self._pollers_added()
+        if was_idle != (pollers == 1):
+            logger.info("Controller: %s, %s", "idle" if pollers == 1 else "busy", self._describe())
+
+    def _describe(self):
+        return "{} /down in flight, frames of {} bytes, srtt {}, goodput {:.0f} B/s".format(
+            self.pollers, self.frame_size,
+            "{:.1f} ms".format(self.srtt * 1000) if self.srtt is not None else "unknown", self.goodput)
+
+    def _carried(self, size):
+        self.period_bytes += size
+        now = time.monotonic()
+        elapsed = now - self.period_start
+        if elapsed >= GOODPUT_PERIOD:
+            self.goodput += SMOOTHING * (self.period_bytes / elapsed - self.goodput)
+            self.period_start = now
+            self.period_bytes = 0
+
+    def down_answered(self, size):
+        """A /down request was answered with size bytes"""
+        with self.lock:
+            self.failures = 0
+            self._carried(size)
+            if size <= NONCE_SIZE + TAG_SIZE:
+                self.empty_polls += 1
+                if self.idle:
+                    self._set_pollers(1)
+                return
+            self.empty_polls = 0
+            pollers = max(self.pollers, min(2, self.window))
+            if size >= BULK_SIZE:
+                pollers = min(self.window, pollers * 2)
+            self._set_pollers(pollers)
+
+    def exchange_delay(self, size):
+        """How long a poller which got a /down answer of size bytes waits for
+        data to send along with its next request, in seconds
+        """
+        if NONCE_SIZE + TAG_SIZE < size < BULK_SIZE:
+            return self.exchange_wait
+        return 0
+
+    def up_answered(self, rtt, size):
+        """An /up request of size bytes was answered after rtt seconds"""
+        with self.lock:
+            self.failures = 0
+            self._carried(size)
+            self.srtt = rtt if self.srtt is None else self.srtt + SMOOTHING * (rtt - self.srtt)
+
+    def batch_taken(self, size, pending):
+        """A frame of size bytes was taken from the /up queue, which still holds pending bytes"""
+        with self.lock:
+            if pending >= self.frame_size:
+                self.frame_size = min(self.max_frame_size, self.frame_size * 2)
+            elif size < self.frame_size // 4:
+                self.frame_size = max(min(MIN_FRAME_SIZE, self.max_frame_size), self.frame_size // 2)
+
+    def read_done(self, size, asked):
+        """A read from sshd returned size bytes out of asked"""
+        with self.lock:
+            if size >= asked:
+                self.read_size = min(MAX_READ_SIZE, self.read_size * 2)
+            elif size < asked // 4:
+                self.read_size = max(MIN_READ_SIZE, self.read_size // 2)
+
+    def failed(self):
+        """A request failed. Returns how long to wait before retrying it, in seconds"""
+        with self.lock:
+            self.failures += 1
+            return min(MAX_RETRY_DELAY, self.interval * 2 ** (self.failures - 1))
+
+    def stats(self):
+        with self.lock:
+            return {'pollers': self.pollers, 'frame_size': self.frame_size, 'read_size': self.read_size,
+                    'srtt': self.srtt, 'goodput': self.goodput, 'idle': self.idle, 'failures': self.failures}
+
+
+class AsyncController(Controller):
+    """Controller for the asyncio engine. ``wait_turn`` must only be used from the event loop"""
+    def __init__(self, *args, **kwargs):
+        Controller.__init__(self, *args, **kwargs)
+        self.changed = asyncio.Event()
+
+    async def wait_turn(self, index):
+        """Coroutine version of ``Controller.wait_turn``"""
+        while index >= self.pollers:
+            self.changed.clear()
+            await self.changed.wait()
+
+    def _pollers_added(self):
+        self.changed.set()
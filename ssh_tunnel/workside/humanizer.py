@@ -1,28 +1,33 @@
 """This modules contains a thread that fakes human behaviour, in
 order to flood the proxy with legitimate traffic"""
 
+import logging
 import requests
 import random
 import time
 from threading import Thread
 from ssh_tunnel.workside import USER_AGENT
+from ssh_tunnel.metrics import log_sampled
+
+logger = logging.getLogger(__name__)
 
 
 class HumanizerThread(Thread):
-    def __init__(self, homeside_url, *args, **kwargs):
-        self.homeside_url = homeside_url
+    def __init__(self, homeside_urls, *args, **kwargs):
+        self.homeside_urls = homeside_urls
         super(*args, **kwargs)
         Thread.__init__(self)
 
     def run(self):
+        session = requests.Session()
+        session.headers['User-Agent'] = USER_AGENT
         while True:
             method = random.choice(['GET', 'POST'])
-            uri = "{}/{}".format(self.homeside_url, random.getrandbits(128))
+            uri = "{}/{}".format(random.choice(self.homeside_urls).rstrip("/"), random.getrandbits(128))
             try:
-                requests.request(method, uri, headers={'User-Agent': USER_AGENT})
+                session.request(method, uri)
             except requests.exceptions.RequestException as e:
-                print("requests failed to {} {}".format(method, uri))
-                print(e)
+                log_sampled(logger, logging.WARNING, "humanize", "requests failed to %s %s: %s", method, uri, e)
             duration = random.randint(800, 1200)/1000
-            print("Contacted {}, sleeping {}".format(uri, duration))
+            log_sampled(logger, logging.DEBUG, "contacted", "Contacted %s, sleeping %s", uri, duration)
             time.sleep(duration)
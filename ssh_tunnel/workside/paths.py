@@ -0,0 +1,101 @@
+"""Urls of the homeside the workside spreads its requests over.
+
+Each url is a path to the homeside of its own : another port, another
+hostname, and thus other proxy connections. Every request goes through the
+path which should answer it first, given the requests it has in flight
+and its round trip time. A path whose requests fail is left aside for a
+delay doubling from the retry interval, the others going on meanwhile.
+Frames carry a sequence number, so each side puts them back in order
+whatever path they took. It is shared by the threaded and the asyncio engines.
+"""
+
+import logging
+import threading
+import time
+from ssh_tunnel.workside.controller import MAX_RETRY_DELAY, SMOOTHING
+
+logger = logging.getLogger(__name__)
+
+
+class Path():
+    """A base url of the homeside, and how its requests went lately"""
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.in_flight = 0
+        # Smoothed round trip time of the timed requests, in seconds
+        self.srtt = None
+        self.requests = 0
+        # Failures in a row, the path is left aside until down_until
+        self.failures = 0
+        self.down_until = 0
+
+
+class Paths():
+    """Pick the path of each request. A path is counted in flight from
+    ``pick`` until ``answered`` or ``failed`` is called
+    """
+    def __init__(self, urls, interval=0.1):
+        self.paths = [Path(url) for url in urls]
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    @property
+    def urls(self):
+        return [path.url for path in self.paths]
+
+    def pick(self):
+        """Returns the path the next request goes through. If every path
+        is left aside, the one back first
+        """
+        with self.lock:
+            now = time.monotonic()
+            healthy = [path for path in self.paths if path.down_until <= now]
+            if not healthy:
+                healthy = [min(self.paths, key=lambda path: path.down_until)]
+            known = [path.srtt for path in healthy if path.srtt is not None]
+            # Paths not measured yet are expected to be as fast as the best one
+            default = min(known) if known else 1
+            path = min(healthy, key=lambda path: (path.in_flight + 1) * (default if path.srtt is None
+                                                                         else path.srtt))
+            path.in_flight += 1
+            path.requests += 1
+            return path
+
+    def answered(self, path, rtt=None):
+        """A request through path got its answer, after rtt seconds if it
+        was not held by the homeside
+        """
+        with self.lock:
+            path.in_flight -= 1
+            if path.failures and len(self.paths) > 1:
+                logger.info("Path %s is back", path.url)
+            path.failures = 0
+            path.down_until = 0
+            if rtt is not None:
+                path.srtt = rtt if path.srtt is None else path.srtt + SMOOTHING * (rtt - path.srtt)
+
+    def failed(self, path):
+        """A request through path failed, leave it aside for a while"""
+        with self.lock:
+            path.in_flight -= 1
+            if not path.failures and len(self.paths) > 1:
+                logger.warning("Path %s failed, using the other ones", path.url)
+            path.failures += 1
+            path.down_until = time.monotonic() + min(MAX_RETRY_DELAY, self.interval * 2 ** (path.failures - 1))
+
+    def wait(self):
+        """Returns how long to wait before a path may be used again, in seconds"""
+        with self.lock:
+            return max(0, min(path.down_until for path in self.paths) - time.monotonic())
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            stats = {}
+            for index, path in enumerate(self.paths):
+                stats.update({"{}_in_flight".format(index): path.in_flight,
+                              "{}_srtt".format(index): path.srtt,
+                              "{}_requests".format(index): path.requests,
+                              "{}_failures".format(index): path.failures,
+                              "{}_up".format(index): int(path.down_until <= now)})
+            return stats
@@ -0,0 +1,258 @@
+"""State of the workside end of the tunnel, shared by the threaded and
+the asyncio engines
+"""
+
+import logging
+import random
+import time
+from ssh_tunnel.commons import Cipherer, FrameSplitter, ReorderBuffer, pack_records, unpack_records
+from ssh_tunnel.compression import StreamCompression
+from ssh_tunnel.metrics import Metrics, log_sampled
+from ssh_tunnel.tracing import UP, DOWN
+from ssh_tunnel.workside.paths import Paths
+from ssh_tunnel.commons import LINGER, MAX_FRAME_SIZE, WINDOW, STREAM_TIMEOUT
+from ssh_tunnel.commons import CHANNEL_OPEN, CHANNEL_CLOSE, CHANNEL_CREDIT, TUNNEL_ACK, TUNNEL_RESUME
+from ssh_tunnel.commons import CHANNEL_WINDOW, CREDIT, ACK, RESUME, FRAME_HEADER, FLAG_RESET, FLAG_TRACE
+
+# Time a frame may be missing before the frames after it are asked again, in seconds
+RESUME_AFTER = 5
+# Number of frames received between two acknowledgments sent to the homeside
+ACK_FRAMES = 16
+
+logger = logging.getLogger(__name__)
+
+
+class Tunnel():
+    """Channels opened to sshd, and frames exchanged with the homeside.
+
+    ``outgoing_content`` holds the (channel, kind, data) records waiting
+    to be sent on /up. Engines read it by themselves, as they do not wait
+    the same way, but they pack batches with ``compression.pack``.
+    ``new_channel`` is called with a channel id when the homeside gets a
+    new ssh client ; it returns an engine object with a
+    ``send(data)``, a ``grant(size)`` and a ``close()`` method, connecting
+    to sshd by itself. Channels read sshd as long as the homeside granted
+    them credit, and report the data written to sshd with ``consumed``,
+    so that the homeside is granted credit in turn.
+
+    Engines agree on a session with the homeside, with a /resume request
+    built by ``resume_request``, whenever ``needs_resume`` : when they start,
+    when frames come from a homeside which restarted, and when a frame is
+    missing for ``RESUME_AFTER`` seconds.
+    """
+    def __init__(self, cipherer, outgoing_content, new_channel, controller, urls=("http://localhost:8000",),
+                 ssh_address=("", 22), linger=LINGER, max_frame_size=MAX_FRAME_SIZE,
+                 window=WINDOW, compress=False, tracer=None, stream_timeout=STREAM_TIMEOUT):
+        self.cipherer = cipherer
+        self.outgoing_content = outgoing_content
+        self.new_channel = new_channel
+        # Picks the size of the frames and of the reads, and the requests in flight
+        self.controller = controller
+        # Urls of the homeside the requests are spread over
+        self.paths = Paths(urls, controller.interval)
+        self.ssh_address = ssh_address
+        self.linger = linger
+        self.max_frame_size = max_frame_size
+        self.window = window
+        # Time without any data after which a /stream answer is given up, in seconds
+        self.stream_timeout = stream_timeout
+        # channel id -> channel, one for each ssh client connected to the homeside
+        self.channels = {}
+        # channel id -> bytes written to sshd, and not granted back to the homeside yet
+        self.unacked = {}
+        # Identify the frames sent by this process on /up
+        self.epoch = random.getrandbits(32)
+        # /down requests may complete out of order, dispatch their records following their sequence number
+        self.incoming_frames = ReorderBuffer(self.deliver_frame)
+        self.compression = StreamCompression(compress)
+        # Epoch of the homeside of the session, None until one resumed
+        self.peer_epoch = None
+        self.resume_asked = False
+        # Next seq the homeside was last told the workside expects
+        self.acked = 1
+        # Tracer stamping the frames at each stage, or None
+        self.tracer = tracer
+        if tracer is not None:
+            outgoing_content.trace = lambda seq, since: tracer.taken(UP, self.epoch, seq, since)
+        self.metrics = Metrics()
+        self.metrics.gauge("queue_bytes", lambda: self.outgoing_content.size)
+        self.metrics.gauge("queue_records", lambda: self.outgoing_content.count)
+        self.metrics.gauge("queue_channels", self.outgoing_content.stats)
+        self.metrics.gauge("channels", lambda: len(self.channels))
+        self.metrics.gauge("controller", self.controller.stats)
+        self.metrics.gauge("paths", self.paths.stats)
+        self.metrics.gauge("compression", self.compression.stats)
+
+    def close_channel(self, identifier):
+        """Forget about a channel and tell it to stop"""
+        channel = self.channels.pop(identifier, None)
+        self.unacked.pop(identifier, None)
+        if self.tracer is not None:
+            self.tracer.forget(identifier)
+        if channel:
+            channel.close()
+
+    def sshd_gone(self, channel):
+        """The connection of a channel to sshd failed or was closed"""
+        if self.channels.get(channel.identifier) is not channel:
+            # Closed already : its identifier may be the one of a channel of a new session
+            return
+        self.close_channel(channel.identifier)
+        self.outgoing_content.put((channel.identifier, CHANNEL_CLOSE, b""))
+
+    def deliver_frame(self, frame):
+        """Called with the frames received on /down, following their sequence number"""
+        frame_epoch, seq, flags, payload = frame
+        try:
+            records = self.compression.unpack(frame_epoch, flags, payload)
+        except ValueError as e:
+            self.metrics.count("invalid_frames")
+            log_sampled(logger, logging.WARNING, "invalid frame", "Invalid frame received on /down, dropping it: %s", e)
+            return
+        self.dispatch_records(records, (DOWN, frame_epoch, seq) if flags & FLAG_TRACE else None)
+
+    def dispatch_records(self, records, traced=None):
+        """Hand the records received on /down to the matching channels. The
+        data of a ``traced`` frame is stamped once written to sshd
+        """
+        for identifier, kind, data in records:
+            if kind == CHANNEL_OPEN:
+                self.channels[identifier] = self.new_channel(identifier)
+            elif kind == CHANNEL_CLOSE:
+                self.close_channel(identifier)
+            else:
+                # The channel may be closed meanwhile by its own thread
+                channel = self.channels.get(identifier)
+                if channel is None:
+                    continue
+                if kind == CHANNEL_CREDIT:
+                    channel.grant(CREDIT.unpack(data)[0])
+                else:
+                    if self.tracer is not None:
+                        self.tracer.dispatched(identifier, len(data), traced)
+                    channel.send(data)
+
+    def consumed(self, channel, size):
+        """A channel wrote size bytes to sshd : grant them back to the
+        homeside, once enough of them piled up
+        """
+        identifier = channel.identifier
+        if self.channels.get(identifier) is not channel:
+            return
+        if self.tracer is not None:
+            self.tracer.written(identifier, size)
+        unacked = self.unacked.get(identifier, 0) + size
+        if unacked >= CHANNEL_WINDOW // 4:
+            self.outgoing_content.put((identifier, CHANNEL_CREDIT, CREDIT.pack(unacked)))
+            unacked = 0
+        self.unacked[identifier] = unacked
+
+    def receive_down(self, body):
+        """Handle the answer of an /down request. Raises ValueError if it cannot be decrypted"""
+        self.accept_down(body, self.open_down(body))
+
+    def open_down(self, body):
+        """Decrypt the answer of an /down request, from any thread. Returns
+        its frame, or None if it is empty. Raises ValueError if it cannot be decrypted
+        """
+        received = time.time()
+        start = time.perf_counter()
+        try:
+            frame = self.cipherer.open(body)
+        except ValueError:
+            self.metrics.count("invalid_frames")
+            raise
+        self.metrics.observe("decrypt_seconds", time.perf_counter() - start)
+        if frame and self.tracer is not None:
+            self.tracer.opened(DOWN, frame, received)
+        return frame
+
+    def accept_down(self, body, frame):
+        """Handle the frame of an /down answer, as returned by ``open_down``"""
+        self.metrics.count("down_bytes", len(body))
+        if not frame:
+            self.metrics.count("down_empty")
+        else:
+            frame_epoch, seq, flags, payload = frame
+            if frame_epoch != self.peer_epoch:
+                # A homeside the session was not agreed with : it sends the frame again once resumed
+                self.metrics.count("down_dropped")
+                self.resume_asked = True
+                return
+            self.metrics.count("down_frames")
+            self.compression.received(flags)
+            self.incoming_frames.push(frame_epoch, seq, frame)
+            next_seq = self.incoming_frames.next_seq
+            if next_seq >= self.acked + ACK_FRAMES:
+                # Let the homeside forget the frames it keeps to send them again
+                self.acked = next_seq
+                self.outgoing_content.put((0, TUNNEL_ACK, ACK.pack(next_seq)))
+
+    def needs_resume(self):
+        """Whether a session must be agreed on with the homeside before polling it"""
+        stalled = self.incoming_frames.stalled_since
+        return (self.peer_epoch is None or self.resume_asked
+                or (stalled is not None and time.monotonic() - stalled > RESUME_AFTER))
+
+    def resume_request(self):
+        """Body of a /resume request : a frame numbered 0 telling the session the workside knows"""
+        session = RESUME.pack(self.peer_epoch or 0, self.incoming_frames.next_seq, self.outgoing_content.seq + 1)
+        return self.cipherer.seal(self.epoch, 0, 0, pack_records([(0, TUNNEL_RESUME, session)]))
+
+    def resumed(self, answer):
+        """Handle the answer of a /resume request. Raises ValueError if it is invalid"""
+        frames = FrameSplitter().feed(answer)
+        frame = self.open_down(frames[0]) if frames else None
+        if not frame:
+            raise ValueError("Empty /resume answer")
+        peer_epoch, seq, flags, payload = frame
+        records = [data for channel, kind, data in unpack_records(payload) if kind == TUNNEL_RESUME]
+        if seq or not records:
+            raise ValueError("No session in /resume answer")
+        _, _, start = RESUME.unpack(records[0])
+        if flags & FLAG_RESET:
+            # A new session : the channels of the previous one lost data, or
+            # their ssh clients are gone with the homeside
+            lost = list(self.channels) if self.peer_epoch is not None else []
+
+            def restart(next_seq):
+                if lost:
+                    self.outgoing_content.drop()
+                # The homeside drops the /up frames in flight, or restarted :
+                # its decompression stream goes on from a new one
+                self.compression.restart()
+
+            self.outgoing_content.restart(restart)
+            for identifier in lost:
+                self.close_channel(identifier)
+            if lost:
+                self.metrics.count("lost_channels", len(lost))
+                logger.warning("Homeside session lost, %s channels closed", len(lost))
+            self.incoming_frames.restart(peer_epoch, start)
+            self.acked = start
+        self.peer_epoch = peer_epoch
+        self.resume_asked = False
+        self.metrics.count("resumes")
+        for body in frames[1:]:
+            self.accept_down(body, self.open_down(body))
+
+    @staticmethod
+    def sealed_size(packed):
+        """Size of the body ``seal_up`` builds out of a packed batch"""
+        return Cipherer.sealed_size(FRAME_HEADER.size + len(packed[1]))
+
+    def seal_up(self, seq, packed):
+        """Build the body of an /up request from a batch of ``outgoing_content``,
+        as packed by ``compression.pack``. It may be called from any thread
+        """
+        flags, payload = packed
+        if self.tracer is not None:
+            flags |= self.tracer.flag(seq)
+        start = time.perf_counter()
+        body = self.cipherer.seal(self.epoch, seq, flags, payload)
+        self.metrics.observe("encrypt_seconds", time.perf_counter() - start)
+        if self.tracer is not None:
+            self.tracer.sealed(UP, self.epoch, seq)
+        self.metrics.count("up_frames")
+        self.metrics.count("up_bytes", len(body))
+        return body
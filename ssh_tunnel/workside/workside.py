@@ -1,96 +1,422 @@
 import argparse
+import collections
+import logging
+import queue
 import socket
 import sys
 import time
 import random
 
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread, local
 try:
     import requests
 except ImportError:
     print("Please download requests with `pip3 install requests`")
     sys.exit(1)
 
-from ssh_tunnel.commons import Cipherer
+from ssh_tunnel.commons import AsyncRecordQueue, BufferPool, Cipherer, Credit, CryptoPool, FrameSplitter, RecordQueue
+from ssh_tunnel.commons import LINGER, MAX_FRAME_SIZE, WINDOW, CHANNEL_DATA, CRYPTO_WORKERS, NONCE_SIZE, TAG_SIZE
+from ssh_tunnel.commons import STREAM_TIMEOUT
 from ssh_tunnel.workside import USER_AGENT
+from ssh_tunnel.workside.aio import AsyncioThread
+from ssh_tunnel.workside.controller import AsyncController, Controller, EXCHANGE_WAIT
 from ssh_tunnel.workside.humanizer import HumanizerThread
+from ssh_tunnel.workside.tunnel import Tunnel
+from ssh_tunnel.metrics import MetricsThread, log_sampled
+from ssh_tunnel.profiling import SamplingProfiler, PROFILE_SIGNAL
+from ssh_tunnel.tracing import Tracer, TRACE_SAMPLE
 
 
-ssh_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+tunnel = None
+# CryptoPool opening the frames of /stream answers, or None to do it in the StreamThread
+crypto = None
+# Frames of /stream answers being opened in the CryptoPool at most, per worker
+OPENING_PER_WORKER = 2
+logger = logging.getLogger(__name__)
+# Holds the http session of each thread
+thread_data = local()
+# Held by the thread agreeing on a session with the homeside
+resume_lock = Lock()
 
 
-def try_post(url, interval, *args, **kwargs):
+def get_session():
+    """Return the requests session of the calling thread, keeping its
+    connections to the homeside alive between requests
+    """
+    if not hasattr(thread_data, "session"):
+        thread_data.session = requests.Session()
+        thread_data.session.headers['User-Agent'] = USER_AGENT
+    return thread_data.session
+
+
+def post_until_created(path, data, timed=False):
+    """Send data to the homeside until it answers with a 201, and return the response.
+    Each try goes through the path picked by ``tunnel.paths``, reporting its round
+    trip time if ``timed``. The path of the url is kept between retries, so the
+    homeside can spot duplicates whatever base url they went to
+    """
     while True:
-        # Randomize a bit
-        time.sleep((random.randint(0, 1000)//1000))
+        route = tunnel.paths.pick()
+        start = time.monotonic()
         try:
-            r = requests.post(url, headers={'User-Agent': USER_AGENT}, *args, **kwargs)
-            return r
+            r = get_session().post(route.url + path, data=data)
         except requests.exceptions.ConnectionError:
-            print("Connection to {} failed, retry in {} sec".format(url, interval))
-            time.sleep(interval)
+            tunnel.controller.failed()
+            tunnel.paths.failed(route)
+            tunnel.metrics.count("http_retries")
+            delay = tunnel.paths.wait()
+            log_sampled(logger, logging.WARNING, "retry", "Connection to %s failed, retry in %.1f sec",
+                        route.url + path, delay)
+            time.sleep(delay)
+            continue
+        if r.status_code == 201:
+            tunnel.paths.answered(route, time.monotonic() - start if timed else None)
+            return r
+        tunnel.metrics.count("http_retries")
+        tunnel.controller.failed()
+        tunnel.paths.failed(route)
+        time.sleep(tunnel.paths.wait())
+
+
+def resume():
+    """Agree on a session with the homeside if needed, before polling it"""
+    if not tunnel.needs_resume():
+        return
+    with resume_lock:
+        while tunnel.needs_resume():
+            r = post_until_created("/resume/{}".format(random.getrandbits(128)), tunnel.resume_request())
+            try:
+                tunnel.resumed(r.content)
+            except ValueError:
+                log_sampled(logger, logging.WARNING, "invalid resume", "Invalid answer received on /resume")
+                time.sleep(tunnel.controller.failed())
+
+
+def deliver_down(content):
+    """Hand a frame received from the homeside to the tunnel"""
+    tunnel.controller.down_answered(len(content))
+    try:
+        tunnel.receive_down(content)
+    except ValueError:
+        log_sampled(logger, logging.WARNING, "invalid down", "Invalid content received on /down, dropping it")
+
+
+def post_up(path, seq, packed):
+    """Seal a batch and send it in an /up request, reporting its round trip time to the controller"""
+    data = tunnel.seal_up(seq, packed)
+    start = time.monotonic()
+    post_until_created(path, data, timed=True)
+    rtt = time.monotonic() - start
+    tunnel.metrics.observe("up_rtt_seconds", rtt)
+    tunnel.controller.up_answered(rtt, len(data))
+
+
+class Channel():
+    """A connection to sshd, on behalf of an ssh client connected to the homeside"""
+    def __init__(self, identifier):
+        self.identifier = identifier
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Data received on /down for sshd, None once the homeside closed it
+        self.incoming_content = queue.Queue()
+        # Bytes of sshd the homeside is ready to take
+        self.credit = Credit()
+
+    def send(self, data):
+        self.incoming_content.put(data)
+
+    def grant(self, size):
+        self.credit.grant(size)
+
+    def close(self):
+        self.incoming_content.put(None)
+        self.credit.close()
+
+
+def new_channel(identifier):
+    """Create the channel of a new ssh client of the homeside"""
+    channel = Channel(identifier)
+    SSHFeedThread(channel).start()
+    return channel
 
 
 class SSHReadThread(Thread):
-    def __init__(self, socket, baseurl, interval, cipherer, *args, **kwargs):
-        self.socket = socket
-        self.baseurl = baseurl
-        self.interval = interval
-        self.cipherer = cipherer
+    """Poll /down for data to send to sshd, as long as the controller lets
+    the poller number ``index`` have a request in flight. If sshd data is
+    pending, it is sent along with the poll, as an /exchange request
+    """
+    def __init__(self, index, *args, **kwargs):
+        self.index = index
         super(*args, **kwargs)
         Thread.__init__(self)
 
     def run(self):
+        delay = 0
         while True:
+            tunnel.controller.wait_turn(self.index)
+            resume()
+            seq, packed = tunnel.outgoing_content.get_batch(tunnel.controller.frame_size, timeout=delay,
+                                                            pack=tunnel.compression.pack)
             request_id = random.getrandbits(128)
-            r = try_post(self.baseurl+"/down/{}".format(request_id), self.interval, data=str(random.getrandbits(128)))
-            if r.status_code == 201:
+            start = time.monotonic()
+            if seq:
+                encrypted_rawdata = tunnel.seal_up(seq, packed)
+                tunnel.controller.batch_taken(len(encrypted_rawdata), tunnel.outgoing_content.size)
+                tunnel.metrics.count("exchanges")
+                r = post_until_created("/exchange/{}".format(request_id), encrypted_rawdata)
+            else:
+                r = post_until_created("/down/{}".format(request_id),
+                                       str(random.getrandbits(128)))
+            tunnel.metrics.observe("down_rtt_seconds", time.monotonic() - start)
+            deliver_down(r.content)
+            delay = tunnel.controller.exchange_delay(len(r.content))
+
+
+class StreamThread(Thread):
+    """Read the frames the homeside writes in long-lived /stream answers,
+    resuming a stream cut short from the first frame not received. If a
+    proxy holds the answers, gets the frames it took one per request, then
+    the StreamThread number 0 polls /down instead
+    """
+    def __init__(self, index, *args, **kwargs):
+        self.index = index
+        # Frames of the current stream received
+        self.received = 0
+        # Futures of the frames handed to the CryptoPool, oldest first
+        self.opening = collections.deque()
+        super(*args, **kwargs)
+        Thread.__init__(self)
+
+    def run(self):
+        while True:
+            resume()
+            path = "/stream/{}".format(random.getrandbits(128))
+            self.received = 0
+            if not self.read_stream(path):
+                break
+        logger.warning("Answers of /stream are held by a proxy : polling /down instead")
+        self.read_framed(path)
+        if self.index == 0:
+            for index in range(tunnel.window):
+                SSHReadThread(index).start()
+
+    def open_in_pool(self, frame):
+        """Hand a frame to the CryptoPool, first waiting for the oldest ones
+        while ``OPENING_PER_WORKER`` frames per worker are being opened
+        """
+        limit = OPENING_PER_WORKER * crypto.workers
+        while self.opening and (self.opening[0].done() or len(self.opening) >= limit):
+            error = self.opening.popleft().exception()
+            if error is not None:
+                log_sampled(logger, logging.ERROR, "deliver stream",
+                            "Failed to deliver a frame received on /stream: %r", error)
+        self.opening.append(crypto.submit(deliver_down, frame))
+
+    def read_stream(self, path):
+        """Read a stream until its end, or until the session must be resumed. Returns False if
+        its frames do not come as they are written
+        """
+        while True:
+            route = tunnel.paths.pick()
+            try:
+                r = get_session().post(route.url + path, data=str(self.received), stream=True,
+                                       timeout=(tunnel.stream_timeout, tunnel.stream_timeout))
+            except requests.exceptions.ConnectTimeout:
+                r = None
+            except requests.exceptions.Timeout:
+                # The homeside writes a first frame straight away
+                tunnel.paths.answered(route)
+                return False
+            except requests.exceptions.ConnectionError:
+                r = None
+            if r is not None and r.status_code == 201:
+                if r.headers.get("Transfer-Encoding", "").lower() != "chunked":
+                    r.close()
+                    tunnel.paths.answered(route)
+                    return False
+                tunnel.metrics.count("streams")
+                splitter = FrameSplitter()
                 try:
-                    content = self.cipherer.decrypt(r.content)
-                    self.socket.send(content)
-                except OSError:
-                    print("Broken pipe trying to send data to ssh_server. Exiting")
-                    return
+                    for piece in r.iter_content(chunk_size=None):
+                        for frame in splitter.feed(piece):
+                            if crypto is None:
+                                deliver_down(frame)
+                            else:
+                                # Opened while the next frames are read, they are put back in order
+                                self.open_in_pool(frame)
+                            self.received += 1
+                            if tunnel.needs_resume():
+                                # Go on in a new stream once resumed
+                                r.close()
+                                tunnel.paths.answered(route)
+                                return True
+                except (requests.exceptions.RequestException, OSError):
+                    pass
+                else:
+                    if not splitter.pending:
+                        tunnel.paths.answered(route)
+                        return True
+                log_sampled(logger, logging.WARNING, "stream", "Stream %s cut short, resuming it",
+                            route.url + path)
+            elif r is not None:
+                r.close()
+            tunnel.metrics.count("http_retries")
+            tunnel.controller.failed()
+            tunnel.paths.failed(route)
+            time.sleep(tunnel.paths.wait())
+
+    def read_framed(self, path):
+        """Get the frames of a stream one per request, answered with a
+        Content-Length, until the homeside has nothing more to send
+        """
+        while True:
+            r = post_until_created(path, "{} framed".format(self.received))
+            frames = FrameSplitter().feed(r.content)
+            for frame in frames:
+                deliver_down(frame)
+            self.received += len(frames)
+            if not frames or len(frames[-1]) <= NONCE_SIZE + TAG_SIZE:
+                return
+
+
+class SSHFeedThread(Thread):
+    """Connect a channel to sshd, and write to it the data received for the channel"""
+    def __init__(self, channel, *args, **kwargs):
+        self.channel = channel
+        self.socket = channel.socket
+        super(*args, **kwargs)
+        Thread.__init__(self)
+
+    def run(self):
+        try:
+            self.socket.connect(tunnel.ssh_address)
+        except OSError:
+            logger.error("Cannot connect to local sshd on port %s", tunnel.ssh_address[1])
+            tunnel.sshd_gone(self.channel)
+            return
+        SSHWriteThread(self.channel).start()
+        while True:
+            rawdata = self.channel.incoming_content.get()
+            if rawdata is None:
+                break
+            try:
+                self.socket.sendall(rawdata)
+            except OSError:
+                logger.info("Broken pipe trying to send data to ssh_server on channel %s", self.channel.identifier)
+                break
+            tunnel.consumed(self.channel, len(rawdata))
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
 
 
 class SSHWriteThread(Thread):
-    def __init__(self, socket, baseurl, interval, cipherer, *args, **kwargs):
-        self.socket = socket
-        self.baseurl = baseurl
-        self.interval = interval
-        self.cipherer = cipherer
+    """Read what sshd sends on a channel, for the UplinkThread to send it"""
+    def __init__(self, channel, *args, **kwargs):
+        self.channel = channel
+        self.socket = channel.socket
         super(*args, **kwargs)
         Thread.__init__(self)
 
     def run(self):
+        buffers = tunnel.outgoing_content.buffers
+        buffer = buffers.get()
         while True:
-            rawdata = self.socket.recv(2048)
-            encrypted_rawdata = self.cipherer.encrypt(rawdata)
-            request_id = random.getrandbits(128)
-            r = try_post(self.baseurl+"/up/{}".format(request_id), self.interval, data=encrypted_rawdata)
-            while r.status_code != 201:
-                r = try_post(self.baseurl+"/up/{}".format(request_id), self.interval, data=encrypted_rawdata)
+            tunnel.outgoing_content.wait_room(self.channel.identifier)
+            credit = self.channel.credit.wait()
+            if not credit:
+                # Closed by the homeside
+                return
+            asked = min(tunnel.controller.read_size, credit, len(buffer))
+            try:
+                size = self.socket.recv_into(buffer, asked)
+            except OSError:
+                size = 0
+            if not size:
+                tunnel.sshd_gone(self.channel)
+                return
+            tunnel.controller.read_done(size, asked)
+            rawdata, buffer = buffers.take(buffer, size)
+            self.channel.credit.consume(size)
+            tunnel.outgoing_content.put((self.channel.identifier, CHANNEL_DATA, rawdata))
 
 
-def run(passphrase, baseurl="http://localhost:8000", ssh_port=22, bind="", interval=0.1):
-    try:
-        ssh_socket.connect((bind, ssh_port))
-    except ConnectionRefusedError:
-        print("Cannot connect to local sshd on port {}".format(ssh_port))
-        sys.exit(1)
+class UplinkThread(Thread):
+    """Coalesce the pending records of every channel into /up requests,
+    with up to ``window`` requests in flight
+    """
+    def __init__(self, *args, **kwargs):
+        self.window = BoundedSemaphore(tunnel.window)
+        self.executor = ThreadPoolExecutor(max_workers=tunnel.window)
+        super(*args, **kwargs)
+        Thread.__init__(self)
 
+    def run(self):
+        while True:
+            self.window.acquire()
+            seq, packed = tunnel.outgoing_content.get_batch(tunnel.controller.frame_size, linger=tunnel.linger,
+                                                            pack=tunnel.compression.pack)
+            if not seq:
+                # The queue restarted with a new session
+                self.window.release()
+                continue
+            tunnel.controller.batch_taken(tunnel.sealed_size(packed), tunnel.outgoing_content.size)
+            request_id = random.getrandbits(128)
+            # Sealed by the thread sending it, while the next batch is taken
+            future = self.executor.submit(post_up, "/up/{}".format(request_id), seq, packed)
+            future.add_done_callback(lambda _: self.window.release())
+
+
+def start(passphrase, baseurl="http://localhost:8000", ssh_port=22, bind="", interval=0.1,
+          linger=LINGER, max_frame_size=MAX_FRAME_SIZE, window=WINDOW, engine="threads", compress=False,
+          metrics_port=None, exchange_wait=EXCHANGE_WAIT, stream=False, crypto_workers=0, trace=None,
+          trace_sample=TRACE_SAMPLE, stream_timeout=STREAM_TIMEOUT):
+    """Start polling the homeside and serving its channels, and return the running threads.
+    ``baseurl`` may be a list of urls, or several comma separated ones, the requests being
+    spread over them. The metrics are served on ``metrics_port`` of localhost, if given. With ``stream``,
+    data is read from long-lived /stream answers instead of /down polls, one for each url, given
+    up after ``stream_timeout`` seconds without data. Frames
+    are sealed and opened by ``crypto_workers`` threads if not 0. If ``trace`` is given, a
+    share ``trace_sample`` of the frames are traced to this file
+    """
+    global tunnel, crypto
+    crypto = CryptoPool(crypto_workers) if crypto_workers else None
     cipherer = Cipherer(passphrase)
-    read_thread = SSHReadThread(ssh_socket, baseurl, interval, cipherer)
-    write_thread = SSHWriteThread(ssh_socket, baseurl, interval, cipherer)
-    humanizer_thread = HumanizerThread(baseurl)
+    urls = baseurl.split(",") if isinstance(baseurl, str) else list(baseurl)
+    settings = dict(urls=urls, ssh_address=(bind, ssh_port), linger=linger,
+                    max_frame_size=max_frame_size, window=window, compress=compress,
+                    tracer=Tracer(trace, trace_sample) if trace else None, stream_timeout=stream_timeout)
+    if engine == "asyncio":
+        controller = AsyncController(window, max_frame_size, interval, exchange_wait)
+        tunnel = Tunnel(cipherer, AsyncRecordQueue(), None, controller, **settings)
+        threads = [AsyncioThread(tunnel, stream, crypto)]
+    else:
+        controller = Controller(window, max_frame_size, interval, exchange_wait)
+        tunnel = Tunnel(cipherer, RecordQueue(buffers=BufferPool()), new_channel, controller, **settings)
+        if stream:
+            # One stream per url
+            readers = [StreamThread(index) for index in range(len(urls))]
+        else:
+            readers = [SSHReadThread(index) for index in range(window)]
+        threads = readers + [UplinkThread(), HumanizerThread(urls)]
+    if metrics_port:
+        threads.append(MetricsThread(tunnel.metrics, metrics_port))
+
+    for thread in threads:
+        thread.start()
+    return threads
 
-    humanizer_thread.start()
-    read_thread.start()
-    write_thread.start()
 
-    humanizer_thread.run()
-    read_thread.run()
-    write_thread.run()
+def run(passphrase, profile=None, **settings):
+    """Run the workside until it is killed. With ``profile``, a SamplingProfiler
+    writes to files starting with it. ``settings`` are the ones of ``start``
+    """
+    if profile:
+        SamplingProfiler(profile).start()
+    for thread in start(passphrase, **settings):
+        thread.join()
 
 
 if __name__ == '__main__':
@@ -101,7 +427,8 @@ if __name__ == '__main__':
     parser.add_argument('baseurl', action='store',
                         default="http://localhost:8000", type=str,
                         nargs='?',
-                        help='Specify alternate url for http interface [default: http://localhost:8000]')
+                        help='Specify alternate url for http interface, or several comma separated urls '
+                             'of the same homeside to spread the requests over [default: http://localhost:8000]')
     parser.add_argument('ssh_port', action='store',
                         default=22, type=int,
                         nargs='?',
@@ -109,8 +436,71 @@ if __name__ == '__main__':
     parser.add_argument('--interval', action='store',
                         default=0.1,
                         nargs='?',
-                        help='Specify alternate interval between http requests [default: 0.1 s]')
+                        help='Specify how long to wait before retrying a failed http request, '
+                             'doubled after each failure in a row [default: 0.1 s]')
+    parser.add_argument('--linger', action='store',
+                        default=LINGER, type=float,
+                        help='Specify how long to wait for more sshd data before sending it on /up '
+                             '[default: {} s]'.format(LINGER))
+    parser.add_argument('--max-frame', action='store',
+                        default=MAX_FRAME_SIZE, type=int,
+                        help='Specify the maximum size of the data sent in a single /up request, '
+                             'frames grow up to it while data piles up [default: {} bytes]'.format(MAX_FRAME_SIZE))
+    parser.add_argument('--window', action='store',
+                        default=WINDOW, type=int,
+                        help='Specify how many /up and /down requests may be in flight at once, '
+                             'a single /down request is kept when idle [default: {}]'.format(WINDOW))
+    parser.add_argument('--engine', action='store',
+                        default="threads", choices=["threads", "asyncio"],
+                        help='Drive sshd connections and http requests with threads, '
+                             'or with a single asyncio event loop [default: threads]')
+    parser.add_argument('--compress', action='store_true',
+                        help='Compress the /up requests when they shrink, if the homeside '
+                             'can decompress them [default: off]')
+    parser.add_argument('--exchange-wait', action='store',
+                        default=EXCHANGE_WAIT, type=float,
+                        help='Specify how long to wait for sshd to answer the data it just got, to send '
+                             'the answer along with the next /down request, 0 to disable '
+                             '[default: {} s]'.format(EXCHANGE_WAIT))
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the data of the homeside from long-lived chunked answers instead of '
+                             'polling /down, falling back to polling if a proxy buffers them [default: off]')
+    parser.add_argument('--stream-timeout', action='store',
+                        default=STREAM_TIMEOUT, type=float,
+                        help='Specify how long a /stream answer may go without data before a proxy is deemed '
+                             'to hold it, it must be longer than the --hold of the homeside '
+                             '[default: {} s]'.format(STREAM_TIMEOUT))
+    parser.add_argument('--crypto-workers', action='store',
+                        default=0, type=int,
+                        help='Specify how many threads seal and open the frames of the asyncio engine and of '
+                             '--stream, {} using every core [default: 0, in the thread handling '
+                             'them]'.format(CRYPTO_WORKERS))
+    parser.add_argument('--metrics-port', action='store',
+                        default=None, type=int,
+                        help='Specify a port of localhost to serve the metrics of the tunnel on '
+                             '[default: not served]')
+    parser.add_argument('--trace', action='store',
+                        default=None, metavar='FILE',
+                        help='Specify a file to append the time each traced frame reaches each stage to, '
+                             'read with python3 -m ssh_tunnel.tracing [default: not traced]')
+    parser.add_argument('--trace-sample', action='store',
+                        default=TRACE_SAMPLE, type=float,
+                        help='Specify the share of the frames sent which are traced, the homeside tracing '
+                             'the same ones [default: {}]'.format(TRACE_SAMPLE))
+    parser.add_argument('--profile', action='store',
+                        default=None, metavar='PREFIX',
+                        help='Sample the stacks of every thread between two {} signals, and write them to '
+                             'PREFIX.<time>.folded [default: off]'.format(PROFILE_SIGNAL.name))
+    parser.add_argument('--log-level', action='store',
+                        default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help='Specify the level of the messages logged [default: INFO]')
     parser.add_argument('passphrase', action='store',
                         help='Specify the passphrase to use')
     args = parser.parse_args()
-    run(args.passphrase, ssh_port=args.ssh_port, baseurl=args.baseurl, bind=args.bind, interval=float(args.interval))
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M')
+    run(args.passphrase, ssh_port=args.ssh_port, baseurl=args.baseurl, bind=args.bind, interval=float(args.interval),
+        linger=args.linger, max_frame_size=args.max_frame, window=args.window, engine=args.engine,
+        compress=args.compress, metrics_port=args.metrics_port, exchange_wait=args.exchange_wait,
+        stream=args.stream, crypto_workers=args.crypto_workers, trace=args.trace, trace_sample=args.trace_sample,
+        stream_timeout=args.stream_timeout, profile=args.profile)